@@ -10,16 +10,35 @@
 #    License for the specific language governing permissions and limitations
 #    under the License."""Top-level package for RBD iSCSI Client."""
 
-import pbr.version
+import sys
 
 __all_ = ['__version__']
 
 __author__ = """Walter A. Boring IV"""
 __email__ = 'waboring@hemna.com'
 
-version_info = pbr.version.VersionInfo('rbd-iscsi-client')
 
-try:
-    version = version_info.version_string()
-except AttributeError:
-    version = None
+def __getattr__(name):
+    """Resolve version and version_info on first access.
+
+    pbr scans the installed package metadata, which is too slow to do
+    on every import of the package.
+    """
+    if name not in ('version', 'version_info'):
+        raise AttributeError("module %r has no attribute %r" %
+                             (__name__, name))
+
+    import pbr.version
+
+    version_info = pbr.version.VersionInfo('rbd-iscsi-client')
+    try:
+        version = version_info.version_string()
+    except AttributeError:
+        version = None
+    globals().update(version=version, version_info=version_info)
+    return globals()[name]
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ needs Python 3.7, resolve them now
+    __getattr__('version')
@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Disk lookup cache
+
+.. module: cache
+
+:Description: DiskCache remembers the results of find_disk(pool, image),
+the disks found and, for a shorter time, the disks that weren't.  The
+disk names listed by a get_disks() or get_config() response are also
+kept, so for a while any other disk is known to be missing without
+asking the gateway.
+"""
+
+import collections
+import threading
+import time
+
+# Returned by DiskCache.get() for a disk known not to exist
+MISSING = object()
+
+
+class DiskCache(object):
+    """LRU cache of find_disk() results keyed by (pool, image).
+
+    :param maxsize: Number of disks kept
+    :param ttl: Seconds a disk found is kept
+    :param negative_ttl: Seconds a disk not found is kept, and the disk
+                         names of a listing are trusted
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, negative_ttl=10,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._known = None
+        self._known_expires = 0
+        self._generation = 0
+
+    @property
+    def generation(self):
+        """Changes every time a disk is invalidated.
+
+        Read it before fetching a listing and pass it to set_known(),
+        so that a listing racing with a disk creation or deletion is
+        ignored.
+        """
+        return self._generation
+
+    def get(self, key):
+        """Return the cached (resp, body), MISSING, or None if unknown."""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+            if self._known is not None and self._known_expires > now:
+                if key not in self._known:
+                    return MISSING
+        return None
+
+    def _put(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def put(self, key, result):
+        """Cache the (resp, body) of a disk found."""
+        self._put(key, result, self.ttl)
+
+    def put_missing(self, key):
+        """Cache a disk not found."""
+        self._put(key, MISSING, self.negative_ttl)
+
+    def set_known(self, keys, generation=None):
+        """Trust keys as the complete list of disks for a while.
+
+        The disks listed and cached as missing are forgotten.
+        """
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            known = set(keys)
+            for key in known:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] is MISSING:
+                    del self._entries[key]
+            self._known = known
+            self._known_expires = self._clock() + self.negative_ttl
+
+    def invalidate(self, key, exists=None):
+        """Forget what is cached about a disk.
+
+        exists, when known, updates the list of disks.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(key, None)
+            if self._known is not None:
+                if exists:
+                    self._known.add(key)
+                elif exists is not None:
+                    self._known.discard(key)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._known = None
+
+    def __len__(self):
+        return len(self._entries)
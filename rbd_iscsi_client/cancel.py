@@ -0,0 +1,207 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Cancellation and deadlines
+
+.. module: cancel
+
+:Description: A CancelToken stops the client calls made under it, when
+it is cancelled or when its deadline passes.  The calls check it before
+every attempt and during the backoff sleeps between retries, and the
+HTTP timeout of an attempt never goes past the deadline.  The token of
+a scope is carried into the threads of the parallel helpers.
+
+Usage::
+
+    with cancel.scope(timeout=30) as token:
+        cl.register_disk(target_iqn, 'rbd/volume-1')
+        cl.export_disk(target_iqn, initiator_iqn, 'rbd', 'volume-1')
+
+and token.cancel() from another thread stops them.
+"""
+
+import contextlib
+import functools
+import threading
+import time
+import weakref
+
+from rbd_iscsi_client import exceptions
+
+# Longest a sleep with a green sleep function goes without checking the
+# token.
+POLL_INTERVAL = 0.1
+
+_local = threading.local()
+
+
+class CancelToken(object):
+    """Cancellation state shared by the calls of an operation.
+
+    :param timeout: Seconds from now after which the calls fail with
+                    DeadlineExceeded
+    :param deadline: time.monotonic() after which they fail, the
+                     earliest of deadline and timeout is used
+    :param parent: The token is also cancelled with parent, and never
+                   outlives its deadline
+    """
+
+    def __init__(self, timeout=None, deadline=None, parent=None,
+                 clock=time.monotonic):
+        self._clock = clock
+        if timeout is not None:
+            deadline = _earliest(deadline, clock() + timeout)
+        self.parent = parent
+        if parent is not None:
+            deadline = _earliest(deadline, parent.deadline)
+        self.deadline = deadline
+        self.reason = None
+        self._event = threading.Event()
+        self._children = weakref.WeakSet()
+        self._lock = threading.Lock()
+        if parent is not None:
+            parent._adopt(self)
+
+    def _adopt(self, child):
+        with self._lock:
+            self._children.add(child)
+            cancelled = self._event.is_set()
+        if cancelled:
+            child.cancel(self.reason)
+
+    def cancel(self, reason=None):
+        """Cancel the calls made under the token and its children."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            children = list(self._children)
+            self._children.clear()
+        for child in children:
+            child.cancel(reason)
+
+    @property
+    def cancelled(self):
+        """Was the token cancelled, or did its deadline pass?"""
+        return self._event.is_set() or self.remaining() == 0
+
+    def remaining(self):
+        """Seconds left before the deadline, None without deadline."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self._clock())
+
+    def check(self):
+        """Raise Cancelled or DeadlineExceeded if the calls must stop."""
+        if self._event.is_set():
+            raise exceptions.Cancelled(self.reason)
+        if self.remaining() == 0:
+            raise exceptions.DeadlineExceeded()
+
+    def sleep(self, seconds, sleep=None):
+        """Sleep, waking up to raise as soon as the token is cancelled.
+
+        A sleep that would end after the deadline raises
+        DeadlineExceeded right away, there is no point in waiting.
+
+        With sleep, the sleep function of a green runtime, the token is
+        checked every POLL_INTERVAL seconds of sleeping with it instead
+        of waiting on the token, which would block the OS thread.
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is not None and seconds >= remaining:
+            raise exceptions.DeadlineExceeded()
+        if sleep is None:
+            self._event.wait(seconds)
+        else:
+            while seconds > 0:
+                interval = min(seconds, POLL_INTERVAL)
+                sleep(interval)
+                seconds -= interval
+                self.check()
+        self.check()
+
+    def timeout(self, timeout):
+        """Return timeout capped to the time left before the deadline."""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if timeout is None:
+            return remaining
+        return min(timeout, remaining)
+
+
+def _earliest(first, second):
+    if first is None:
+        return second
+    if second is None:
+        return first
+    return min(first, second)
+
+
+def current():
+    """Return the CancelToken of the current scope, or None."""
+    return getattr(_local, 'token', None)
+
+
+@contextlib.contextmanager
+def scope(token=None, timeout=None):
+    """Make the client calls of the block use a token.
+
+    Without token, a new one is created, a child of the token of the
+    enclosing scope if there is one, with the given timeout.  Yields the
+    token.
+    """
+    if token is None:
+        token = CancelToken(timeout=timeout, parent=current())
+    elif timeout is not None:
+        token = CancelToken(timeout=timeout, parent=token)
+    previous = current()
+    _local.token = token
+    try:
+        yield token
+    finally:
+        _local.token = previous
+
+
+@contextlib.contextmanager
+def shield():
+    """Run the block without the token of the enclosing scope.
+
+    For the cleanups that must go on once the operation was abandoned,
+    like rolling back a transaction.
+    """
+    previous = current()
+    _local.token = None
+    try:
+        yield
+    finally:
+        _local.token = previous
+
+
+def propagate(func):
+    """Wrap func to run under the token of the current scope.
+
+    For the functions handed to other threads, which don't see the
+    scopes of the caller.
+    """
+    token = current()
+    if token is None:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with scope(token):
+            return func(*args, **kwargs)
+    return wrapper
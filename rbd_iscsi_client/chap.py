@@ -0,0 +1,92 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+CHAP credential rotation
+
+.. module: chap
+
+:Description: Sets new CHAP credentials on the clients of a target
+concurrently.  The updates are sent by a bounded pool of workers under a
+rate cap, so that rotating thousands of initiators neither takes hours
+nor floods the gateway, and each client is checked with
+get_client_info() once updated.
+"""
+
+import collections
+import time
+
+from rbd_iscsi_client import cancel
+from rbd_iscsi_client import parallel
+from rbd_iscsi_client import throttle
+
+
+class Rotation(collections.namedtuple('Rotation',
+                                      ['client_iqn', 'username', 'error',
+                                       'elapsed'])):
+    """The outcome of the rotation of the credentials of one client.
+
+    username is the new CHAP username and elapsed the seconds taken by
+    the update and its verification.  error is None when both
+    succeeded, otherwise the exception raised by the first that failed.
+    The password isn't kept.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def rotate(client, target_iqn, credentials, clients=None, rate=None,
+           max_workers=parallel.DEFAULT_MAX_WORKERS, verify=True):
+    """Set new CHAP credentials on clients of a target.
+
+    :param client: The RBDISCSIClient
+    :param target_iqn: The target of the clients
+    :param credentials: Called with a client iqn, returns its new
+                        (username, password)
+    :param clients: Iterable of the client iqns, every client of the
+                    target by default
+    :param rate: Updates started per second at most, unlimited by
+                 default
+    :param max_workers: Updates in flight at once
+    :param verify: Check every client with get_client_info() once its
+                   credentials are set
+
+    Returns an iterator of Rotation, in the order the clients complete.
+    A failed client doesn't stop the others.
+    """
+    if clients is None:
+        resp, body = client.get_clients(target_iqn)
+        clients = body.get('clients', []) if body else []
+    limiter = throttle.PriorityRateLimiter(rate) if rate else None
+    outcomes = {}
+
+    def _rotate(client_iqn):
+        if limiter is not None:
+            limiter.acquire(token=cancel.current())
+        start = time.monotonic()
+        username = None
+        try:
+            username, password = credentials(client_iqn)
+            result = client.set_client_auth(target_iqn, client_iqn,
+                                            username, password)
+            if verify:
+                result = client.get_client_info(target_iqn, client_iqn)
+        finally:
+            outcomes[client_iqn] = (username, time.monotonic() - start)
+        return result
+
+    for result in parallel.fan_out(_rotate, clients,
+                                   max_workers=max_workers):
+        username, elapsed = outcomes.pop(result.key)
+        yield Rotation(result.key, username, result.error, elapsed)
@@ -0,0 +1,311 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+rbd-iscsi command line tool
+
+.. module: cli
+
+:Description: The ``rbd-iscsi`` console script.  Inspects gateways,
+runs bulk export/unexport operations from a CSV file and probes the
+latency of the rbd-target-api endpoints.
+
+The credentials default to the RBD_ISCSI_USERNAME and
+RBD_ISCSI_PASSWORD environment variables.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import loadgen
+from rbd_iscsi_client import parallel
+from rbd_iscsi_client import stats
+
+# The read only endpoints measured by the probe command.
+PROBE_ENDPOINTS = ('/api', '/api/config', '/api/disks', '/api/targets',
+                   '/api/gatewayinfo')
+
+CSV_FIELDS = ('target_iqn', 'client_iqn', 'pool', 'image')
+
+
+def _client(args, url):
+    return client.RBDISCSIClient(args.username, args.password, url,
+                                 secure=args.verify, timeout=args.timeout)
+
+
+def _write_row(out, fmt, row):
+    out.write(fmt % row + "\n")
+    out.flush()
+
+
+def _dump_disks(cl, args, out):
+    resp, config = cl.get_config()
+    disks = (config or {}).get('disks', {})
+    if args.format == 'json':
+        json.dump(disks, out, indent=4, sort_keys=True)
+        out.write("\n")
+        return 0
+
+    fmt = "%-40s %-10s %-20s %-12s"
+    _write_row(out, fmt, ('DISK', 'SIZE', 'OWNER', 'BACKSTORE'))
+    for name in sorted(disks):
+        disk = disks[name]
+        _write_row(out, fmt, (name, disk.get('size', ''),
+                              disk.get('owner', ''),
+                              disk.get('backstore', '')))
+    return 0
+
+
+def _dump_targets(cl, args, out):
+    resp, config = cl.get_config()
+    targets = (config or {}).get('targets', {})
+    if args.format == 'json':
+        json.dump(targets, out, indent=4, sort_keys=True)
+        out.write("\n")
+        return 0
+
+    # The session counts are fetched in parallel, and every row is
+    # printed as soon as its target info is in.
+    fmt = "%-50s %8s %8s %8s"
+    _write_row(out, fmt, ('TARGET', 'DISKS', 'CLIENTS', 'SESSIONS'))
+    status = 0
+    results = parallel.fan_out(cl.get_target_info, sorted(targets),
+                               max_workers=args.workers)
+    for result in results:
+        target = targets[result.key]
+        if result.ok:
+            sessions = (result.body or {}).get('num_sessions', '')
+        else:
+            sessions = 'error'
+            status = 1
+        _write_row(out, fmt, (result.key, len(target.get('disks') or ()),
+                              len(target.get('clients') or ()), sessions))
+    return status
+
+
+def _dump_config(cl, args, out):
+    resp, config = cl.get_config()
+    if args.format == 'json':
+        json.dump(config, out, indent=4, sort_keys=True)
+        out.write("\n")
+        return 0
+
+    fmt = "%-20s %s"
+    for key in sorted(config or {}):
+        value = config[key]
+        if isinstance(value, dict):
+            value = "%d entries" % len(value)
+        _write_row(out, fmt, (key, value))
+    return 0
+
+
+DUMPERS = {'config': _dump_config,
+           'disks': _dump_disks,
+           'targets': _dump_targets}
+
+
+def do_dump(args, out):
+    return DUMPERS[args.what](_client(args, args.url[0]), args, out)
+
+
+def _read_mappings(path):
+    with open(path) as f:
+        reader = csv.DictReader(f)
+        missing = set(CSV_FIELDS) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError("CSV file %s is missing the columns: %s" %
+                             (path, ", ".join(sorted(missing))))
+        for row in reader:
+            yield tuple(row[field].strip() for field in CSV_FIELDS)
+
+
+def do_bulk(args, out):
+    cl = _client(args, args.url[0])
+    call = getattr(cl, '%s_disk' % args.command)
+
+    def _run(mapping):
+        return call(*mapping)
+
+    status = 0
+    results = parallel.fan_out(_run, _read_mappings(args.csv),
+                               max_workers=args.workers)
+    for result in results:
+        outcome = 'ok' if result.ok else 'FAILED: %s' % result.error
+        if not result.ok:
+            status = 1
+        _write_row(out, "%s %s %s/%s %s", result.key + (outcome,))
+    return status
+
+
+def _probe_gateway(args, url):
+    cl = _client(args, url)
+    latencies = dict((endpoint, []) for endpoint in PROBE_ENDPOINTS)
+    errors = dict((endpoint, 0) for endpoint in PROBE_ENDPOINTS)
+    for i in range(args.count):
+        for endpoint in PROBE_ENDPOINTS:
+            start = time.monotonic()
+            try:
+                # A single attempt, the retry sleeps would be counted as
+                # latency.  A request needing a retry is an error.
+                cl.get(endpoint, tries=1)
+            except Exception:
+                errors[endpoint] += 1
+                continue
+            latencies[endpoint].append(time.monotonic() - start)
+    return latencies, errors
+
+
+def do_probe(args, out):
+    fmt = "%-30s %-18s %6s %6s %9s %9s %9s %9s"
+    _write_row(out, fmt, ('GATEWAY', 'ENDPOINT', 'OK', 'ERRORS',
+                          'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+
+    def _ms(value):
+        return '-' if value is None else '%.1f' % (value * 1000)
+
+    def _probe(url):
+        return _probe_gateway(args, url)
+
+    status = 0
+    # Every gateway is probed in parallel, the endpoints of a gateway
+    # are probed one after the other so they don't skew each other.
+    for result in parallel.fan_out(_probe, args.url,
+                                   max_workers=len(args.url)):
+        if not result.ok:
+            sys.stderr.write("rbd-iscsi: probing %s failed: %s\n" %
+                             (result.key, result.error))
+            status = 1
+            continue
+        latencies, errors = result.resp, result.body
+        for endpoint in PROBE_ENDPOINTS:
+            summary = stats.summarize(latencies[endpoint])
+            if errors[endpoint]:
+                status = 1
+            _write_row(out, fmt, (result.key, endpoint, summary['count'],
+                                  errors[endpoint], _ms(summary['p50']),
+                                  _ms(summary['p90']), _ms(summary['p99']),
+                                  _ms(summary['max'])))
+    return status
+
+
+def do_loadgen(args, out):
+    if args.fake:
+        cl = client.RBDISCSIClient(args.username, args.password,
+                                   'http://fake-gateway',
+                                   transport=fake.FakeTransport())
+    else:
+        cl = _client(args, args.url[0])
+    generator = loadgen.LoadGenerator(
+        cl, args.target_iqn, args.client_iqn, pool=args.pool,
+        mix=loadgen.parse_mix(args.mix) if args.mix else None,
+        rate=args.rate, concurrency=args.concurrency,
+        duration=args.duration, prefix=args.prefix, seed=args.seed)
+    generator.setup()
+    try:
+        report = generator.run()
+    finally:
+        if not args.no_cleanup:
+            generator.cleanup()
+    out.write(report.format() + "\n")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='rbd-iscsi',
+        description="Inspect and operate ceph-iscsi rbd-target-api "
+                    "gateways.")
+    parser.add_argument('--url', action='append', default=[],
+                        help="Base url of a gateway, e.g. "
+                             "http://10.0.0.69:5000.  Repeat it to probe "
+                             "several gateways.")
+    parser.add_argument('--username',
+                        default=os.environ.get('RBD_ISCSI_USERNAME'))
+    parser.add_argument('--password',
+                        default=os.environ.get('RBD_ISCSI_PASSWORD'))
+    parser.add_argument('--verify', action='store_true',
+                        help="Verify the SSL certificate of the gateway.")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--workers', type=int,
+                        default=parallel.DEFAULT_MAX_WORKERS,
+                        help="Number of requests to run in parallel.")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    dump = subparsers.add_parser('dump', help="Dump the gateway config.")
+    dump.add_argument('what', choices=sorted(DUMPERS))
+    dump.add_argument('--format', choices=('json', 'table'),
+                      default='table')
+    dump.set_defaults(func=do_dump)
+
+    for command in ('export', 'unexport'):
+        bulk = subparsers.add_parser(
+            command, help="%s the disks listed in a CSV file with the "
+                          "columns %s." % (command.capitalize(),
+                                           ", ".join(CSV_FIELDS)))
+        bulk.add_argument('--csv', required=True)
+        bulk.set_defaults(func=do_bulk)
+
+    probe = subparsers.add_parser(
+        'probe', help="Measure the latency of the read endpoints.")
+    probe.add_argument('--count', type=int, default=10,
+                       help="Number of requests per endpoint.")
+    probe.set_defaults(func=do_probe)
+
+    load = subparsers.add_parser(
+        'loadgen', help="Generate load to capacity test the gateways.")
+    load.add_argument('--fake', action='store_true',
+                      help="Run against an in process fake gateway.")
+    load.add_argument('--target-iqn', required=True)
+    load.add_argument('--client-iqn', required=True)
+    load.add_argument('--pool', default='rbd')
+    load.add_argument('--mix',
+                      help="Operation weights, e.g. "
+                           "create_disk=1,export_disk=1,find_disk=4. "
+                           "Operations: %s." %
+                           ", ".join(sorted(loadgen.TRANSITIONS) +
+                                     list(loadgen.READ_OPS)))
+    load.add_argument('--rate', type=float, default=10,
+                      help="Operations started per second.")
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--duration', type=float, default=10,
+                      help="Seconds to run for.")
+    load.add_argument('--prefix', default='loadgen',
+                      help="Name prefix of the created volumes.")
+    load.add_argument('--seed', type=int)
+    load.add_argument('--no-cleanup', action='store_true',
+                      help="Leave the created volumes behind.")
+    load.set_defaults(func=do_loadgen)
+    return parser
+
+
+def main(argv=None, out=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if not args.url and not getattr(args, 'fake', False):
+        parser.error("--url is required")
+    out = out or sys.stdout
+    try:
+        return args.func(args, out)
+    except (exceptions.ClientException, ValueError, IOError) as ex:
+        sys.stderr.write("rbd-iscsi: %s\n" % ex)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
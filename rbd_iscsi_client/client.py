@@ -19,13 +19,112 @@ the ceph-iscsi/rbd-target-api service running on the ceph iscsi gateway
 host.
 """
 
+import collections
+import copy
+import functools
+import inspect
 import json
 import logging
+import os
+import threading
 import time
+from urllib import parse
 
+from rbd_iscsi_client import cache
+from rbd_iscsi_client import cancel as cancels
+from rbd_iscsi_client import chap
+from rbd_iscsi_client import encoding
 from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import green as greens
+from rbd_iscsi_client import health
+from rbd_iscsi_client import hedge as hedges
+from rbd_iscsi_client import inventory
+from rbd_iscsi_client import journal as journals
+from rbd_iscsi_client import lazy
+from rbd_iscsi_client import metrics
+from rbd_iscsi_client import parallel
+from rbd_iscsi_client import reconcile as reconciler
+from rbd_iscsi_client import routing
+from rbd_iscsi_client import snapshot
+from rbd_iscsi_client import teardown as teardowns
+from rbd_iscsi_client import throttle
+from rbd_iscsi_client import transport as transports
+
+# requests is only imported when the first client is created
+requests = lazy.LazyModule('requests')
+
+# Number of requests whose (request, start, end) times are kept in
+# RBDISCSIClient.times, the oldest are dropped.
+TIMES_KEPT = 1000
+
+# Bumped in the child process after every fork, see _check_fork()
+_fork_generation = 0
+
+
+def _after_fork_in_child():
+    global _fork_generation
+    _fork_generation += 1
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+    def _fork_id():
+        """A value that changes in the child process after a fork."""
+        return _fork_generation
+else:
+    # Python 3.6 has no fork hooks, the child is told apart by its pid
+    _fork_id = os.getpid
+
+
+class _DefaultRetryExceptions(object):
+    """The default RBDISCSIClient.retry_exceptions.
+
+    They include a requests exception, so they are only built when first
+    looked up.  Assigning retry_exceptions on a subclass or an instance
+    overrides them as usual.
+    """
+
+    def __get__(self, obj, cls):
+        value = (exceptions.HTTPServiceUnavailable,
+                 requests.exceptions.ConnectionError)
+        RBDISCSIClient.retry_exceptions = value
+        return value
+
+
+def _journaled(redact=()):
+    """Record the calls of a client method in the client journal.
+
+    The arguments named in redact, like passwords, are not written to
+    the journal.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        signature = signature.replace(
+            parameters=list(signature.parameters.values())[1:])
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.journal is None:
+                return func(self, *args, **kwargs)
+            self._check_fork()
+            call_args = dict(signature.bind(*args, **kwargs).arguments)
+            for name in redact:
+                if name in call_args:
+                    call_args[name] = journals.REDACTED
+            op_id = self.journal.intent(func.__name__, call_args)
+            try:
+                result = func(self, *args, **kwargs)
+            except Exception as ex:
+                self.journal.failed(op_id, ex)
+                raise
+            self.journal.done(op_id)
+            return result
 
-import requests
+        wrapper.journal_signature = signature
+        wrapper.journal_redact = tuple(redact)
+        return wrapper
+    return decorator
 
 
 class RBDISCSIClient(object):
@@ -45,28 +144,191 @@ class RBDISCSIClient(object):
     timeout = 60
 
     _logger = logging.getLogger(__name__)
-    retry_exceptions = (exceptions.HTTPServiceUnavailable,
-                        requests.exceptions.ConnectionError)
+    retry_exceptions = _DefaultRetryExceptions()
 
     def __init__(self, username, password, base_url,
                  suppress_ssl_warnings=False, timeout=None,
-                 secure=False, http_log_debug=False):
+                 secure=False, http_log_debug=False, snapshot_file=None,
+                 rate_limiter=None, transport=None, json_body=False,
+                 adaptive_concurrency=None, journal_file=None,
+                 compression=True, compression_threshold=0, hedging=None,
+                 disk_cache=None, green=None, shared_config=None,
+                 owner_routing=False, retry_budget=None, prewarm=None,
+                 snapshot_max_age=86400):
         super(RBDISCSIClient, self).__init__()
+        self._fork_generation = _fork_id()
 
         self.username = username
         self.password = password
-        self.api_url = base_url
+        # base_url is the url of a gateway, or a list of the urls of the
+        # gateways of the cluster.  The first one is the preferred one.
+        if isinstance(base_url, (list, tuple)):
+            self.api_urls = list(base_url)
+        else:
+            self.api_urls = [base_url]
+        self.api_url = self.api_urls[0]
+        self.health_monitor = None
         self.timeout = timeout
         self.secure = secure
 
-        self.times = []
+        # Bounded, the health monitor keeps sending requests for as long
+        # as the client lives.
+        self.times = collections.deque(maxlen=TIMES_KEPT)
         self.set_debug_flag(http_log_debug)
 
+        # Under eventlet or gevent, detected unless green is given, the
+        # retry sleeps are cooperative and large JSON bodies are decoded
+        # in a native thread.
+        self.runtime = greens.get_runtime(green)
+
         if suppress_ssl_warnings:
             requests.packages.urllib3.disable_warnings()
 
         self.auth = requests.auth.HTTPBasicAuth(username, password)
 
+        # The transport actually sending the HTTP requests, see
+        # rbd_iscsi_client.transport.
+        if transport is None:
+            transport = transports.RequestsTransport()
+        self.transport = transport
+
+        # The headers sent with every request are built once here, the
+        # request bodies are encoded by self._encoder.  json_body should
+        # only be set for gateways that accept JSON request bodies.
+        self._encoder = encoding.BodyEncoder(use_json=json_body)
+        self._static_headers = {'User-Agent': self.USER_AGENT,
+                                'Accept': 'application/json'}
+
+        # With compression, the responses are requested compressed with
+        # every coding the transport can decode.  Paths whose last
+        # response was smaller than compression_threshold bytes are
+        # requested uncompressed, it isn't worth it for them.  The sizes
+        # are kept by method and endpoint, not by full path, so there are
+        # only a few of them however many disks and clients there are.
+        accept_encoding = transports.accept_encoding(transport)
+        if accept_encoding and not compression:
+            accept_encoding = 'identity'
+        if accept_encoding:
+            self._static_headers['Accept-Encoding'] = accept_encoding
+        self.compression_threshold = compression_threshold
+        self._response_sizes = {}
+
+        self._body_headers = dict(self._static_headers)
+        self._body_headers['Content-Type'] = self._encoder.content_type
+
+        # Optional throttle.PriorityRateLimiter shared by every request
+        # this client sends.
+        self.rate_limiter = rate_limiter
+
+        self.metrics = metrics.Metrics()
+
+        # With adaptive_concurrency set (True, or a dict of arguments for
+        # throttle.AdaptiveConcurrencyLimiter) the requests in flight to
+        # each gateway are limited by a limiter of their own.
+        if adaptive_concurrency is True:
+            adaptive_concurrency = {}
+        self.adaptive_concurrency = adaptive_concurrency
+        self._concurrency_limiters = {}
+        self._limiters_lock = threading.Lock()
+
+        # With retry_budget set (True, or a dict of arguments for
+        # throttle.RetryBudget) the retries to each gateway are only
+        # made while they are a small fraction of its recent successful
+        # requests, so that an overload isn't multiplied by the retries.
+        if retry_budget is True:
+            retry_budget = {}
+        self.retry_budget = retry_budget
+        self._retry_budgets = {}
+
+        # When a snapshot file is given, the last config we fetched is
+        # persisted to it, and the first get_config() after startup is
+        # served from it while it is revalidated in the background,
+        # unless it was fetched more than snapshot_max_age seconds ago.
+        self.snapshot_file = snapshot_file
+        self._snapshot_lock = threading.Lock()
+        self._config_snapshot = None
+        self._snapshot_warm = False
+        self._revalidating = False
+        if snapshot_file:
+            self._config_snapshot = snapshot.load(snapshot_file)
+            self._snapshot_warm = (
+                self._config_snapshot is not None and
+                (snapshot_max_age is None or
+                 time.time() - self._config_snapshot.fetched_at <=
+                 snapshot_max_age))
+
+        # With hedging set (True, or a dict of arguments for
+        # hedge.Hedger) and several gateways, the latency critical reads
+        # are hedged across two gateways.
+        if hedging is True:
+            hedging = {}
+        self.hedger = None
+        if hedging is not None:
+            self.hedger = hedges.Hedger(**hedging)
+
+        # With shared_config set (the path of a SQLite file, or a dict of
+        # arguments for snapshot.SharedCache) get_config() results are
+        # shared by the processes of the host.
+        if isinstance(shared_config, str):
+            shared_config = {'path': shared_config}
+        self.shared_config = None
+        if shared_config is not None:
+            shared_config.setdefault('sleep', self.runtime.sleep)
+            self.shared_config = snapshot.SharedCache(**shared_config)
+
+        # With disk_cache set (True, or a dict of arguments for
+        # cache.DiskCache) the results of find_disk() are cached.
+        if disk_cache is True:
+            disk_cache = {}
+        self.disk_cache = None
+        if disk_cache is not None:
+            self.disk_cache = cache.DiskCache(**disk_cache)
+
+        # With owner_routing and several gateways, the requests changing
+        # a disk are sent to the gateway owning it in the last config
+        # fetched, saving the gateways from forwarding them.
+        self.owner_routing = owner_routing
+        self._owner_urls = (None, {})
+
+        # When a journal file is given, the mutating calls are recorded
+        # in it so that recover() can finish what a dead process left
+        # half done.
+        self.journal = None
+        if journal_file:
+            self.journal = journals.Journal(journal_file)
+
+        # With prewarm set (True, or the number of connections per
+        # gateway) and a pooling transport, the connections to the
+        # gateways are opened now rather than by the first requests.
+        if prewarm:
+            self.prewarm(None if prewarm is True else prewarm)
+
+    def _check_fork(self):
+        """Rebuild the state inherited from the parent after a fork.
+
+        The threads of the parent don't exist in the child, so its locks
+        may be held forever and its connections are shared with the
+        parent.  They are replaced the first time the client is used in
+        the child.
+        """
+        fork_id = _fork_id()
+        if self._fork_generation == fork_id:
+            return
+        self._fork_generation = fork_id
+        self._snapshot_lock = threading.Lock()
+        self._revalidating = False
+        self._limiters_lock = threading.Lock()
+        self._concurrency_limiters = {}
+        self._retry_budgets = {}
+        self._response_sizes = {}
+        self.metrics.after_fork()
+        for component in (self.transport, self.rate_limiter, self.hedger,
+                          self.disk_cache, self.journal,
+                          self.health_monitor):
+            after_fork = getattr(component, 'after_fork', None)
+            if after_fork is not None:
+                after_fork()
+
     def set_debug_flag(self, flag):
         """Turn on/off http request/response debugging."""
         if not self.http_log_debug and flag:
@@ -112,44 +374,79 @@ class RBDISCSIClient(object):
 
         You should use get, post, delete instead.
 
+        The priority keyword selects the rate limiter class of the
+        request.  By default GET requests are background requests and
+        all other methods are interactive.  The tries keyword overrides
+        the number of attempts made.  The cancel keyword is the
+        cancel.CancelToken stopping the request, by default the one of
+        the current cancel.scope().
+
         """
-        kwargs.setdefault('headers', kwargs.get('headers', {}))
-        kwargs['headers']['User-Agent'] = self.USER_AGENT
-        kwargs['headers']['Accept'] = 'application/json'
-        if 'data' in kwargs:
-            payload = kwargs['data']
+        self._check_fork()
+        priority = kwargs.pop('priority', None)
+        tries = kwargs.pop('tries', None) or self.tries
+        token = kwargs.pop('cancel', None) or cancels.current()
+        payload = kwargs.get('data')
+        req_body = payload
+        base_headers = self._static_headers
+        if payload and isinstance(payload, dict):
+            encoded = self._encoder.encode(payload)
+            if encoded is not None:
+                req_body = encoded
+                base_headers = self._body_headers
+
+        headers = kwargs.get('headers')
+        if headers:
+            headers = dict(headers)
+            headers.update(base_headers)
         else:
-            payload = None
+            headers = dict(base_headers)
+        kwargs['headers'] = headers
 
         # args[0] contains the URL, args[1] contains the HTTP verb/method
         http_url = args[0]
         http_method = args[1]
+        gateway = self._gateway_of(http_url)
+        size_key = None
+        if self.compression_threshold and 'Accept-Encoding' in headers:
+            size_key = self._endpoint_of(http_method, http_url)
+            size = self._response_sizes.get(size_key)
+            if size is not None and size < self.compression_threshold:
+                headers['Accept-Encoding'] = 'identity'
+        if priority is None:
+            if http_method == 'GET':
+                priority = throttle.PRIORITY_BACKGROUND
+            else:
+                priority = throttle.PRIORITY_INTERACTIVE
 
         self._http_log_req(args, kwargs)
         r = None
         resp = None
         body = None
-        while r is None and self.tries > 0:
+        # Keep the retry state local to this call, so that concurrent
+        # requests made from the parallel helpers don't share it.
+        delay = self.delay
+        while r is None and tries > 0:
             try:
                 # Check to see if the request is being retried. If it is, we
                 # want to delay.
-                if self.delay:
-                    time.sleep(self.delay)
-
-                if self.timeout:
-                    r = requests.request(http_method, http_url, data=payload,
-                                         headers=kwargs['headers'],
-                                         auth=self.auth,
-                                         verify=self.secure,
-                                         timeout=self.timeout)
-                else:
-                    r = requests.request(http_method, http_url, data=payload,
-                                         auth=self.auth,
-                                         headers=kwargs['headers'],
-                                         verify=self.secure)
+                self._pause(delay, token)
+
+                if self.rate_limiter is not None:
+                    self._rate_limit(priority, token)
+
+                r = self._send(http_method, http_url, req_body,
+                               kwargs['headers'], token)
 
                 resp = r.headers
                 body = r.text
+                wire_bytes, decoded_bytes = transports.response_sizes(r)
+                self.metrics.incr('bytes_received', wire_bytes,
+                                  gateway=gateway)
+                self.metrics.incr('bytes_decoded', decoded_bytes,
+                                  gateway=gateway)
+                if size_key is not None:
+                    self._response_sizes[size_key] = decoded_bytes
                 if isinstance(body, bytes):
                     body = body.decode('utf-8')
 
@@ -168,7 +465,10 @@ class RBDISCSIClient(object):
                 # This assumes the body of the reply is JSON
                 if body:
                     try:
-                        body = json.loads(body)
+                        if self.runtime.should_offload(len(body)):
+                            body = self.runtime.offload(json.loads, body)
+                        else:
+                            body = json.loads(body)
                     except ValueError:
                         pass
                 else:
@@ -190,12 +490,15 @@ class RBDISCSIClient(object):
                 # If we catch an exception where we want to retry, we need to
                 # decrement the retry count prepare to try again.
                 r = None
-                self.tries -= 1
-                self.delay = self.delay * self.backoff + 1
+                tries -= 1
+                delay = delay * self.backoff + 1
 
                 # Raise exception, we have exhausted all retries.
-                if self.tries == 0:
+                if tries == 0:
+                    raise ex
+                if not self._retry_allowed(gateway):
                     raise ex
+                self.metrics.incr('retries', gateway=gateway)
             except requests.exceptions.HTTPError as err:
                 raise exceptions.HTTPError("HTTP Error: %s" % err)
             except requests.exceptions.URLRequired as err:
@@ -204,12 +507,185 @@ class RBDISCSIClient(object):
                 raise exceptions.TooManyRedirects(
                     "Too Many Redirects: %s" % err)
             except requests.exceptions.Timeout as err:
+                if token is not None:
+                    # The timeout was cut short by the deadline
+                    token.check()
                 raise exceptions.Timeout("Timeout: %s" % err)
             except requests.exceptions.RequestException as err:
                 raise exceptions.RequestException(
                     "Request Exception: %s" % err)
         return resp, body
 
+    @staticmethod
+    def _copy_response(resp):
+        """Return a copy of resp, as request() returns it.
+
+        The copy has case insensitive keys and the status attribute,
+        taken from the 'status' header when resp has none.
+        """
+        copied = requests.structures.CaseInsensitiveDict(resp)
+        copied.status = getattr(resp, 'status', None)
+        if copied.status is None:
+            copied.status = int(copied.get('status', 200))
+        return copied
+
+    @staticmethod
+    def _endpoint_of(method, url):
+        """Return (method, endpoint) of a request, e.g. ('GET', '/api/disk').
+
+        The endpoint is the path without the pool, image, target and
+        client names that follow the endpoint name.
+        """
+        path = parse.urlsplit(url).path
+        return method, '/'.join(path.split('/')[:3])
+
+    @staticmethod
+    def _gateway_of(url):
+        """Return the gateway (scheme://host:port) of a request url."""
+        parts = parse.urlsplit(url)
+        return "%s://%s" % (parts.scheme, parts.netloc)
+
+    def _concurrency_limiter(self, gateway):
+        if self.adaptive_concurrency is None:
+            return None
+        limiter = self._concurrency_limiters.get(gateway)
+        if limiter is None:
+            with self._limiters_lock:
+                limiter = self._concurrency_limiters.get(gateway)
+                if limiter is None:
+                    limiter = throttle.AdaptiveConcurrencyLimiter(
+                        **self.adaptive_concurrency)
+                    self._concurrency_limiters[gateway] = limiter
+        return limiter
+
+    def _retry_budget(self, gateway):
+        if self.retry_budget is None:
+            return None
+        budget = self._retry_budgets.get(gateway)
+        if budget is None:
+            with self._limiters_lock:
+                budget = self._retry_budgets.get(gateway)
+                if budget is None:
+                    budget = throttle.RetryBudget(**self.retry_budget)
+                    self._retry_budgets[gateway] = budget
+        return budget
+
+    def _retry_allowed(self, gateway):
+        """Take a retry to gateway from its retry budget."""
+        budget = self._retry_budget(gateway)
+        if budget is None or budget.try_retry():
+            return True
+        self.metrics.incr('retries_denied', gateway=gateway)
+        return False
+
+    def _rate_limit(self, priority, token):
+        """Wait for the rate limiter, giving up when token is cancelled."""
+        if token is None:
+            self.rate_limiter.acquire(priority)
+        else:
+            self.rate_limiter.acquire(priority, token=token)
+
+    def _pause(self, delay, token):
+        """Sleep before an attempt, and stop if the token says so."""
+        if token is None:
+            if delay:
+                self.runtime.sleep(delay)
+            return
+        if not delay:
+            token.check()
+        elif self.runtime.name is None:
+            token.sleep(delay)
+        else:
+            token.sleep(delay, sleep=self.runtime.sleep)
+
+    def _send(self, method, url, body, headers, token=None):
+        """Send one attempt of a request with the transport."""
+        gateway = self._gateway_of(url)
+        self.metrics.incr('requests', gateway=gateway)
+        r = self._send_limited(method, url, body, headers, gateway, token)
+        budget = self._retry_budget(gateway)
+        if budget is not None and r.status_code < 500:
+            budget.record_success()
+        return r
+
+    def _attempt_timeout(self, token):
+        """The timeout of an attempt about to be sent under token."""
+        if token is None:
+            return self.timeout
+        # The attempt can't be interrupted once sent, but it never
+        # waits for the gateway past the deadline.
+        token.check()
+        timeout = token.timeout(self.timeout)
+        if timeout is not None and timeout <= 0:
+            # A transport would take it for no timeout at all
+            raise exceptions.DeadlineExceeded()
+        return timeout
+
+    def _transport_request(self, method, url, body, headers, token):
+        return self.transport.request(method, url, data=body,
+                                      headers=headers,
+                                      auth=self.auth,
+                                      verify=self.secure,
+                                      timeout=self._attempt_timeout(token))
+
+    def _send_limited(self, method, url, body, headers, gateway, token):
+        """Send a request under the concurrency limit of gateway."""
+        limiter = self._concurrency_limiter(gateway)
+        if limiter is None:
+            return self._transport_request(method, url, body, headers,
+                                           token)
+
+        limiter.acquire(token=token)
+        outcome = throttle.OUTCOME_IGNORE
+        start = time.monotonic()
+        try:
+            r = self._transport_request(method, url, body, headers, token)
+            if r.status_code == exceptions.HTTPServiceUnavailable.http_status:
+                outcome = throttle.OUTCOME_OVERLOAD
+            elif r.status_code < 500:
+                outcome = throttle.OUTCOME_OK
+            return r
+        except requests.exceptions.Timeout:
+            outcome = throttle.OUTCOME_OVERLOAD
+            raise
+        finally:
+            limiter.release(time.monotonic() - start, outcome)
+            self.metrics.set('concurrency_limit', limiter.limit,
+                             gateway=gateway)
+
+    def prewarm(self, connections=None):
+        """Open pooled connections to every gateway ahead of the requests.
+
+        Only the transports keeping connection pools, like
+        transport.Urllib3Transport, support it.  A gateway that can't be
+        connected to is logged and skipped, the requests will retry it.
+
+        :param connections: Connections to open per gateway, the size of
+                            the transport pools by default
+        :returns: dict of the number of connections opened per gateway url
+        """
+        self._check_fork()
+        transport_prewarm = getattr(self.transport, 'prewarm', None)
+        if transport_prewarm is None:
+            return {}
+        opened = {}
+        for url in self.api_urls:
+            try:
+                opened[url] = transport_prewarm(url, connections,
+                                                verify=self.secure,
+                                                timeout=self.timeout)
+            except requests.exceptions.RequestException as ex:
+                self._logger.warning("Failed to prewarm the connections "
+                                     "to %s: %s", url, ex)
+                opened[url] = 0
+            self.metrics.incr('connections_prewarmed', opened[url],
+                              gateway=url)
+        return opened
+
+    def get_metrics(self):
+        """Return a snapshot of the client metrics, see metrics.Metrics."""
+        return self.metrics.snapshot()
+
     def _time_request(self, url, method, **kwargs):
         start_time = time.time()
         resp, body = self.request(url, method, **kwargs)
@@ -217,11 +693,106 @@ class RBDISCSIClient(object):
                            start_time, time.time()))
         return resp, body
 
-    def _cs_request(self, url, method, **kwargs):
-        resp, body = self._time_request(self.api_url + url, method,
+    def _cs_request(self, url, method, gateway=None, hedge=False,
+                    **kwargs):
+        if gateway is None:
+            if hedge and self.hedger is not None and method == 'GET':
+                gateways = self._usable_gateways()
+                if len(gateways) > 1:
+                    return self._hedged_request(url, method, gateways[0],
+                                                gateways[1], **kwargs)
+            gateway = self._select_gateway()
+        resp, body = self._time_request(gateway + url, method,
                                         **kwargs)
         return resp, body
 
+    def _hedged_request(self, url, method, primary, secondary, **kwargs):
+        """Send the request to primary, hedged with secondary."""
+        def _call(gateway):
+            return self._time_request(gateway + url, method, **kwargs)
+
+        def _hedge(gateway):
+            self.metrics.incr('hedges', gateway=gateway)
+            # A single attempt, the primary request does the retries
+            hedge_kwargs = dict(kwargs, tries=1)
+            return self._time_request(gateway + url, method, **hedge_kwargs)
+
+        # The requests run in the threads of the hedger
+        result, winner = self.hedger.run(cancels.propagate(_call), primary,
+                                         secondary,
+                                         hedge_call=cancels.propagate(_hedge))
+        if winner != primary:
+            self.metrics.incr('hedge_wins', gateway=winner)
+        return result
+
+    def _usable_gateways(self):
+        """The urls of the gateways that aren't known to be unhealthy."""
+        monitor = self.health_monitor
+        if monitor is None:
+            return self.api_urls
+        return [url for url in self.api_urls if monitor.is_usable(url)]
+
+    def _select_gateway(self):
+        """Return the url of the gateway to send a request to.
+
+        Without a health monitor this is always api_url.  With one, it
+        is the first of api_urls that isn't known to be unhealthy.
+        """
+        if self.health_monitor is None:
+            return self.api_url
+        gateways = self._usable_gateways()
+        if gateways:
+            return gateways[0]
+        raise exceptions.GatewayUnavailable(
+            "%s are unhealthy" % ", ".join(self.api_urls))
+
+    def _owner_gateway(self, pool, image):
+        """Return the url of the gateway owning a disk, or None.
+
+        The owner is looked up in the last config fetched, no request is
+        made.  None is returned when it isn't known, or when its gateway
+        is unhealthy, and the request goes to the usual gateway.
+        """
+        if not self.owner_routing or len(self.api_urls) < 2:
+            return None
+        snap = self._config_snapshot
+        if snap is None or not isinstance(snap.config, dict):
+            return None
+        config, owners = self._owner_urls
+        if config is not snap.config:
+            owners = routing.owner_urls(snap.config, self.api_urls)
+            self._owner_urls = (snap.config, owners)
+        url = owners.get(routing.disk_owner(snap.config,
+                                            '%s/%s' % (pool, image)))
+        if url is None:
+            return None
+        monitor = self.health_monitor
+        if monitor is not None and not monitor.is_usable(url):
+            return None
+        self.metrics.incr('owner_routed', gateway=url)
+        return url
+
+    def _volume_gateway(self, volume):
+        """_owner_gateway() of a 'pool/image' volume name."""
+        pool, sep, image = volume.partition('/')
+        return self._owner_gateway(pool, image)
+
+    def start_health_monitor(self, interval=30, **kwargs):
+        """Probe the gateways in the background and route by their health.
+
+        See health.HealthMonitor for the arguments.  Returns the monitor.
+        """
+        self.stop_health_monitor()
+        monitor = health.HealthMonitor(self, interval=interval, **kwargs)
+        monitor.start()
+        self.health_monitor = monitor
+        return monitor
+
+    def stop_health_monitor(self):
+        if self.health_monitor is not None:
+            self.health_monitor.stop()
+            self.health_monitor = None
+
     def get(self, url, **kwargs):
         return self._cs_request(url, 'GET', **kwargs)
 
@@ -239,8 +810,92 @@ class RBDISCSIClient(object):
         return self.get("/api")
 
     def get_config(self):
-        """Get the complete config object."""
-        return self.get("/api/config")
+        """Get the complete config object.
+
+        If the client was warm started from a snapshot_file, the
+        snapshot is returned until the background revalidation of it
+        against the gateway has finished.  A snapshot older than
+        snapshot_max_age isn't used, the config is fetched instead.
+
+        With shared_config, a config fetched by another process less
+        than max_age seconds ago is returned, and only one of the
+        processes fetches it when it is older.
+        """
+        self._check_fork()
+        if self.shared_config is not None:
+            snap = self.shared_config.get_or_fetch(self._fetch_snapshot)
+            return self._copy_response(snap.headers), snap.config
+
+        with self._snapshot_lock:
+            snap = self._config_snapshot
+            warm = self._snapshot_warm
+            if warm and not self._revalidating:
+                self._revalidating = True
+                thread = threading.Thread(target=self._revalidate_snapshot,
+                                          name='rbd-iscsi-revalidate')
+                thread.daemon = True
+                thread.start()
+
+        if warm:
+            return self._copy_response(snap.headers), snap.config
+        return self._fetch_config()
+
+    def _fetch_config(self):
+        """Fetch the config from the gateway, bypassing any snapshot."""
+        generation = self._disk_generation()
+        resp, body = self.get("/api/config")
+        self._store_snapshot(snapshot.ConfigSnapshot.from_response(resp,
+                                                                   body))
+        self._learn_disks((body or {}).get('disks'), generation)
+        return resp, body
+
+    def _fetch_snapshot(self):
+        resp, body = self._fetch_config()
+        return snapshot.ConfigSnapshot.from_response(resp, body)
+
+    def _revalidate_snapshot(self):
+        """Revalidate a warm started snapshot against the gateway."""
+        snap = self._config_snapshot
+        generation = self._disk_generation()
+        try:
+            resp, body = self.get("/api/config",
+                                  headers=snap.conditional_headers())
+            if resp.get('status') == '304':
+                new_snap = snapshot.ConfigSnapshot(snap.config, snap.headers)
+            else:
+                new_snap = snapshot.ConfigSnapshot.from_response(resp, body)
+            self._store_snapshot(new_snap)
+            if isinstance(new_snap.config, dict):
+                self._learn_disks(new_snap.config.get('disks'), generation)
+        except Exception as ex:
+            # Keep serving the snapshot, the next get_config() call will
+            # retry the revalidation.
+            self._logger.warning("Failed to revalidate the config "
+                                 "snapshot: %s", ex)
+        else:
+            with self._snapshot_lock:
+                self._snapshot_warm = False
+        finally:
+            with self._snapshot_lock:
+                self._revalidating = False
+
+    def _store_snapshot(self, new_snap):
+        """Remember the latest config and persist it if it changed."""
+        with self._snapshot_lock:
+            old_snap = self._config_snapshot
+            self._config_snapshot = new_snap
+
+        if not self.snapshot_file:
+            return
+        if old_snap is not None and old_snap.same_as(new_snap):
+            # Only the fetch time changed, don't rewrite the file.
+            return
+        try:
+            snapshot.save(self.snapshot_file, new_snap)
+        except (IOError, OSError) as ex:
+            self._logger.warning("Failed to save the config snapshot to "
+                                 "%(path)s: %(ex)s",
+                                 {'path': self.snapshot_file, 'ex': ex})
 
     def get_sys_info(self, type):
         """Get system info of <type>.
@@ -268,6 +923,111 @@ class RBDISCSIClient(object):
         api = "/api/targetinfo/%(target_iqn)s" % {'target_iqn': target_iqn}
         return self.get(api)
 
+    def reconcile(self, target_iqn, desired_mappings, dry_run=False,
+                  unregister_unused=True, delete_unused=False,
+                  max_workers=parallel.DEFAULT_MAX_WORKERS):
+        """Converge the exports of a target to a desired state.
+
+        desired_mappings is the complete set of (client_iqn, disk)
+        exports wanted on the target, where disk is 'pool/image' or a
+        (pool, image) tuple.  The config is fetched once and the missing
+        disks, clients, registrations and exports are added, then the
+        exports that aren't wanted are removed, along with the disks no
+        longer used by the target.  See reconcile.plan() for the details.
+
+        Returns the reconcile.Plan.  Unless dry_run is set, the plan is
+        executed with at most max_workers calls in flight, and the
+        outcome of each step is in plan.results.
+        """
+        resp, config = self._fetch_config()
+        plan = reconciler.plan(config, target_iqn, desired_mappings,
+                               unregister_unused=unregister_unused,
+                               delete_unused=delete_unused)
+        if dry_run:
+            return plan
+        return reconciler.execute(self, plan, max_workers=max_workers)
+
+    def submit_many(self, ops, max_workers=parallel.DEFAULT_MAX_WORKERS,
+                    window=None):
+        """Run a stream of calls, in parallel but in order per resource.
+
+        ops is an iterable of (action, args), where action is the name
+        of a client method, e.g. ('export_disk', (target_iqn, client_iqn,
+        'rbd', 'volume-1')).  It is consumed lazily, so it can be a
+        generator of any length.  The ops on the same disk or client iqn
+        run in order, see parallel.submit_many() for the details.
+
+        Returns an iterator of parallel.Result keyed by op, in the order
+        the ops complete.
+        """
+        return parallel.submit_many(self, ops, max_workers=max_workers,
+                                    window=window)
+
+    def teardown(self, disks, preserve_image=True, delete=True,
+                 workers=None, max_inflight=None):
+        """Unexport, unregister and delete many disks.
+
+        disks is an iterable of 'pool/image' or (pool, image), which is
+        consumed as the pipeline has room.  The config is fetched once,
+        and every disk is unexported from its clients, unregistered from
+        its targets, then deleted unless delete is False.  Each stage
+        has its own workers, see teardown.teardown() for the details.
+
+        Returns an iterator of teardown.Outcome, one per disk, in the
+        order the disks complete.  A disk stops at its first failed
+        step, the others go on.
+        """
+        resp, config = self._fetch_config()
+        return teardowns.teardown(self, disks, config=config,
+                                  preserve_image=preserve_image,
+                                  delete=delete, workers=workers,
+                                  max_inflight=max_inflight)
+
+    def run_transaction(self, steps, name=None):
+        """Run dependent calls as one transaction.
+
+        steps is a list of (action, args), where action is the name of a
+        mutating client method, e.g.::
+
+            [('create_disk', ('rbd', 'volume-1')),
+             ('register_disk', (target_iqn, 'rbd/volume-1')),
+             ('export_disk', (target_iqn, client_iqn, 'rbd', 'volume-1'))]
+
+        The steps run in order.  If one fails, the ones already applied
+        are rolled back and the exception is raised.  With a journal, a
+        transaction interrupted by the death of the process is finished
+        by recover().
+
+        Returns the list of the (resp, body) of every step.
+        """
+        return journals.run_transaction(self, self.journal, steps, name)
+
+    def recover(self, mode=journals.RESUME):
+        """Finish the calls and transactions left unfinished in the journal.
+
+        mode is journal.RESUME to complete them or journal.ROLLBACK to
+        undo them.  Returns a list of journal.Recovered.
+        """
+        if self.journal is None:
+            return []
+        return journals.recover(self, self.journal, mode=mode)
+
+    def get_all_target_info(self, max_workers=parallel.DEFAULT_MAX_WORKERS):
+        """Fetch get_target_info() for every target in parallel.
+
+        The targets are discovered with get_targets() and the details
+        are fetched with at most max_workers requests in flight.
+
+        Returns an iterator of parallel.Result, one per target, in the
+        order the calls complete.  A failed call does not stop the
+        others; its exception is reported in Result.error.
+        """
+        resp, body = self.get_targets()
+        targets = body.get('targets', []) if body else []
+        return parallel.fan_out(self.get_target_info, targets,
+                                max_workers=max_workers)
+
+    @_journaled()
     def create_target_iqn(self, target_iqn, mode=None, controls=None):
         """Create the target iqn on the gateway."""
         api = "/api/target/%(target_iqn)s" % {'target_iqn': target_iqn}
@@ -280,6 +1040,7 @@ class RBDISCSIClient(object):
 
         return self.put(api, data=payload)
 
+    @_journaled()
     def delete_target_iqn(self, target_iqn):
         """Delete a target iqn from the gateways."""
         api = "/api/target/%(target_iqn)s" % {'target_iqn': target_iqn}
@@ -298,8 +1059,48 @@ class RBDISCSIClient(object):
         api = ("/api/clientinfo/%(target_iqn)s/%(client_iqn)s" %
                {'target_iqn': target_iqn,
                 'client_iqn': client_iqn})
-        return self.get(api)
+        return self.get(api, hedge=True)
+
+    def get_all_client_info(self, target_iqn,
+                            max_workers=parallel.DEFAULT_MAX_WORKERS):
+        """Fetch get_client_info() for every client of a target in parallel.
+
+        The clients are discovered with get_clients(target_iqn) and the
+        details are fetched with at most max_workers requests in flight.
+
+        Returns an iterator of parallel.Result keyed by client iqn, in the
+        order the calls complete.  A failed call does not stop the
+        others; its exception is reported in Result.error.
+        """
+        resp, body = self.get_clients(target_iqn)
+        clients = body.get('clients', []) if body else []
+
+        def _client_info(client_iqn):
+            return self.get_client_info(target_iqn, client_iqn)
+
+        return parallel.fan_out(_client_info, clients,
+                                max_workers=max_workers)
 
+    def rotate_client_auth(self, target_iqn, credentials, clients=None,
+                           rate=None,
+                           max_workers=parallel.DEFAULT_MAX_WORKERS,
+                           verify=True):
+        """Set new CHAP credentials on the clients of a target.
+
+        credentials is called with each client iqn and returns its new
+        (username, password).  The set_client_auth() calls run with at
+        most max_workers in flight and rate started per second, and each
+        client is then checked with get_client_info() unless verify is
+        False.  clients defaults to every client of the target.
+
+        Returns an iterator of chap.Rotation, with the outcome and the
+        duration of each client, in the order they complete.
+        """
+        return chap.rotate(self, target_iqn, credentials, clients=clients,
+                           rate=rate, max_workers=max_workers,
+                           verify=verify)
+
+    @_journaled()
     def create_client(self, target_iqn, client_iqn):
         """Delete a client."""
         api = ("/api/client/%(target_iqn)s/%(client_iqn)s" %
@@ -307,6 +1108,7 @@ class RBDISCSIClient(object):
                 'client_iqn': client_iqn})
         return self.put(api)
 
+    @_journaled()
     def delete_client(self, target_iqn, client_iqn):
         """Delete a client."""
         api = ("/api/client/%(target_iqn)s/%(client_iqn)s" %
@@ -314,6 +1116,7 @@ class RBDISCSIClient(object):
                 'client_iqn': client_iqn})
         return self.delete(api)
 
+    @_journaled(redact=('password',))
     def set_client_auth(self, target_iqn, client_iqn, username, password):
         """Set the client chap credentials."""
         url = ("/api/clientauth/%(target_iqn)s/%(client_iqn)s" %
@@ -323,10 +1126,46 @@ class RBDISCSIClient(object):
                 'password': password}
         return self.put(url, data=args)
 
+    def get_inventory(self):
+        """Get the disks of the config as an inventory.Inventory.
+
+        One row per disk with its pool, image, size in bytes, owner,
+        backstore and its number of targets and clients, ready to be
+        written to CSV, Arrow or Parquet.
+        """
+        resp, config = self.get_config()
+        return inventory.Inventory.from_config(config)
+
     def get_disks(self):
         """Get the rbd disks defined to the gateways."""
-        return self.get("/api/disks")
+        generation = self._disk_generation()
+        resp, body = self.get("/api/disks")
+        self._learn_disks((body or {}).get('disks'), generation)
+        return resp, body
+
+    def _disk_generation(self):
+        if self.disk_cache is None:
+            return None
+        return self.disk_cache.generation
+
+    def _learn_disks(self, names, generation):
+        """Give the disk cache the complete list of disk names."""
+        if self.disk_cache is None or names is None:
+            return
+        keys = []
+        for name in names:
+            try:
+                keys.append(reconciler.split_disk(name)[1:])
+            except ValueError:
+                # Not a pool/image name, the list can't be trusted
+                return
+        self.disk_cache.set_known(keys, generation)
+
+    def _invalidate_disk(self, pool, image, exists=None):
+        if self.disk_cache is not None:
+            self.disk_cache.invalidate((pool, image), exists)
 
+    @_journaled()
     def create_disk(self, pool, image, size=None, extras=None):
         """Add a disk to the gateway."""
         url = ("/api/disk/%(pool)s/%(image)s" %
@@ -340,15 +1179,53 @@ class RBDISCSIClient(object):
 
         if extras:
             args.update(extras)
-        return self.put(url, data=args)
+        try:
+            result = self.put(url, data=args)
+        except Exception:
+            self._invalidate_disk(pool, image)
+            raise
+        self._invalidate_disk(pool, image, exists=True)
+        return result
 
     def find_disk(self, pool, image):
-        """Find the disk in the gateway."""
+        """Find the disk in the gateway.
+
+        With a disk cache, the result is served from it when it is
+        known, and a disk known not to exist raises HTTPNotFound without
+        a request.
+        """
         url = ("/api/disk/%(pool)s/%(image)s" %
                {'pool': pool,
                 'image': image})
-        return self.get(url)
+        if self.disk_cache is None:
+            return self.get(url, hedge=True)
+
+        self._check_fork()
+        key = (pool, image)
+        cached = self.disk_cache.get(key)
+        if cached is cache.MISSING:
+            self.metrics.incr('disk_cache_hits')
+            raise exceptions.HTTPNotFound(
+                {'desc': "rbd image %s/%s not found" % key})
+        if cached is not None:
+            self.metrics.incr('disk_cache_hits')
+            resp, body = cached
+            return self._copy_response(resp), copy.deepcopy(body)
+
+        self.metrics.incr('disk_cache_misses')
+        generation = self.disk_cache.generation
+        try:
+            resp, body = self.get(url, hedge=True)
+        except exceptions.HTTPNotFound:
+            if self.disk_cache.generation == generation:
+                self.disk_cache.put_missing(key)
+            raise
+        if self.disk_cache.generation == generation:
+            self.disk_cache.put(key, (self._copy_response(resp),
+                                      copy.deepcopy(body)))
+        return resp, body
 
+    @_journaled()
     def delete_disk(self, pool, image, preserve_image=True):
         """Delete a disk definition from the gateway.
 
@@ -370,8 +1247,16 @@ class RBDISCSIClient(object):
             'preserve_image': preserve
         }
 
-        return self.delete(url, data=payload)
+        try:
+            result = self.delete(url, data=payload,
+                                 gateway=self._owner_gateway(pool, image))
+        except Exception:
+            self._invalidate_disk(pool, image)
+            raise
+        self._invalidate_disk(pool, image, exists=False)
+        return result
 
+    @_journaled()
     def register_disk(self, target_iqn, volume):
         """Add the volume to the target definition.
 
@@ -381,8 +1266,18 @@ class RBDISCSIClient(object):
         url = ("/api/targetlun/%(target_iqn)s" %
                {'target_iqn': target_iqn})
         args = {'disk': volume}
-        return self.put(url, data=args)
-
+        try:
+            return self.put(url, data=args,
+                            gateway=self._volume_gateway(volume))
+        finally:
+            if self.disk_cache is not None:
+                try:
+                    self._invalidate_disk(
+                        *reconciler.split_disk(volume)[1:])
+                except ValueError:
+                    self.disk_cache.clear()
+
+    @_journaled()
     def unregister_disk(self, target_iqn, volume):
         """Remove the volume from the target definition.
 
@@ -392,8 +1287,10 @@ class RBDISCSIClient(object):
         url = ("/api/targetlun/%(target_iqn)s" %
                {'target_iqn': target_iqn})
         args = {'disk': volume}
-        return self.delete(url, data=args)
+        return self.delete(url, data=args,
+                           gateway=self._volume_gateway(volume))
 
+    @_journaled()
     def export_disk(self, target_iqn, client_iqn, pool, disk):
         """Add a disk to export to a client."""
         url = ("/api/clientlun/%(target_iqn)s/%(client_iqn)s" %
@@ -401,12 +1298,15 @@ class RBDISCSIClient(object):
                 'client_iqn': client_iqn})
         args = {'disk': "%(pool)s/%(disk)s" % {'pool': pool, 'disk': disk},
                 'client_iqn': client_iqn}
-        return self.put(url, data=args)
+        return self.put(url, data=args,
+                        gateway=self._owner_gateway(pool, disk))
 
+    @_journaled()
     def unexport_disk(self, target_iqn, client_iqn, pool, disk):
         """Remove a disk to export to a client."""
         url = ("/api/clientlun/%(target_iqn)s/%(client_iqn)s" %
                {'target_iqn': target_iqn,
                 'client_iqn': client_iqn})
         args = {'disk': "%(pool)s/%(disk)s" % {'pool': pool, 'disk': disk}}
-        return self.delete(url, data=args)
+        return self.delete(url, data=args,
+                           gateway=self._owner_gateway(pool, disk))
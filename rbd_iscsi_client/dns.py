@@ -0,0 +1,195 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Gateway name resolution and connection
+
+.. module: dns
+
+:Description: Resolver caches the addresses of the gateway host names,
+so that opening a connection doesn't wait for a DNS lookup every time.
+connect() tries the addresses of a gateway "happy eyeballs" style: when
+the first one hasn't connected after a short delay the next one is
+tried too, alternating IPv6 and IPv4, and the first connection made is
+used.
+"""
+
+import collections
+import errno
+import ipaddress
+import os
+import selectors
+import socket
+import threading
+import time
+
+# Delay before trying the next address, RFC 8305 recommends 250ms
+DEFAULT_ATTEMPT_DELAY = 0.25
+
+_IN_PROGRESS = (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+def _interleave(infos):
+    """Alternate the address families, the first family first."""
+    by_family = collections.OrderedDict()
+    for info in infos:
+        by_family.setdefault(info[0], collections.deque()).append(info)
+    result = []
+    while by_family:
+        for family in list(by_family):
+            queue = by_family[family]
+            result.append(queue.popleft())
+            if not queue:
+                del by_family[family]
+    return result
+
+
+class Resolver(object):
+    """Cache of the addresses of host names.
+
+    The system resolver doesn't tell the TTL of the records, the
+    addresses are kept ttl seconds.  When a lookup fails, the addresses
+    that expired are used for up to stale_ttl more seconds rather than
+    failing the connection.
+
+    :param ttl: Seconds the addresses of a name are kept
+    :param stale_ttl: Seconds expired addresses are still used when the
+                      name can't be resolved
+    """
+
+    def __init__(self, ttl=60, stale_ttl=300, clock=time.monotonic,
+                 getaddrinfo=socket.getaddrinfo):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._getaddrinfo = getaddrinfo
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def resolve(self, host, port):
+        """Return the getaddrinfo() tuples of a host, families interleaved.
+        """
+        try:
+            ipaddress.ip_address(host)
+        except ValueError:
+            pass
+        else:
+            return self._lookup(host, port)
+
+        key = (host, port)
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        try:
+            infos = self._lookup(host, port)
+        except socket.gaierror:
+            if entry is not None and entry[0] + self.stale_ttl > now:
+                return entry[1]
+            raise
+        with self._lock:
+            self._entries[key] = (now + self.ttl, infos)
+        return infos
+
+    def _lookup(self, host, port):
+        infos = self._getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        if not infos:
+            raise socket.gaierror("getaddrinfo returns an empty list")
+        return _interleave(infos)
+
+    def forget(self, host=None):
+        """Drop the cached addresses of host, or of every host."""
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == host]:
+                    del self._entries[key]
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+
+def _start(info, source_address, socket_options):
+    family, type_, proto, dummy, sockaddr = info
+    sock = socket.socket(family, type_, proto)
+    try:
+        for option in socket_options or ():
+            sock.setsockopt(*option)
+        if source_address:
+            sock.bind(source_address)
+        sock.setblocking(False)
+        err = sock.connect_ex(sockaddr)
+    except OSError:
+        sock.close()
+        raise
+    if err not in _IN_PROGRESS:
+        sock.close()
+        raise OSError(err, "Connection to %s failed" % (sockaddr,))
+    return sock
+
+
+def connect(infos, timeout=None, delay=DEFAULT_ATTEMPT_DELAY,
+            source_address=None, socket_options=None):
+    """Connect to the first of infos that answers, return the socket.
+
+    infos are getaddrinfo() tuples, tried in order.  The next address is
+    tried when the previous attempts failed, or haven't connected after
+    delay seconds, while they go on.  The other attempts are closed once
+    one connects.  socket.timeout is raised when none connected within
+    timeout seconds, the error of the last attempt when they all failed.
+    """
+    infos = list(infos)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    pending = set()
+    error = None
+    next_attempt = 0
+    try:
+        while True:
+            now = time.monotonic()
+            if infos and (not pending or now >= next_attempt):
+                try:
+                    sock = _start(infos.pop(0), source_address,
+                                  socket_options)
+                except OSError as ex:
+                    error = ex
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE)
+                pending.add(sock)
+                next_attempt = now + delay
+                continue
+            if not pending:
+                raise error or OSError("No address to connect to")
+
+            wait = next_attempt - now if infos else None
+            if deadline is not None:
+                if now >= deadline:
+                    raise socket.timeout("timed out")
+                wait = deadline - now if wait is None else min(
+                    wait, deadline - now)
+            for key, dummy in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                pending.discard(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if not err:
+                    sock.settimeout(timeout)
+                    return sock
+                sock.close()
+                error = OSError(err, os.strerror(err))
+                # Don't wait for the delay to try the next address
+                next_attempt = now
+    finally:
+        for sock in pending:
+            sock.close()
+        selector.close()
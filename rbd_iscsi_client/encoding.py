@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Request body encoding
+
+.. module: encoding
+
+:Description: Encodes the request payloads of the client.  Every
+endpoint sends the same set of form fields on every call, so the
+quoted field names are computed once per set of fields and reused.
+"""
+
+import json
+import threading
+from urllib import parse
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+JSON_CONTENT_TYPE = 'application/json'
+
+_SCALARS = (str, int, float)
+
+
+class FormTemplate(object):
+    """Form encoder for a fixed, ordered set of field names.
+
+    :param keys: The field names, in the order they are encoded
+    """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self._prefixes = tuple('%s=' % parse.quote_plus(str(key))
+                               for key in self.keys)
+
+    def encode(self, data):
+        return '&'.join([prefix + parse.quote_plus(str(data[key]))
+                         for prefix, key in zip(self._prefixes, self.keys)])
+
+
+class BodyEncoder(object):
+    """Encode dict payloads to a request body.
+
+    The FormTemplate for each set of field names is kept and reused, so
+    the per call work is only quoting the values.
+
+    :param use_json: Send JSON bodies instead of form encoded ones.
+                     Only use this with gateways that accept JSON.
+    """
+
+    def __init__(self, use_json=False):
+        self.use_json = use_json
+        self.content_type = (JSON_CONTENT_TYPE if use_json
+                             else FORM_CONTENT_TYPE)
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def template(self, keys):
+        keys = tuple(keys)
+        template = self._templates.get(keys)
+        if template is None:
+            with self._lock:
+                template = self._templates.setdefault(keys,
+                                                      FormTemplate(keys))
+        return template
+
+    def encode(self, data):
+        """Return the encoded body of data.
+
+        Returns None if data holds values that can't be encoded as
+        simple fields (lists, dicts), those are left to the transport
+        so they are encoded exactly like before.
+        """
+        if self.use_json:
+            return json.dumps(data, separators=(',', ':'))
+
+        for value in data.values():
+            if not isinstance(value, _SCALARS):
+                return None
+        return self.template(data.keys()).encode(data)
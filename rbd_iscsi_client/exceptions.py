@@ -119,6 +119,30 @@ class SSLCertFailed(ClientException):
     message = "SSL Certificate Verification Failed"
 
 
+# Gateway selection errors
+
+
+class GatewayUnavailable(ClientException):
+    """None of the gateways of the client is healthy."""
+    http_status = ""
+    message = "No healthy gateway available"
+
+
+# Cancellation errors
+
+
+class Cancelled(ClientException):
+    """The call was cancelled with its cancel.CancelToken."""
+    http_status = ""
+    message = "The call was cancelled"
+
+
+class DeadlineExceeded(Cancelled):
+    """The deadline of the call passed before it could complete."""
+    http_status = ""
+    message = "The deadline of the call was exceeded"
+
+
 #  Python Requests Errors
 
 
@@ -0,0 +1,376 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+In process fake of rbd-target-api
+
+.. module: fake
+
+:Description: FakeGateway keeps the rbd-target-api state (targets, disks,
+clients and LUN mappings) in memory, and FakeTransport serves the
+client's requests from it without opening any sockets.  It is meant for
+tests and for simulations of drivers built on RBDISCSIClient.
+
+Usage::
+
+    gateway = fake.FakeGateway()
+    cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                               transport=fake.FakeTransport(gateway))
+"""
+
+import copy
+import hashlib
+import json
+import re
+import threading
+from urllib import parse
+
+from rbd_iscsi_client import transport
+
+
+class FakeGatewayError(Exception):
+    """Turned into an HTTP error response by FakeGateway.handle()."""
+
+    def __init__(self, status, message):
+        super(FakeGatewayError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _not_found(message):
+    return FakeGatewayError(404, message)
+
+
+def _bad_request(message):
+    return FakeGatewayError(400, message)
+
+
+class FakeGateway(object):
+    """In memory state of a cluster of rbd-target-api gateways.
+
+    All gateways of a cluster share one config, so one FakeGateway
+    serves every gateway url the client is pointed at.
+
+    :param gateways: Names of the gateway hosts, disks are assigned an
+                     owner from these round robin
+    :param credentials: Optional (username, password) the requests must
+                        authenticate with
+    """
+
+    def __init__(self, gateways=('gateway1', 'gateway2'), credentials=None):
+        self.gateways = list(gateways)
+        self.credentials = tuple(credentials) if credentials else None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.config = {
+            'created': '',
+            'discovery_auth': {'username': '', 'password': '',
+                               'mutual_username': '',
+                               'mutual_password': ''},
+            'disks': {},
+            'epoch': 0,
+            'gateways': dict((name, {'portal_ip_addresses': [],
+                                     'active_luns': 0})
+                             for name in self.gateways),
+            'targets': {},
+            'version': 11,
+        }
+        # The iscsi-gateway.cfg of the gateways, checkconf returns its hash
+        self.gateway_cfg = '[config]\ncluster_name = ceph\n'
+        self._routes = [
+            ('GET', r'/api$', self._get_api),
+            ('GET', r'/api/config$', self._get_config),
+            ('GET', r'/api/sysinfo/(?P<type>[^/]+)$', self._get_sys_info),
+            ('GET', r'/api/gatewayinfo$', self._get_gatewayinfo),
+            ('GET', r'/api/targets$', self._get_targets),
+            ('GET', r'/api/targetinfo/(?P<target_iqn>[^/]+)$',
+             self._get_target_info),
+            ('PUT', r'/api/target/(?P<target_iqn>[^/]+)$',
+             self._create_target),
+            ('DELETE', r'/api/target/(?P<target_iqn>[^/]+)$',
+             self._delete_target),
+            ('GET', r'/api/clients/(?P<target_iqn>[^/]+)$',
+             self._get_clients),
+            ('GET', r'/api/clientinfo/(?P<target_iqn>[^/]+)/'
+                    r'(?P<client_iqn>[^/]+)$', self._get_client_info),
+            ('PUT', r'/api/client/(?P<target_iqn>[^/]+)/'
+                    r'(?P<client_iqn>[^/]+)$', self._create_client),
+            ('DELETE', r'/api/client/(?P<target_iqn>[^/]+)/'
+                       r'(?P<client_iqn>[^/]+)$', self._delete_client),
+            ('PUT', r'/api/clientauth/(?P<target_iqn>[^/]+)/'
+                    r'(?P<client_iqn>[^/]+)$', self._set_client_auth),
+            ('GET', r'/api/disks$', self._get_disks),
+            ('GET', r'/api/disk/(?P<pool>[^/]+)/(?P<image>[^/]+)$',
+             self._find_disk),
+            ('PUT', r'/api/disk/(?P<pool>[^/]+)/(?P<image>[^/]+)$',
+             self._create_disk),
+            ('DELETE', r'/api/disk/(?P<pool>[^/]+)/(?P<image>[^/]+)$',
+             self._delete_disk),
+            ('PUT', r'/api/targetlun/(?P<target_iqn>[^/]+)$',
+             self._register_disk),
+            ('DELETE', r'/api/targetlun/(?P<target_iqn>[^/]+)$',
+             self._unregister_disk),
+            ('PUT', r'/api/clientlun/(?P<target_iqn>[^/]+)/'
+                    r'(?P<client_iqn>[^/]+)$', self._export_disk),
+            ('DELETE', r'/api/clientlun/(?P<target_iqn>[^/]+)/'
+                       r'(?P<client_iqn>[^/]+)$', self._unexport_disk),
+        ]
+        self._routes = [(method, re.compile(pattern), handler)
+                        for method, pattern, handler in self._routes]
+
+    def handle(self, method, path, data=None, auth=None):
+        """Serve one request.
+
+        Returns a (status, body) tuple where body is JSON serializable.
+        """
+        if self.credentials and auth != self.credentials:
+            return 401, {'message': 'Unauthorized'}
+
+        with self.lock:
+            self.requests += 1
+            for route_method, pattern, handler in self._routes:
+                match = pattern.match(path)
+                if match and route_method == method:
+                    kwargs = dict((k, parse.unquote(v)) for k, v in
+                                  match.groupdict().items())
+                    try:
+                        return handler(data or {}, **kwargs)
+                    except FakeGatewayError as err:
+                        return err.status, {'message': err.message}
+        return 404, {'message': 'Unknown endpoint %s %s' % (method, path)}
+
+    def _changed(self):
+        self.config['epoch'] += 1
+
+    def _target(self, target_iqn):
+        if target_iqn not in self.config['targets']:
+            raise _not_found("target %s not found" % target_iqn)
+        return self.config['targets'][target_iqn]
+
+    def _client(self, target_iqn, client_iqn):
+        target = self._target(target_iqn)
+        if client_iqn not in target['clients']:
+            raise _not_found("client %s not found" % client_iqn)
+        return target['clients'][client_iqn]
+
+    def _disk_id(self, data):
+        disk = data.get('disk')
+        if not disk or disk not in self.config['disks']:
+            raise _bad_request("disk %s is not defined" % disk)
+        return disk
+
+    def _get_api(self, data):
+        return 200, {'api': sorted(set(pattern.pattern for _, pattern, _
+                                       in self._routes))}
+
+    def _get_config(self, data):
+        return 200, copy.deepcopy(self.config)
+
+    def _get_sys_info(self, data, type):
+        if type == 'ip_address':
+            return 200, {'data': ['127.0.0.1']}
+        if type == 'checkconf':
+            digest = hashlib.md5(self.gateway_cfg.encode('utf-8'))
+            return 200, {'data': digest.hexdigest()}
+        if type == 'checkversions':
+            return 200, {'data': True}
+        raise _not_found("unknown sysinfo type %s" % type)
+
+    def _get_gatewayinfo(self, data):
+        return 200, {'num_sessions': 0}
+
+    def _get_targets(self, data):
+        return 200, {'targets': sorted(self.config['targets'])}
+
+    def _get_target_info(self, data, target_iqn):
+        self._target(target_iqn)
+        return 200, {'num_sessions': 0}
+
+    def _create_target(self, data, target_iqn):
+        if target_iqn in self.config['targets']:
+            raise _bad_request("target %s already exists" % target_iqn)
+        self.config['targets'][target_iqn] = {
+            'acl_enabled': True,
+            'auth': {'username': '', 'password': '',
+                     'mutual_username': '', 'mutual_password': ''},
+            'clients': {},
+            'controls': {},
+            'disks': {},
+            'groups': {},
+            'ip_list': [],
+            'portals': {},
+        }
+        self._changed()
+        return 200, {'message': 'Target defined successfully'}
+
+    def _delete_target(self, data, target_iqn):
+        self._target(target_iqn)
+        del self.config['targets'][target_iqn]
+        self._changed()
+        return 200, {'message': 'Target deleted successfully'}
+
+    def _get_clients(self, data, target_iqn):
+        return 200, {'clients': sorted(self._target(target_iqn)['clients'])}
+
+    def _get_client_info(self, data, target_iqn, client_iqn):
+        self._client(target_iqn, client_iqn)
+        return 200, {'alias': '', 'ip_address': [], 'state': {}}
+
+    def _create_client(self, data, target_iqn, client_iqn):
+        target = self._target(target_iqn)
+        if client_iqn in target['clients']:
+            raise _bad_request("client %s already exists" % client_iqn)
+        target['clients'][client_iqn] = {
+            'auth': {'username': '', 'password': '',
+                     'mutual_username': '', 'mutual_password': ''},
+            'group_name': '',
+            'luns': {},
+        }
+        self._changed()
+        return 200, {'message': 'client created'}
+
+    def _delete_client(self, data, target_iqn, client_iqn):
+        self._client(target_iqn, client_iqn)
+        del self._target(target_iqn)['clients'][client_iqn]
+        self._changed()
+        return 200, {'message': 'client deleted'}
+
+    def _set_client_auth(self, data, target_iqn, client_iqn):
+        client = self._client(target_iqn, client_iqn)
+        client['auth']['username'] = data.get('username', '')
+        client['auth']['password'] = data.get('password', '')
+        self._changed()
+        return 200, {'message': 'client auth updated'}
+
+    def _get_disks(self, data):
+        return 200, {'disks': sorted(self.config['disks'])}
+
+    def _find_disk(self, data, pool, image):
+        disk_id = '%s/%s' % (pool, image)
+        if disk_id not in self.config['disks']:
+            raise _not_found("rbd image %s not found" % disk_id)
+        disk = copy.deepcopy(self.config['disks'][disk_id])
+        disk['status'] = {'state': 'Online'}
+        return 200, disk
+
+    def _create_disk(self, data, pool, image):
+        disk_id = '%s/%s' % (pool, image)
+        if disk_id in self.config['disks']:
+            raise _bad_request("disk %s already exists" % disk_id)
+        owner = self.gateways[len(self.config['disks']) %
+                              len(self.gateways)]
+        self.config['disks'][disk_id] = {
+            'allocating_host': owner,
+            'backstore': 'user:rbd',
+            'backstore_object_name': '%s.%s' % (pool, image),
+            'controls': {},
+            'created': '',
+            'image': image,
+            'owner': owner,
+            'pool': pool,
+            'pool_id': 0,
+            'size': data.get('size', '1G'),
+            'wwn': '',
+        }
+        self._changed()
+        return 200, {'message': 'disk %s created' % disk_id}
+
+    def _delete_disk(self, data, pool, image):
+        disk_id = '%s/%s' % (pool, image)
+        if disk_id not in self.config['disks']:
+            raise _not_found("rbd image %s not found" % disk_id)
+        for target_iqn, target in self.config['targets'].items():
+            if disk_id in target['disks']:
+                raise _bad_request("disk %s is in use by %s" %
+                                   (disk_id, target_iqn))
+        del self.config['disks'][disk_id]
+        self._changed()
+        return 200, {'message': 'disk %s deleted' % disk_id}
+
+    def _register_disk(self, data, target_iqn):
+        target = self._target(target_iqn)
+        disk_id = self._disk_id(data)
+        if disk_id in target['disks']:
+            raise _bad_request("disk %s is already registered" % disk_id)
+        used = set(d['lun_id'] for d in target['disks'].values())
+        lun_id = 0
+        while lun_id in used:
+            lun_id += 1
+        target['disks'][disk_id] = {'lun_id': lun_id}
+        self._changed()
+        return 200, {'message': 'disk %s added to %s' % (disk_id,
+                                                         target_iqn)}
+
+    def _unregister_disk(self, data, target_iqn):
+        target = self._target(target_iqn)
+        disk_id = data.get('disk')
+        if disk_id not in target['disks']:
+            raise _bad_request("disk %s is not registered" % disk_id)
+        for client_iqn, client in target['clients'].items():
+            if disk_id in client['luns']:
+                raise _bad_request("disk %s is mapped to %s" %
+                                   (disk_id, client_iqn))
+        del target['disks'][disk_id]
+        self._changed()
+        return 200, {'message': 'disk %s removed from %s' % (disk_id,
+                                                             target_iqn)}
+
+    def _export_disk(self, data, target_iqn, client_iqn):
+        target = self._target(target_iqn)
+        client = self._client(target_iqn, client_iqn)
+        disk_id = data.get('disk')
+        if disk_id not in target['disks']:
+            raise _bad_request("disk %s is not registered to %s" %
+                               (disk_id, target_iqn))
+        client['luns'][disk_id] = {
+            'lun_id': target['disks'][disk_id]['lun_id']}
+        self._changed()
+        return 200, {'message': 'disk %s exported to %s' % (disk_id,
+                                                            client_iqn)}
+
+    def _unexport_disk(self, data, target_iqn, client_iqn):
+        client = self._client(target_iqn, client_iqn)
+        disk_id = data.get('disk')
+        if disk_id not in client['luns']:
+            raise _bad_request("disk %s is not exported to %s" %
+                               (disk_id, client_iqn))
+        del client['luns'][disk_id]
+        self._changed()
+        return 200, {'message': 'disk %s unexported from %s' % (disk_id,
+                                                                client_iqn)}
+
+
+class FakeTransport(transport.Transport):
+    """Transport serving requests from a FakeGateway.
+
+    :param gateway: The FakeGateway to use, a new one by default
+    """
+
+    def __init__(self, gateway=None):
+        super(FakeTransport, self).__init__()
+        self.gateway = gateway if gateway is not None else FakeGateway()
+
+    def request(self, method, url, data=None, headers=None, auth=None,
+                verify=True, timeout=None):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        if isinstance(data, str):
+            content_type = (headers or {}).get('Content-Type', '')
+            if content_type.startswith('application/json'):
+                data = json.loads(data)
+            else:
+                data = dict(parse.parse_qsl(data))
+        status, body = self.gateway.handle(
+            method, parse.urlsplit(url).path, data,
+            transport.basic_auth_credentials(auth))
+        return transport.Response(status,
+                                  {'Content-Type': 'application/json'},
+                                  json.dumps(body), url)
@@ -0,0 +1,140 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Green thread support
+
+.. module: green
+
+:Description: Cinder runs its volume drivers under eventlet, other
+services use gevent.  A Runtime gives the client the sleep to use
+between retries and a way to run CPU bound work, like decoding a large
+JSON body, in a native thread so the other green threads of the process
+keep running.  Neither eventlet nor gevent is imported unless the
+process already uses it or it is asked for.
+"""
+
+import importlib
+import logging
+import sys
+import time
+
+LOG = logging.getLogger(__name__)
+
+EVENTLET = 'eventlet'
+GEVENT = 'gevent'
+
+# JSON bodies larger than this many characters are decoded in a native
+# thread by the green runtimes.
+OFFLOAD_THRESHOLD = 64 * 1024
+
+
+def detect():
+    """Return the green library that monkey patched socket, if any.
+
+    Only looks at the modules already imported.
+    """
+    patcher = sys.modules.get('eventlet.patcher')
+    if patcher is not None and patcher.is_monkey_patched('socket'):
+        return EVENTLET
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        return GEVENT
+    return None
+
+
+class Runtime(object):
+    """The native threads runtime, and the base of the green ones."""
+
+    name = None
+    offload_threshold = None
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def offload(self, func, *args):
+        """Run func(*args) without blocking the other threads."""
+        return func(*args)
+
+    def should_offload(self, size):
+        return (self.offload_threshold is not None and
+                size > self.offload_threshold)
+
+
+class EventletRuntime(Runtime):
+    """Cooperative sleeps and tpool offloading for eventlet."""
+
+    name = EVENTLET
+
+    def __init__(self, offload_threshold=OFFLOAD_THRESHOLD):
+        self._eventlet = importlib.import_module('eventlet')
+        self._tpool = importlib.import_module('eventlet.tpool')
+        self.offload_threshold = offload_threshold
+        _check_patched(self.name,
+                       importlib.import_module('eventlet.patcher')
+                       .is_monkey_patched)
+
+    def sleep(self, seconds):
+        self._eventlet.sleep(seconds)
+
+    def offload(self, func, *args):
+        return self._tpool.execute(func, *args)
+
+
+class GeventRuntime(Runtime):
+    """Cooperative sleeps and hub threadpool offloading for gevent."""
+
+    name = GEVENT
+
+    def __init__(self, offload_threshold=OFFLOAD_THRESHOLD):
+        self._gevent = importlib.import_module('gevent')
+        self.offload_threshold = offload_threshold
+        _check_patched(self.name,
+                       importlib.import_module('gevent.monkey')
+                       .is_module_patched)
+
+    def sleep(self, seconds):
+        self._gevent.sleep(seconds)
+
+    def offload(self, func, *args):
+        return self._gevent.get_hub().threadpool.apply(func, args)
+
+
+def _check_patched(name, is_patched):
+    # The connection pools of requests and urllib3 are only green safe
+    # when socket and threading are, which a library can't arrange.
+    unpatched = [module for module in ('socket', 'thread')
+                 if not is_patched(module)]
+    if unpatched:
+        LOG.warning("%(name)s has not monkey patched %(modules)s, requests "
+                    "to the gateways will block the other green threads",
+                    {'name': name, 'modules': ', '.join(unpatched)})
+
+
+_RUNTIMES = {
+    EVENTLET: EventletRuntime,
+    GEVENT: GeventRuntime,
+}
+
+
+def get_runtime(green=None, **kwargs):
+    """Return the Runtime to use.
+
+    :param green: None to detect the green library in use, False for
+                  native threads, or 'eventlet' or 'gevent'
+    """
+    if green is None:
+        green = detect()
+    if not green:
+        return Runtime()
+    if green not in _RUNTIMES:
+        raise ValueError("Unknown green library %r" % green)
+    return _RUNTIMES[green](**kwargs)
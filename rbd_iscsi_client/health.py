@@ -0,0 +1,219 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Gateway health monitoring
+
+.. module: health
+
+:Description: HealthMonitor probes every gateway of a client in a
+background thread with /api/gatewayinfo and the checkconf/checkversions
+sysinfo calls, and keeps a table of their health and score.  Reading the
+table never blocks on the network, so the client can consult it on
+every request to route around unhealthy gateways.
+
+checkconf returns the hash of the config file of a gateway, the
+gateways whose hash differs from the one most of them have are
+penalised, their config drifted.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+MAX_SCORE = 100
+
+
+class GatewayHealth(collections.namedtuple(
+        'GatewayHealth', ['url', 'healthy', 'score', 'latency',
+                          'sessions', 'checked_at', 'error'])):
+    """The result of the last probe of a gateway.
+
+    :param url: The gateway url
+    :param healthy: Should the gateway be given work
+    :param score: 0 to 100, higher is better
+    :param latency: Moving average of the probe latency, in seconds
+    :param sessions: The number of active sessions on the gateway
+    :param checked_at: time.time() of the probe
+    :param error: Why the gateway isn't healthy, if it isn't
+    """
+    __slots__ = ()
+
+
+class HealthMonitor(object):
+    """Probe the gateways of a client and keep their health.
+
+    :param client: The RBDISCSIClient whose api_urls are probed
+    :param interval: Seconds between two rounds of probes
+    :param slow_latency: Probe latency, in seconds, above which the score
+                         of a gateway starts to drop
+    :param min_score: Gateways scoring below this are not healthy
+    :param alpha: Weight of a new latency sample in the moving average
+    """
+
+    def __init__(self, client, interval=30, slow_latency=1.0, min_score=50,
+                 alpha=0.3):
+        self.client = client
+        self.interval = interval
+        self.slow_latency = slow_latency
+        self.min_score = min_score
+        self.alpha = alpha
+        # Replaced as a whole by each probe, so readers never need a lock
+        self._table = {}
+        # url to the (checkconf hash, versions ok, probe error) of the
+        # gateways that answered their last probe
+        self._checks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def status(self, url):
+        """Return the GatewayHealth of url, None if not probed yet."""
+        return self._table.get(url)
+
+    def table(self):
+        """Return a dict of url to GatewayHealth of every gateway."""
+        return dict(self._table)
+
+    def is_usable(self, url):
+        """Can work be sent to url?
+
+        Gateways that haven't been probed yet are given the benefit of
+        the doubt.
+        """
+        health = self._table.get(url)
+        return health is None or health.healthy
+
+    def _score(self, latency, conf_ok, versions_ok):
+        score = MAX_SCORE
+        if not conf_ok:
+            score -= 60
+        if not versions_ok:
+            score -= 20
+        if latency > self.slow_latency:
+            score -= min(40, int(20 * latency / self.slow_latency))
+        return max(0, score)
+
+    def probe(self, url):
+        """Probe one gateway and update its entry in the table."""
+        previous = self._table.get(url)
+        start = time.monotonic()
+        error = None
+        sessions = None
+        conf = versions_ok = None
+        try:
+            # A single attempt, a gateway that needs retries is not
+            # healthy.
+            resp, body = self.client.get('/api/gatewayinfo', gateway=url,
+                                         tries=1)
+            sessions = (body or {}).get('num_sessions')
+            latency = time.monotonic() - start
+            resp, body = self.client.get('/api/sysinfo/checkconf',
+                                         gateway=url, tries=1)
+            conf = (body or {}).get('data')
+            resp, body = self.client.get('/api/sysinfo/checkversions',
+                                         gateway=url, tries=1)
+            versions_ok = bool((body or {}).get('data'))
+        except Exception as ex:
+            error = str(ex) or type(ex).__name__
+
+        table = dict(self._table)
+        checks = dict(self._checks)
+        if error is not None and sessions is None:
+            table[url] = GatewayHealth(
+                url, False, 0, previous.latency if previous else None,
+                None, time.time(), error)
+            checks.pop(url, None)
+        else:
+            if previous is not None and previous.latency is not None:
+                latency = (self.alpha * latency +
+                           (1 - self.alpha) * previous.latency)
+            table[url] = GatewayHealth(url, False, 0, latency, sessions,
+                                       time.time(), error)
+            checks[url] = (conf, versions_ok, error)
+        # The score of the other gateways changes with the majority hash
+        self._rescore(table, checks)
+        self._checks = checks
+        self._table = table
+        for name, entry in table.items():
+            self.client.metrics.set('health_score', entry.score,
+                                    gateway=name)
+        return table[url]
+
+    @staticmethod
+    def _majority_hash(checks):
+        """The checkconf hash most gateways have, None if there's none."""
+        counts = collections.Counter(
+            conf for conf, versions_ok, error in checks.values()
+            if isinstance(conf, str) and conf)
+        common = counts.most_common(2)
+        if not common or (len(common) > 1 and common[0][1] == common[1][1]):
+            return None
+        return common[0][0]
+
+    def _rescore(self, table, checks):
+        majority = self._majority_hash(checks)
+        for url, (conf, versions_ok, error) in checks.items():
+            drifted = (majority is not None and isinstance(conf, str) and
+                       conf != majority)
+            conf_ok = bool(conf) and not drifted
+            entry = table[url]
+            score = self._score(entry.latency, conf_ok, versions_ok)
+            if error is None and not conf:
+                error = "config check failed"
+            elif error is None and drifted:
+                error = "config differs from the other gateways"
+            elif error is None and not versions_ok:
+                error = "version check failed"
+            table[url] = entry._replace(healthy=score >= self.min_score,
+                                        score=score, error=error)
+
+    def probe_all(self):
+        """Probe every gateway of the client once."""
+        for url in list(self.client.api_urls):
+            try:
+                self.probe(url)
+            except Exception:
+                LOG.exception("Failed to probe gateway %s", url)
+        return self.table()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.interval)
+
+    def after_fork(self):
+        """Restart the probing thread, which doesn't survive a fork."""
+        running = self._thread is not None and not self._stop.is_set()
+        self._stop = threading.Event()
+        self._thread = None
+        if running:
+            self.start()
+
+    def start(self):
+        """Start probing in a background thread."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='rbd-iscsi-health')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background probing."""
+        self._stop.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self.interval)
+        self._thread = None
@@ -0,0 +1,187 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Hedged requests
+
+.. module: hedge
+
+:Description: A read sent to one gateway that hasn't answered after the
+95th percentile of the recent latencies is sent again to a second
+gateway, and whichever answers first wins.  The hedges are paid for by
+a budget that grows by a small fraction of a token for every request, so
+they never add more than that fraction of extra load.
+"""
+
+import collections
+import threading
+import time
+from concurrent import futures
+
+from rbd_iscsi_client import stats
+
+
+class Hedger(object):
+    """When to hedge a request, and the threads running them.
+
+    :param percentile: Latency percentile after which a request is hedged
+    :param min_delay: The hedge delay never goes below this, in seconds
+    :param max_delay: The hedge delay never goes above this, and it is
+                      used until min_samples latencies were seen
+    :param budget: Hedges allowed per request, 0.05 for at most 5% of
+                   extra requests
+    :param burst: Hedges that can be saved up while they aren't needed
+    :param window: Number of recent latencies the delay is computed from
+    :param min_samples: Latencies needed before the percentile is used
+    :param max_workers: Threads running the hedged requests
+    """
+
+    def __init__(self, percentile=95, min_delay=0.005, max_delay=1.0,
+                 budget=0.05, burst=5, window=500, min_samples=20,
+                 max_workers=16):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.burst = burst
+        self.min_samples = min_samples
+        self.max_workers = max_workers
+        self._latencies = collections.deque(maxlen=window)
+        self._delay = max_delay
+        self._since_update = 0
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._busy = 0
+
+    def record(self, latency):
+        """Add the latency of a request that completed."""
+        with self._lock:
+            self._latencies.append(latency)
+            self._since_update += 1
+            # Sorting the window on every request would be wasteful, the
+            # delay is recomputed every few samples.
+            if (len(self._latencies) >= self.min_samples and
+                    self._since_update >= self.min_samples // 2):
+                self._since_update = 0
+                value = stats.percentile(sorted(self._latencies),
+                                         self.percentile)
+                self._delay = min(self.max_delay,
+                                  max(self.min_delay, value))
+
+    @property
+    def delay(self):
+        """Seconds to wait for the first gateway before hedging."""
+        return self._delay
+
+    def _earn(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.budget)
+
+    def try_hedge(self):
+        """Take a hedge from the budget, False if it is spent."""
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    def _submit(self, func, *args):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = futures.ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='rbd-iscsi-hedge')
+
+        def _run():
+            with self._lock:
+                self._busy += 1
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+
+        return self._executor.submit(_run)
+
+    def _saturated(self):
+        """Are all the threads busy?  A hedge would only queue."""
+        return self._busy >= self.max_workers
+
+    def after_fork(self):
+        """Forget the threads and lock of the parent process."""
+        self._lock = threading.Lock()
+        self._executor = None
+        self._busy = 0
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def run(self, call, primary, secondary, hedge_call=None):
+        """Return call(primary), hedged with a call to secondary.
+
+        call(gateway) sends the request to a gateway.  hedge_call, which
+        defaults to call, sends the hedge.  The first successful result
+        is returned.  The losing request can't be interrupted once
+        sent, its result is ignored.  If both fail, the error of the
+        primary request is raised.
+
+        The latency of the primary request, the hedge delay included,
+        is measured from the moment a thread starts running it, so the
+        time spent queued for a thread, a local bottleneck, neither
+        triggers hedges nor inflates the recorded latencies.  No hedge
+        is sent while all the threads are busy.
+
+        Returns a (result, gateway) tuple.
+        """
+        self._earn()
+        started = threading.Event()
+        start = []
+
+        def _primary(gateway):
+            start.append(time.monotonic())
+            started.set()
+            return call(gateway)
+
+        def _record(future):
+            if start and future.exception() is None:
+                self.record(time.monotonic() - start[0])
+
+        first = self._submit(_primary, primary)
+        first.add_done_callback(_record)
+        while not started.wait(self.delay) and not first.done():
+            pass
+        try:
+            elapsed = time.monotonic() - start[0] if start else 0
+            return (first.result(timeout=max(0, self.delay - elapsed)),
+                    primary)
+        except futures.TimeoutError:
+            pass
+        if self._saturated() or not self.try_hedge():
+            return first.result(), primary
+
+        second = self._submit(hedge_call or call, secondary)
+        pending = {first: primary, second: secondary}
+        while pending:
+            done, _ = futures.wait(pending,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                gateway = pending.pop(future)
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result(), gateway
+        # Both failed
+        return first.result(), primary
@@ -0,0 +1,248 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Disk inventory export
+
+.. module: inventory
+
+:Description: Flattens the disks of /api/config into columns, one row
+per disk.  The numeric columns are arrays of machine integers and the
+repetitive string columns (pool, owner, backstore) are dictionary
+encoded, so an inventory of many thousands of disks holds no per-row
+dicts.  It is written to CSV with the standard library, and to Arrow
+and Parquet when pyarrow is installed
+(``pip install rbd-iscsi-client[arrow]``).
+"""
+
+import array
+import csv
+
+from rbd_iscsi_client import lazy
+
+pyarrow = lazy.LazyModule('pyarrow', optional=True)
+parquet = lazy.LazyModule('pyarrow.parquet', optional=True)
+
+# The columns of an inventory, in order
+COLUMNS = ('pool', 'image', 'size', 'owner', 'backstore', 'targets',
+           'clients')
+
+# Columns holding integers
+NUMERIC = ('size', 'targets', 'clients')
+
+# Dictionary encoded columns
+ENCODED = ('pool', 'owner', 'backstore')
+
+_UNITS = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+          'T': 1024 ** 4, 'P': 1024 ** 5}
+
+
+def size_bytes(value):
+    """Return a disk size like '10G' or 1024 in bytes, 0 if unknown."""
+    if isinstance(value, int):
+        return value
+    value = str(value or '').strip().upper()
+    if value.endswith('IB'):
+        value = value[:-2]
+    number = value.rstrip('BKMGTP')
+    unit = value[len(number):]
+    try:
+        return int(float(number) * _UNITS[unit])
+    except (KeyError, ValueError):
+        return 0
+
+
+class _Encoded(object):
+    """A dictionary encoded column: codes into a list of values."""
+
+    def __init__(self):
+        self.values = []
+        self.codes = array.array('q')
+        self._index = {}
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None:
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __iter__(self):
+        values = self.values
+        return (values[code] for code in self.codes)
+
+    def __len__(self):
+        return len(self.codes)
+
+
+def _require_pyarrow():
+    if not lazy.is_available(pyarrow):
+        raise ImportError("pyarrow is needed for Arrow and Parquet, "
+                          "pip install rbd-iscsi-client[arrow]")
+
+
+class Inventory(object):
+    """The disks of the gateways, by column.
+
+    columns maps each name of COLUMNS to its values.  Use column() to
+    get the plain values of a dictionary encoded column.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        for name in COLUMNS:
+            if name in NUMERIC:
+                self.columns[name] = array.array('q')
+            elif name in ENCODED:
+                self.columns[name] = _Encoded()
+            else:
+                self.columns[name] = []
+
+    @classmethod
+    def from_config(cls, config, disks=None):
+        """Build the inventory from a /api/config document.
+
+        disks, the names listed by get_disks(), adds the disks missing
+        from config, with empty details.
+        """
+        config = config or {}
+        # Count the registrations and mappings of every disk in a single
+        # pass over the targets.
+        targets = {}
+        clients = {}
+        for target in (config.get('targets') or {}).values():
+            for name in target.get('disks') or ():
+                targets[name] = targets.get(name, 0) + 1
+            for client in (target.get('clients') or {}).values():
+                for name in client.get('luns') or ():
+                    clients[name] = clients.get(name, 0) + 1
+
+        details = config.get('disks') or {}
+        names = list(details)
+        if disks:
+            names.extend(name for name in disks if name not in details)
+
+        inventory = cls()
+        columns = inventory.columns
+        for name in names:
+            disk = details.get(name) or {}
+            pool, sep, image = name.partition('/')
+            columns['pool'].append(disk.get('pool', pool))
+            columns['image'].append(disk.get('image', image))
+            columns['size'].append(size_bytes(disk.get('size')))
+            columns['owner'].append(disk.get('owner', ''))
+            columns['backstore'].append(disk.get('backstore', ''))
+            columns['targets'].append(targets.get(name, 0))
+            columns['clients'].append(clients.get(name, 0))
+        return inventory
+
+    def __len__(self):
+        return len(self.columns['image'])
+
+    def column(self, name):
+        """Return the values of a column as a list."""
+        return list(self.columns[name])
+
+    def rows(self):
+        """Iterate over the rows, as tuples in the order of COLUMNS."""
+        return zip(*(iter(self.columns[name]) for name in COLUMNS))
+
+    def write_csv(self, fileobj, header=True):
+        """Write the inventory to a text file object as CSV."""
+        writer = csv.writer(fileobj)
+        if header:
+            writer.writerow(COLUMNS)
+        writer.writerows(self.rows())
+
+    def pool_totals(self):
+        """Aggregate the disks by pool.
+
+        Returns the columns 'pool', 'disks', 'size' (the bytes
+        provisioned), 'luns' (the target registrations) and 'mappings'
+        (the client mappings), one row per pool.  The aggregation is
+        done by Arrow when pyarrow is installed.
+        """
+        if (len(self) and lazy.is_available(pyarrow) and
+                hasattr(pyarrow.Table, 'group_by')):
+            totals = self._arrow_pool_totals()
+        else:
+            totals = self._pool_totals()
+        totals['pool'] = list(self.columns['pool'].values)
+        return totals
+
+    def _arrow_pool_totals(self):
+        # The pool codes are dense, 0 to the number of pools - 1, so the
+        # groups sorted by code are the rows of the result.
+        table = pyarrow.table({
+            'code': pyarrow.array(self.columns['pool'].codes,
+                                  type=pyarrow.int64()),
+            'size': pyarrow.array(self.columns['size'],
+                                  type=pyarrow.int64()),
+            'luns': pyarrow.array(self.columns['targets'],
+                                  type=pyarrow.int64()),
+            'mappings': pyarrow.array(self.columns['clients'],
+                                      type=pyarrow.int64()),
+        })
+        grouped = table.group_by('code').aggregate(
+            [('code', 'count'), ('size', 'sum'), ('luns', 'sum'),
+             ('mappings', 'sum')]).sort_by('code')
+        return {
+            'disks': array.array('q', grouped['code_count'].to_pylist()),
+            'size': array.array('q', grouped['size_sum'].to_pylist()),
+            'luns': array.array('q', grouped['luns_sum'].to_pylist()),
+            'mappings': array.array('q',
+                                    grouped['mappings_sum'].to_pylist()),
+        }
+
+    def _pool_totals(self):
+        count = len(self.columns['pool'].values)
+        totals = dict((name, array.array('q', [0]) * count)
+                      for name in ('disks', 'size', 'luns', 'mappings'))
+        disks = totals['disks']
+        size = totals['size']
+        luns = totals['luns']
+        mappings = totals['mappings']
+        for code, disk_size, disk_luns, disk_mappings in zip(
+                self.columns['pool'].codes, self.columns['size'],
+                self.columns['targets'], self.columns['clients']):
+            disks[code] += 1
+            size[code] += disk_size
+            luns[code] += disk_luns
+            mappings[code] += disk_mappings
+        return totals
+
+    def to_arrow(self):
+        """Return the inventory as a pyarrow.Table.
+
+        The dictionary encoded columns become Arrow dictionary arrays,
+        without expanding them.
+        """
+        _require_pyarrow()
+        arrays = []
+        for name in COLUMNS:
+            column = self.columns[name]
+            if name in ENCODED:
+                arrays.append(pyarrow.DictionaryArray.from_arrays(
+                    pyarrow.array(column.codes, type=pyarrow.int64()),
+                    pyarrow.array(column.values, type=pyarrow.string())))
+            elif name in NUMERIC:
+                arrays.append(pyarrow.array(column, type=pyarrow.int64()))
+            else:
+                arrays.append(pyarrow.array(column, type=pyarrow.string()))
+        return pyarrow.Table.from_arrays(arrays, names=list(COLUMNS))
+
+    def write_parquet(self, where, **kwargs):
+        """Write the inventory to a Parquet file.
+
+        kwargs are passed to pyarrow.parquet.write_table().
+        """
+        _require_pyarrow()
+        parquet.write_table(self.to_arrow(), where, **kwargs)
@@ -0,0 +1,698 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Operation journal
+
+.. module: journal
+
+:Description: An append only, JSON lines journal of the mutating calls
+made by RBDISCSIClient.  The intent of a call is written, and synced,
+before the request is sent and its completion after the response, so on
+startup recover() finds the calls, and the multi-step transactions,
+that a dead process left unfinished by reading the journal alone, and
+resumes or rolls them back.
+
+Records, one JSON object per line::
+
+    {"t": "begin", "tx": id, "name": ..., "steps": [[action, args], ...]}
+    {"t": "intent", "op": id, "tx": id, "step": n, "action": ...,
+     "args": {...}}
+    {"t": "done", "op": id}
+    {"t": "fail", "op": id, "error": ...}
+    {"t": "end", "tx": id, "state": "committed" | "rolled_back"}
+
+The arguments that are secrets, like CHAP passwords, are written as
+REDACTED, and the file is only readable by its owner.
+
+A process holds a lock on the journal it writes.  When the journal file
+is already locked by another live process, like the parent of a forked
+worker, the process writes to a journal of its own, the file name
+suffixed with its pid.  recover() adopts the records of the journals
+whose process died, and never touches those of live processes.
+"""
+
+import collections
+import contextlib
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from rbd_iscsi_client import cancel
+from rbd_iscsi_client import exceptions
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks, every process uses the journal file as is
+    fcntl = None
+
+LOG = logging.getLogger(__name__)
+
+RESUME = 'resume'
+ROLLBACK = 'rollback'
+
+COMMITTED = 'committed'
+ROLLED_BACK = 'rolled_back'
+
+# Marks an argument that was not written to the journal, a call with a
+# redacted argument can't be replayed.
+REDACTED = '<redacted>'
+
+# The client call undoing each call, and the arguments it is given.  The
+# rollback of create_disk preserves the rbd image.
+INVERSES = {
+    'create_target_iqn': ('delete_target_iqn', ('target_iqn',)),
+    'create_client': ('delete_client', ('target_iqn', 'client_iqn')),
+    'create_disk': ('delete_disk', ('pool', 'image')),
+    'register_disk': ('unregister_disk', ('target_iqn', 'volume')),
+    'export_disk': ('unexport_disk', ('target_iqn', 'client_iqn', 'pool',
+                                      'disk')),
+}
+
+
+def inverse(action, args):
+    """Return the (action, args) undoing a call, None if there is none."""
+    if action not in INVERSES:
+        return None
+    undo, names = INVERSES[action]
+    return undo, dict((name, args[name]) for name in names)
+
+
+class Operation(object):
+    """A journaled call, as read back from the journal."""
+
+    def __init__(self, op_id, action, args, tx_id=None, step=None):
+        self.op_id = op_id
+        self.action = action
+        self.args = args
+        self.tx_id = tx_id
+        self.step = step
+        # None while in doubt, then True or False
+        self.done = None
+        self.error = None
+
+    @property
+    def replayable(self):
+        return REDACTED not in self.args.values()
+
+    def __repr__(self):
+        return "<Operation %s %s(%s)>" % (self.op_id, self.action, self.args)
+
+
+class Transaction(object):
+    """A journaled sequence of steps, as read back from the journal."""
+
+    def __init__(self, tx_id, name, steps):
+        self.tx_id = tx_id
+        self.name = name
+        self.steps = steps
+        self.operations = []
+        self.state = None
+
+    @property
+    def completed_steps(self):
+        return set(op.step for op in self.operations if op.done)
+
+    @property
+    def in_doubt_steps(self):
+        return set(op.step for op in self.operations if op.done is None)
+
+    def __repr__(self):
+        return "<Transaction %s %s>" % (self.tx_id, self.name)
+
+
+class Recovered(collections.namedtuple('Recovered',
+                                       ['key', 'action', 'error'])):
+    """The outcome of recovering one unfinished operation or transaction.
+
+    key is the operation or transaction id, action what was done
+    (resume or rollback) and error the exception that stopped it, if any.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _open_append(path):
+    """Open path for appending, creating it readable by its owner only."""
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    return os.fdopen(fd, 'a')
+
+
+def _try_lock(f):
+    """Lock the file f for this process, False if another one holds it."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class Journal(object):
+    """The journal file of a client.
+
+    Intents are synced to disk before the call is made.  Other records
+    are only flushed, and synced in batches of sync_batch records or on
+    the next intent, since losing them only makes recovery redo work.
+    Concurrent intents share the same fsync.
+
+    The records of the finished calls and transactions are compacted
+    away once compact_after of them were written, so that the journal of
+    a long lived client doesn't grow without bound.
+
+    :param path: The journal file, created if needed.  When another
+                 process holds it, the journal of this process is
+                 path.<pid>
+    :param sync_batch: Number of unsynced records allowed
+    :param compact_after: Number of calls and transactions finished
+                          before the journal is compacted, None to only
+                          compact it on recover()
+    """
+
+    def __init__(self, path, sync_batch=64, compact_after=1000):
+        self.base_path = path
+        self.sync_batch = sync_batch
+        self.compact_after = compact_after
+        self._finished = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._local = threading.local()
+        self._written = 0
+        self._synced = 0
+        self._open()
+
+    def _open(self):
+        self.path = self.base_path
+        self._file = _open_append(self.path)
+        if not _try_lock(self._file):
+            self._file.close()
+            self.path = '%s.%d' % (self.base_path, os.getpid())
+            self._file = _open_append(self.path)
+            _try_lock(self._file)
+
+    def close(self):
+        """Close the journal, removing it if it is a per process one
+        without unfinished records."""
+        with self._lock:
+            if self._file.closed:
+                return
+        transactions, operations = self.pending()
+        with self._lock:
+            if (self.path != self.base_path and not transactions and
+                    not operations):
+                os.unlink(self.path)
+            self._file.close()
+
+    def after_fork(self):
+        """Open a journal of our own, with locks of our own.
+
+        The journal of the parent stays locked by the parent.  Every
+        record is flushed when written, so the buffer copied from the
+        parent is empty.
+        """
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._local = threading.local()
+        # Closing our copy of the file doesn't release the lock of the
+        # parent, but keeps the journal of the parent locked once it dies.
+        self._file.close()
+        self._written = self._synced = self._finished = 0
+        self._open()
+
+    def _orphans(self):
+        """The journal files of the dead processes, opened and locked."""
+        if fcntl is None:
+            return []
+        orphans = []
+        paths = [self.base_path] + glob.glob(glob.escape(self.base_path) +
+                                             '.*')
+        for path in paths:
+            suffix = path[len(self.base_path) + 1:]
+            if path == self.path or not (path == self.base_path or
+                                         suffix.isdigit()):
+                continue
+            try:
+                f = open(path)
+            except FileNotFoundError:
+                continue
+            if _try_lock(f):
+                orphans.append(f)
+            else:
+                f.close()
+        return orphans
+
+    def adopt_orphans(self):
+        """Move the records of the journals of dead processes into ours.
+
+        Returns the number of journals adopted.
+        """
+        adopted = 0
+        for f in self._orphans():
+            with f:
+                lines = [line for line in f if line.endswith('\n')]
+                if lines:
+                    with self._lock:
+                        self._file.writelines(lines)
+                        self._written += len(lines)
+                    self.sync()
+                # A crash before the unlink leaves the records in both
+                # journals, read() ignores the duplicates.
+                os.unlink(f.name)
+            adopted += 1
+        return adopted
+
+    def _append(self, record, sync=False):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._written += 1
+            seq = self._written
+            if not sync and seq - self._synced < self.sync_batch:
+                self._file.flush()
+                return
+        self._sync(seq)
+
+    def _sync(self, seq):
+        with self._sync_lock:
+            # Another thread may have synced our record with its own
+            if self._synced >= seq:
+                return
+            with self._lock:
+                self._file.flush()
+                target = self._written
+                fd = self._file.fileno()
+            os.fsync(fd)
+            self._synced = target
+
+    def sync(self):
+        """Sync every record written so far."""
+        self._sync(self._written)
+
+    @contextlib.contextmanager
+    def context(self, tx_id=None, step=None, enabled=True):
+        """Attribute the calls of this thread to a transaction step.
+
+        With enabled False the calls are not journaled at all.
+        """
+        previous = getattr(self._local, 'context', None)
+        self._local.context = (tx_id, step, enabled)
+        try:
+            yield
+        finally:
+            self._local.context = previous
+
+    def begin(self, steps, name=None):
+        """Record the start of a transaction, return its id.
+
+        The secret arguments of steps must already be redacted, see
+        redact_steps().
+        """
+        tx_id = uuid.uuid4().hex
+        self._append({'t': 'begin', 'tx': tx_id, 'name': name,
+                      'at': time.time(),
+                      'steps': [[action, list(args)]
+                                for action, args in steps]})
+        return tx_id
+
+    def _finish(self, record):
+        """Append the record finishing a call or transaction."""
+        self._append(record)
+        with self._lock:
+            self._finished += 1
+            due = (self.compact_after is not None and
+                   self._finished >= self.compact_after)
+        if due:
+            self.compact()
+
+    def end(self, tx_id, state=COMMITTED):
+        self._finish({'t': 'end', 'tx': tx_id, 'state': state})
+
+    def intent(self, action, args):
+        """Durably record a call about to be made, return its id.
+
+        Returns None when journaling is disabled for this thread.
+        """
+        tx_id, step, enabled = (getattr(self._local, 'context', None) or
+                                (None, None, True))
+        if not enabled:
+            return None
+        op_id = uuid.uuid4().hex
+        record = {'t': 'intent', 'op': op_id, 'action': action,
+                  'args': args}
+        if tx_id is not None:
+            record['tx'] = tx_id
+            record['step'] = step
+        self._append(record, sync=True)
+        return op_id
+
+    def done(self, op_id):
+        if op_id is not None:
+            self._finish({'t': 'done', 'op': op_id})
+
+    def failed(self, op_id, error):
+        if op_id is not None:
+            self._finish({'t': 'fail', 'op': op_id, 'error': str(error)})
+
+    def read(self):
+        """Read the journal back.
+
+        Returns a (transactions, operations) tuple of dicts by id.  A
+        truncated last line, left by a crash, is ignored.
+        """
+        self.sync()
+        transactions = collections.OrderedDict()
+        operations = collections.OrderedDict()
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    LOG.warning("Ignoring corrupt journal record %r", line)
+                    continue
+                kind = record.get('t')
+                if kind == 'begin':
+                    if record['tx'] in transactions:
+                        continue
+                    transactions[record['tx']] = Transaction(
+                        record['tx'], record.get('name'),
+                        [(action, tuple(args))
+                         for action, args in record['steps']])
+                elif kind == 'intent':
+                    if record['op'] in operations:
+                        continue
+                    op = Operation(record['op'], record['action'],
+                                   record['args'], record.get('tx'),
+                                   record.get('step'))
+                    operations[op.op_id] = op
+                    tx = transactions.get(op.tx_id)
+                    if tx is not None:
+                        tx.operations.append(op)
+                elif kind in ('done', 'fail'):
+                    op = operations.get(record['op'])
+                    if op is not None:
+                        op.done = kind == 'done'
+                        op.error = record.get('error')
+                elif kind == 'end':
+                    tx = transactions.get(record['tx'])
+                    if tx is not None:
+                        tx.state = record['state']
+        return transactions, operations
+
+    def pending(self):
+        """Return the unfinished (transactions, operations).
+
+        The operations are the calls made outside of a transaction that
+        are in doubt: their intent was recorded but not their outcome.
+        """
+        transactions, operations = self.read()
+        pending_tx = [tx for tx in transactions.values()
+                      if tx.state is None]
+        pending_ops = [op for op in operations.values()
+                       if op.tx_id is None and op.done is None]
+        return pending_tx, pending_ops
+
+    def compact(self):
+        """Rewrite the journal with the unfinished records only."""
+        with self._sync_lock, self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            with open(self.path) as f:
+                records = []
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+
+            finished_tx = set(r['tx'] for r in records if r['t'] == 'end')
+            finished_ops = set(r['op'] for r in records
+                               if r['t'] in ('done', 'fail'))
+            keep_ops = set(r['op'] for r in records
+                           if r['t'] == 'intent' and
+                           r.get('tx') not in finished_tx and
+                           (r.get('tx') or r['op'] not in finished_ops))
+
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.rbdjnl-')
+            f = os.fdopen(fd, 'a')
+            # Locked before it replaces the journal, so that no other
+            # process takes it for the journal of a dead one.
+            _try_lock(f)
+            for record in records:
+                if record['t'] in ('begin', 'end'):
+                    keep = record['tx'] not in finished_tx
+                else:
+                    keep = record['op'] in keep_ops
+                if keep:
+                    f.write(json.dumps(record, separators=(',', ':')))
+                    f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._file.close()
+            self._file = f
+            self._written = self._synced = self._finished = 0
+
+
+def _call(client, action, args):
+    return getattr(client, action)(**args)
+
+
+def _bind(client, action, args):
+    """The keyword arguments of a call given with positional args."""
+    func = getattr(client, action)
+    signature = getattr(func, 'journal_signature', None)
+    if signature is None:
+        raise ValueError("%s is not a journaled call" % action)
+    return dict(signature.bind(*args).arguments)
+
+
+def redact_steps(client, steps):
+    """Return steps with the secret arguments replaced by REDACTED.
+
+    The secrets are the arguments the client method redacts from its
+    own journal records.
+    """
+    redacted = []
+    for action, args in steps:
+        names = getattr(getattr(client, action), 'journal_redact', ())
+        if names:
+            bound = list(_bind(client, action, args))
+            args = tuple(REDACTED if index < len(bound) and
+                         bound[index] in names else arg
+                         for index, arg in enumerate(args))
+        redacted.append((action, args))
+    return redacted
+
+
+def _context(journal, *args, **kwargs):
+    if journal is None:
+        return contextlib.ExitStack()
+    return journal.context(*args, **kwargs)
+
+
+def _tolerate(step, in_doubt, func, *args):
+    """Run func, ignoring its failure if the step is in doubt.
+
+    A step in doubt may or may not have been applied by the gateway, so
+    redoing or undoing it may fail because it already was.
+    """
+    try:
+        func(*args)
+    except Exception as ex:
+        if step not in in_doubt:
+            raise
+        LOG.info("Ignoring failure of in doubt step %(step)s: %(ex)s",
+                 {'step': step, 'ex': ex})
+
+
+def outcome_unknown(ex):
+    """Whether a call that failed with ex may have been applied.
+
+    A call answered with a 4xx, or that failed before it was sent, was
+    not.  One answered with a 5xx, or that got no answer at all, like a
+    call that timed out, lost its connection or was cancelled, may have
+    been.
+    """
+    status = getattr(ex, 'http_status', None)
+    if isinstance(status, int):
+        return status >= 500
+    # The requests exceptions are OSErrors
+    return isinstance(ex, (exceptions.ConnectionError, exceptions.Timeout,
+                           exceptions.RequestException,
+                           exceptions.HTTPError,
+                           exceptions.TooManyRedirects,
+                           exceptions.Cancelled, OSError))
+
+
+def rollback(client, journal, tx_id, steps, applied, in_doubt=()):
+    """Undo the applied steps of a transaction, in reverse order.
+
+    Steps without an inverse, like deletions, are left as they are.
+    """
+    with _context(journal, enabled=False):
+        for index in sorted(applied, reverse=True):
+            action, args = steps[index]
+            undo = inverse(action, _bind(client, action, args))
+            if undo is None:
+                LOG.warning("Step %(index)s of transaction %(tx)s, "
+                            "%(action)s, can't be rolled back",
+                            {'index': index, 'tx': tx_id,
+                             'action': action})
+                continue
+            _tolerate(index, in_doubt, _call, client, *undo)
+    if journal is not None:
+        journal.end(tx_id, ROLLED_BACK)
+
+
+def run_transaction(client, journal, steps, name=None):
+    """Run steps, a list of (action, args), one after the other.
+
+    The transaction is journaled when journal is not None.  When a step
+    fails, the steps already applied are rolled back and the exception
+    is raised again.  The failed step is rolled back too only when its
+    outcome is unknown, see outcome_unknown(): a step the gateway
+    refused, like the creation of a disk that already exists, must not
+    undo what was there before.  If the rollback fails too, the
+    transaction is left unfinished in the journal for recover().
+
+    Returns the (resp, body) of every step.
+    """
+    steps = [(action, tuple(args)) for action, args in steps]
+    tx_id = None
+    if journal is not None:
+        tx_id = journal.begin(redact_steps(client, steps), name)
+    results = []
+    for index, (action, args) in enumerate(steps):
+        try:
+            with _context(journal, tx_id, index):
+                results.append(getattr(client, action)(*args))
+        except Exception as ex:
+            LOG.warning("Step %(index)s of transaction %(name)s, "
+                        "%(action)s, failed: %(ex)s. Rolling back.",
+                        {'index': index, 'name': name or tx_id,
+                         'action': action, 'ex': ex})
+            applied = list(range(index))
+            in_doubt = ()
+            if outcome_unknown(ex):
+                applied.append(index)
+                in_doubt = (index,)
+            try:
+                # Roll back even when the transaction was abandoned
+                # with its cancel token.
+                with cancel.shield():
+                    rollback(client, journal, tx_id, steps, applied,
+                             in_doubt=in_doubt)
+            except Exception:
+                LOG.exception("Failed to roll back transaction %s",
+                              name or tx_id)
+            raise
+    if journal is not None:
+        journal.end(tx_id, COMMITTED)
+    return results
+
+
+def _recover_operation(client, journal, op, mode):
+    if mode == RESUME:
+        if not op.replayable:
+            raise ValueError("%s can't be replayed, its arguments were "
+                             "not journaled" % op.action)
+        call = (op.action, op.args)
+    else:
+        call = inverse(op.action, op.args)
+        if call is None:
+            raise ValueError("%s can't be rolled back" % op.action)
+    # The call is in doubt, so it may fail because it was already
+    # applied, or undone.
+    with journal.context(enabled=False):
+        _tolerate(None, (None,), _call, client, *call)
+    journal.done(op.op_id)
+
+
+def _recover_transaction(client, journal, tx, mode):
+    """Resume or roll back tx, return what was done.
+
+    A transaction whose steps left to run have redacted arguments can't
+    be resumed, it is rolled back instead.
+    """
+    completed = tx.completed_steps
+    in_doubt = tx.in_doubt_steps
+    if mode == RESUME and any(
+            REDACTED in args for index, (action, args) in enumerate(tx.steps)
+            if index not in completed):
+        LOG.warning("Transaction %s has redacted arguments, rolling it "
+                    "back instead of resuming it", tx.name or tx.tx_id)
+        mode = ROLLBACK
+    if mode == RESUME:
+        for index, (action, args) in enumerate(tx.steps):
+            if index in completed:
+                continue
+            with journal.context(tx.tx_id, index):
+                _tolerate(index, in_doubt, getattr(client, action), *args)
+        journal.end(tx.tx_id, COMMITTED)
+    else:
+        rollback(client, journal, tx.tx_id, tx.steps,
+                 completed | in_doubt, in_doubt)
+    return mode
+
+
+def recover(client, journal, mode=RESUME):
+    """Finish what a previous process left in the journal.
+
+    Transactions are resumed from their first step not known to be
+    done, or rolled back, according to mode.  Calls made outside of a
+    transaction whose outcome is unknown are replayed or undone.  Only
+    the journal is read to find them, not the gateway config.
+
+    The journals of the dead processes that shared the journal file are
+    adopted first, those of the live ones are left alone.
+
+    Returns a list of Recovered.  The transactions that couldn't be
+    recovered stay in the journal for the next attempt, everything else
+    is compacted away.
+    """
+    if mode not in (RESUME, ROLLBACK):
+        raise ValueError("Unknown recovery mode %r" % mode)
+    journal.adopt_orphans()
+    results = []
+    transactions, operations = journal.pending()
+    for tx in transactions:
+        try:
+            action = _recover_transaction(client, journal, tx, mode)
+        except Exception as ex:
+            LOG.warning("Failed to %(mode)s transaction %(tx)s: %(ex)s",
+                        {'mode': mode, 'tx': tx.tx_id, 'ex': ex})
+            results.append(Recovered(tx.tx_id, mode, ex))
+        else:
+            results.append(Recovered(tx.tx_id, action, None))
+    for op in operations:
+        try:
+            _recover_operation(client, journal, op, mode)
+        except Exception as ex:
+            # Nothing more can be done with it, don't keep it around
+            LOG.warning("Failed to %(mode)s %(op)r: %(ex)s",
+                        {'mode': mode, 'op': op, 'ex': ex})
+            journal.failed(op.op_id, ex)
+            results.append(Recovered(op.op_id, mode, ex))
+        else:
+            results.append(Recovered(op.op_id, mode, None))
+    journal.compact()
+    return results
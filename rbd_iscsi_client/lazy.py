@@ -0,0 +1,78 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Lazy imports
+
+.. module: lazy
+
+:Description: Defers importing the heavier dependencies (requests,
+urllib3, msgpack) until they are first used, so importing the package
+stays cheap for short lived processes.
+"""
+
+import importlib
+import threading
+import types
+
+_lock = threading.Lock()
+
+
+class LazyModule(types.ModuleType):
+    """Stand in for a module that is imported on first attribute access.
+
+    :param name: The name of the module to import
+    :param optional: If the module can't be imported, is_available()
+                     returns False instead of the ImportError being
+                     raised
+    """
+
+    def __init__(self, name, optional=False):
+        super(LazyModule, self).__init__(name)
+        self.__dict__['_lazy_optional'] = optional
+        self.__dict__['_lazy_module'] = None
+        self.__dict__['_lazy_error'] = None
+
+    def _lazy_load(self):
+        module = self.__dict__['_lazy_module']
+        if module is None:
+            with _lock:
+                module = self.__dict__['_lazy_module']
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._lazy_load(), name)
+
+    def __repr__(self):
+        state = 'loaded' if self.__dict__['_lazy_module'] else 'not loaded'
+        return "<lazy module %r (%s)>" % (self.__name__, state)
+
+
+def is_available(module):
+    """Can module, a module, LazyModule or None, be used?"""
+    if module is None:
+        return False
+    if not isinstance(module, LazyModule):
+        return True
+    if module.__dict__['_lazy_error'] is not None:
+        # Don't scan sys.path again for a module we know is missing
+        return False
+    try:
+        module._lazy_load()
+    except ImportError as ex:
+        if not module.__dict__['_lazy_optional']:
+            raise
+        module.__dict__['_lazy_error'] = ex
+        return False
+    return True
@@ -0,0 +1,280 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Load generator
+
+.. module: loadgen
+
+:Description: Drives an RBDISCSIClient with a configurable mix of disk
+lifecycle and read calls at an open loop arrival rate, to find out how
+many operations a gateway cluster sustains.  It works against real
+gateways or the in process fake gateway.
+
+Requests are started on a fixed schedule whether or not the previous
+ones completed, and latencies are measured from the scheduled start, so
+a saturated gateway shows up as growing latencies instead of silently
+lowering the offered load.
+"""
+
+import collections
+import random
+import threading
+import time
+from concurrent import futures
+
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import stats
+
+# Calls that move a volume through its lifecycle: the state the volume
+# must be in and the state it is in afterwards.
+TRANSITIONS = {
+    'create_disk': (None, 'created'),
+    'register_disk': ('created', 'registered'),
+    'export_disk': ('registered', 'exported'),
+    'unexport_disk': ('exported', 'registered'),
+    'unregister_disk': ('registered', 'created'),
+    'delete_disk': ('created', None),
+}
+
+READ_OPS = ('find_disk', 'get_config', 'get_disks', 'get_targets',
+            'get_clients', 'get_gatewayinfo')
+
+DEFAULT_MIX = {'create_disk': 2, 'register_disk': 2, 'export_disk': 2,
+               'unexport_disk': 1, 'unregister_disk': 1, 'delete_disk': 1,
+               'find_disk': 4, 'get_config': 1}
+
+
+def parse_mix(value):
+    """Parse 'op=weight,op=weight' into a mix dict."""
+    mix = {}
+    for item in value.split(','):
+        op, sep, weight = item.partition('=')
+        op = op.strip()
+        if op not in TRANSITIONS and op not in READ_OPS:
+            raise ValueError("Unknown operation %r in the mix" % op)
+        mix[op] = float(weight) if sep else 1.0
+    return mix
+
+
+class Report(object):
+    """The outcome of a load generator run."""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(stats.Histogram)
+        self.errors = collections.Counter()
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.duration = 0
+        self._lock = threading.Lock()
+
+    def record(self, op, latency, error=None):
+        with self._lock:
+            self.completed += 1
+            self.latencies[op].add(latency)
+            if error is not None:
+                self.failed += 1
+                self.errors[(op, type(error).__name__)] += 1
+
+    def skip(self):
+        with self._lock:
+            self.skipped += 1
+
+    @property
+    def throughput(self):
+        """Completed operations per second."""
+        if not self.duration:
+            return 0
+        return self.completed / self.duration
+
+    def format(self):
+        lines = ["scheduled %d, completed %d, failed %d, skipped %d "
+                 "in %.1fs: %.1f ops/s" %
+                 (self.scheduled, self.completed, self.failed, self.skipped,
+                  self.duration, self.throughput)]
+        fmt = "%-18s %8s %9s %9s %9s %9s"
+        lines.append(fmt % ('OPERATION', 'COUNT', 'p50 ms', 'p90 ms',
+                            'p99 ms', 'max ms'))
+        for op in sorted(self.latencies):
+            summary = self.latencies[op].summary()
+            lines.append(fmt % (op, summary['count'],
+                                '%.1f' % (summary['p50'] * 1000),
+                                '%.1f' % (summary['p90'] * 1000),
+                                '%.1f' % (summary['p99'] * 1000),
+                                '%.1f' % (summary['max'] * 1000)))
+        if self.errors:
+            lines.append("%-18s %-30s %8s" % ('OPERATION', 'ERROR', 'COUNT'))
+            for (op, error), count in sorted(self.errors.items()):
+                lines.append("%-18s %-30s %8d" % (op, error, count))
+        return "\n".join(lines)
+
+
+class LoadGenerator(object):
+    """Run a mix of operations against the gateways of a client.
+
+    :param client: The RBDISCSIClient to drive
+    :param target_iqn: The target the volumes are registered to
+    :param client_iqn: The initiator the volumes are exported to
+    :param pool: The pool the volumes are created in
+    :param mix: dict of operation name to relative weight
+    :param rate: Operations started per second
+    :param concurrency: Maximum number of operations in flight
+    :param duration: Seconds to generate load for
+    :param size: Size of the created volumes
+    :param prefix: Name prefix of the created volumes
+    :param poisson: Use exponential inter arrival times instead of a
+                    fixed interval
+    :param seed: Seed of the random generator, for repeatable runs
+    """
+
+    def __init__(self, client, target_iqn, client_iqn, pool='rbd',
+                 mix=None, rate=10.0, concurrency=8, duration=10.0,
+                 size='1G', prefix='loadgen', poisson=True, seed=None):
+        self.client = client
+        self.target_iqn = target_iqn
+        self.client_iqn = client_iqn
+        self.pool = pool
+        self.mix = dict(mix or DEFAULT_MIX)
+        self.rate = float(rate)
+        self.concurrency = concurrency
+        self.duration = duration
+        self.size = size
+        self.prefix = prefix
+        self.poisson = poisson
+        self._random = random.Random(seed)
+        self._ops = sorted(self.mix)
+        self._weights = [self.mix[op] for op in self._ops]
+        self._lock = threading.Lock()
+        self._counter = 0
+        # Idle volumes by lifecycle state, a volume is removed from its
+        # set while an operation on it is in flight.
+        self._volumes = dict((state, set()) for state in
+                             ('created', 'registered', 'exported'))
+
+    def setup(self):
+        """Make sure the target and the client exist."""
+        for call, args in ((self.client.create_target_iqn,
+                            (self.target_iqn,)),
+                           (self.client.create_client,
+                            (self.target_iqn, self.client_iqn))):
+            try:
+                call(*args)
+            except exceptions.HTTPBadRequest:
+                # Already exists
+                pass
+
+    def _take(self, state):
+        with self._lock:
+            if state is None:
+                self._counter += 1
+                return '%s-%d' % (self.prefix, self._counter)
+            volumes = self._volumes[state]
+            if not volumes:
+                return None
+            return volumes.pop()
+
+    def _put(self, state, volume):
+        if state is not None:
+            with self._lock:
+                self._volumes[state].add(volume)
+
+    def _call(self, op, volume):
+        cl = self.client
+        disk = '%s/%s' % (self.pool, volume)
+        if op == 'create_disk':
+            return cl.create_disk(self.pool, volume, size=self.size)
+        if op == 'register_disk':
+            return cl.register_disk(self.target_iqn, disk)
+        if op == 'export_disk':
+            return cl.export_disk(self.target_iqn, self.client_iqn,
+                                  self.pool, volume)
+        if op == 'unexport_disk':
+            return cl.unexport_disk(self.target_iqn, self.client_iqn,
+                                    self.pool, volume)
+        if op == 'unregister_disk':
+            return cl.unregister_disk(self.target_iqn, disk)
+        if op == 'delete_disk':
+            # The volumes are ours, don't leave their images behind
+            return cl.delete_disk(self.pool, volume, preserve_image=False)
+        if op == 'find_disk':
+            return cl.find_disk(self.pool, volume)
+        if op == 'get_clients':
+            return cl.get_clients(self.target_iqn)
+        return getattr(cl, op)()
+
+    def _run_op(self, report, op, scheduled):
+        volume = None
+        before = after = None
+        if op in TRANSITIONS:
+            before, after = TRANSITIONS[op]
+            volume = self._take(before)
+            if volume is None:
+                report.skip()
+                return
+        elif op == 'find_disk':
+            with self._lock:
+                known = [v for vols in self._volumes.values() for v in vols]
+            volume = (self._random.choice(known) if known
+                      else '%s-missing' % self.prefix)
+
+        error = None
+        try:
+            self._call(op, volume)
+        except Exception as ex:
+            error = ex
+        report.record(op, time.monotonic() - scheduled, error)
+
+        if op in TRANSITIONS:
+            self._put(before if error else after, volume)
+
+    def run(self):
+        """Generate load for duration seconds and return the Report."""
+        report = Report()
+        start = time.monotonic()
+        end = start + self.duration
+        next_at = start
+        with futures.ThreadPoolExecutor(
+                max_workers=self.concurrency) as executor:
+            while True:
+                if self.poisson:
+                    next_at += self._random.expovariate(self.rate)
+                else:
+                    next_at += 1.0 / self.rate
+                if next_at >= end:
+                    break
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                op = self._random.choices(self._ops, self._weights)[0]
+                report.scheduled += 1
+                executor.submit(self._run_op, report, op, next_at)
+        report.duration = time.monotonic() - start
+        return report
+
+    def cleanup(self):
+        """Unexport, unregister and delete the volumes left behind.
+
+        A volume whose call fails, whatever the error, is skipped and the
+        cleanup goes on with the others.
+        """
+        for op in ('unexport_disk', 'unregister_disk', 'delete_disk'):
+            before, after = TRANSITIONS[op]
+            while True:
+                volume = self._take(before)
+                if volume is None:
+                    break
+                try:
+                    self._call(op, volume)
+                except Exception:
+                    continue
+                self._put(after, volume)
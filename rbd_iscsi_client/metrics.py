@@ -0,0 +1,70 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Client metrics
+
+.. module: metrics
+
+:Description: Thread safe counters and gauges kept by RBDISCSIClient.
+A metric is either global or per gateway, in which case it is keyed by
+the gateway base url.
+"""
+
+import collections
+import copy
+import threading
+
+
+class Metrics(object):
+    """Counters and gauges of a client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(dict)
+
+    def incr(self, name, value=1, gateway=None):
+        """Add value to a counter."""
+        with self._lock:
+            values = self._values[name]
+            values[gateway] = values.get(gateway, 0) + value
+
+    def set(self, name, value, gateway=None):
+        """Set a gauge."""
+        with self._lock:
+            self._values[name][gateway] = value
+
+    def get(self, name, gateway=None, default=0):
+        with self._lock:
+            return self._values.get(name, {}).get(gateway, default)
+
+    def after_fork(self):
+        """Replace the lock, which another thread may have held."""
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self):
+        """Return a copy of all the metrics.
+
+        Global metrics map their name to the value, per gateway metrics
+        map their name to a dict of gateway url to value.
+        """
+        with self._lock:
+            result = {}
+            for name, values in self._values.items():
+                if list(values) == [None]:
+                    result[name] = copy.copy(values[None])
+                else:
+                    result[name] = dict(values)
+            return result
@@ -0,0 +1,223 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Parallel helpers for the client
+
+.. module: parallel
+
+:Description: Bounded fan-out of client calls across a thread pool,
+and a streaming executor of mixed client calls keeping their order per
+resource.
+"""
+
+import collections
+import inspect
+from concurrent import futures
+
+from rbd_iscsi_client import cancel
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class Result(collections.namedtuple('Result',
+                                    ['key', 'resp', 'body', 'error'])):
+    """The outcome of a single call made by fan_out().
+
+    ``error`` is None when the call succeeded, otherwise it holds the
+    exception that was raised and ``resp``/``body`` are None.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def fan_out(func, keys, max_workers=DEFAULT_MAX_WORKERS):
+    """Call func(key) for every key with at most max_workers in flight.
+
+    Results are yielded as they complete, not in the order of keys.
+    Exceptions raised by func are captured in the yielded Result so
+    a single failure does not abort the rest of the batch.
+
+    func must return a (resp, body) tuple like the client calls do.
+
+    The calls run under the cancel.scope() of the caller.  Once its
+    token is cancelled no more keys are taken, and Cancelled or
+    DeadlineExceeded is raised after the results of the calls already
+    started, if keys were left.
+    """
+    keys = iter(keys)
+    max_workers = max(1, int(max_workers))
+    token = cancel.current()
+    func = cancel.propagate(func)
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        stopped = []
+
+        def _submit():
+            for key in keys:
+                if token is not None and token.cancelled:
+                    stopped.append(key)
+                    return False
+                pending[executor.submit(func, key)] = key
+                return True
+            return False
+
+        # Only keep max_workers calls queued so that a long iterable of
+        # keys is consumed lazily.
+        for _ in range(max_workers):
+            if not _submit():
+                break
+
+        while pending:
+            done, _ = futures.wait(pending,
+                                   return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    resp, body = future.result()
+                except Exception as ex:
+                    yield Result(key, None, None, ex)
+                else:
+                    yield Result(key, resp, body, None)
+                _submit()
+    if stopped:
+        token.check()
+
+
+def resources(method, args):
+    """Return the resources a client call changes.
+
+    method is the bound client method and args its positional
+    arguments.  The resources are ('disk', 'pool/image') and
+    ('client', client_iqn) tuples.  A call on a target as a whole,
+    like create_target_iqn, returns ('target', target_iqn) only.
+    """
+    call = inspect.signature(method).bind(*args).arguments
+    found = set()
+    pool = call.get('pool')
+    image = call.get('image', call.get('disk'))
+    if pool is not None and image is not None:
+        found.add(('disk', '%s/%s' % (pool, image)))
+    if call.get('volume') is not None:
+        found.add(('disk', call['volume']))
+    if call.get('client_iqn') is not None:
+        found.add(('client', call['client_iqn']))
+    if not found and call.get('target_iqn') is not None:
+        found.add(('target', call['target_iqn']))
+    return found
+
+
+def submit_many(client, ops, max_workers=DEFAULT_MAX_WORKERS, window=None):
+    """Run a stream of client calls, keeping their order per resource.
+
+    ops is an iterable of (action, args), like reconcile.Step, where
+    action is the name of a client method.  It is consumed lazily: at
+    most window ops, four times max_workers by default, are taken and
+    not yet complete at any time.
+
+    Two ops on the same disk or the same client iqn run in the order of
+    ops, the others run in parallel, at most max_workers at once.  An op
+    on a whole target (create_target_iqn, delete_target_iqn) waits for
+    the ops before it, and the ops after it wait for it.
+
+    Yields a Result keyed by the op for every op, in the order they
+    complete.  A failed op doesn't stop the others, not even the later
+    ops on the same resource.  Cancellation works like fan_out().
+    """
+    ops = iter(ops)
+    max_workers = max(1, int(max_workers))
+    window = max(1, int(window or 4 * max_workers))
+    token = cancel.current()
+
+    @cancel.propagate
+    def _call(op):
+        return getattr(client, op[0])(*op[1])
+
+    # The admitted ops by id, with their resources, and the queue of the
+    # admitted ops of each resource, the head of a queue may run.
+    admitted = {}
+    queues = {}
+    done_ops = collections.deque()
+    stopped = False
+    barrier = None
+    next_id = 0
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def _maybe_submit(op_id):
+            op, keys = admitted[op_id]
+            if all(queues[key][0] == op_id for key in keys):
+                pending[executor.submit(_call, op)] = op_id
+
+        def _admit(op_id, op, keys):
+            admitted[op_id] = (op, keys)
+            for key in keys:
+                queues.setdefault(key, collections.deque()).append(op_id)
+            _maybe_submit(op_id)
+
+        try:
+            while True:
+                while barrier is None and len(admitted) < window:
+                    op = next(ops, None)
+                    if op is None:
+                        break
+                    if token is not None and token.cancelled:
+                        stopped = True
+                        break
+                    try:
+                        keys = resources(getattr(client, op[0]), op[1])
+                    except (AttributeError, TypeError, ValueError) as ex:
+                        done_ops.append(Result(op, None, None, ex))
+                        continue
+                    op_id = next_id
+                    next_id += 1
+                    if any(kind == 'target' for kind, name in keys):
+                        # Runs alone once the ops before it completed
+                        barrier = (op_id, op, keys)
+                        break
+                    _admit(op_id, op, keys)
+                if barrier is not None and not admitted:
+                    _admit(*barrier)
+                    barrier = None
+
+                while done_ops:
+                    yield done_ops.popleft()
+                if not pending:
+                    break
+
+                done, dummy = futures.wait(pending,
+                                           return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    op_id = pending.pop(future)
+                    op, keys = admitted.pop(op_id)
+                    try:
+                        resp, body = future.result()
+                    except Exception as ex:
+                        done_ops.append(Result(op, None, None, ex))
+                    else:
+                        done_ops.append(Result(op, resp, body, None))
+                    for key in keys:
+                        queue = queues[key]
+                        queue.popleft()
+                        if queue:
+                            _maybe_submit(queue[0])
+                        else:
+                            del queues[key]
+        finally:
+            # Don't run the queued calls when the caller stops early
+            for future in pending:
+                future.cancel()
+    if stopped:
+        token.check()
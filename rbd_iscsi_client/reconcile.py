@@ -0,0 +1,192 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Desired state reconciliation
+
+.. module: reconcile
+
+:Description: Computes the client calls needed to converge the exports
+of a target to a desired set of (client_iqn, pool/image) mappings from
+one /api/config document, and runs them phase by phase.
+"""
+
+import collections
+
+from rbd_iscsi_client import parallel
+
+
+class Step(collections.namedtuple('Step', ['action', 'args'])):
+    """One client call of a plan, action is the client method name."""
+    __slots__ = ()
+
+    def __str__(self):
+        return "%s(%s)" % (self.action, ", ".join(repr(a) for a in self.args))
+
+
+# The phases of a plan, in the order they have to run.  The steps inside
+# a phase don't depend on each other and can run in parallel.
+PHASES = ('create_target', 'create', 'register', 'export',
+          'unexport', 'unregister', 'delete')
+
+
+class Plan(object):
+    """The steps to converge a target, grouped in phases."""
+
+    def __init__(self, target_iqn):
+        self.target_iqn = target_iqn
+        self.phases = collections.OrderedDict((p, []) for p in PHASES)
+        self.results = []
+        self.executed = False
+
+    def add(self, phase, action, *args):
+        self.phases[phase].append(Step(action, args))
+
+    @property
+    def steps(self):
+        return [step for steps in self.phases.values() for step in steps]
+
+    @property
+    def failed(self):
+        """The results of the steps that failed when executed."""
+        return [r for r in self.results if not r.ok]
+
+    def __len__(self):
+        return sum(len(steps) for steps in self.phases.values())
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __str__(self):
+        lines = []
+        for phase, steps in self.phases.items():
+            for step in steps:
+                lines.append("%s: %s" % (phase, step))
+        return "\n".join(lines)
+
+
+def split_disk(disk):
+    """Return the 'pool/image' name of a disk given as a str or tuple."""
+    if isinstance(disk, str):
+        pool, sep, image = disk.partition('/')
+        if not sep or not pool or not image:
+            raise ValueError("Invalid disk %r, expected pool/image" % disk)
+        return disk, pool, image
+    pool, image = disk
+    return '%s/%s' % (pool, image), pool, image
+
+
+def _names(value):
+    """Names from a config section, which is a dict or an older list."""
+    if not value:
+        return set()
+    return set(value)
+
+
+def plan(config, target_iqn, desired_mappings, unregister_unused=True,
+         delete_unused=False):
+    """Compute the minimal plan to converge target_iqn.
+
+    :param config: The /api/config document
+    :param target_iqn: The target to converge
+    :param desired_mappings: Iterable of (client_iqn, disk) where disk is
+                             'pool/image' or a (pool, image) tuple.  It is
+                             the complete set of exports of the target.
+    :param unregister_unused: Unregister the disks of the target that no
+                              desired mapping uses
+    :param delete_unused: Also delete the unregistered disks from the
+                          gateway if no other target uses them.  The rbd
+                          images are preserved.
+    """
+    config = config or {}
+    result = Plan(target_iqn)
+
+    desired = set()
+    disks = {}
+    for client_iqn, disk in desired_mappings:
+        name, pool, image = split_disk(disk)
+        desired.add((client_iqn, name))
+        disks[name] = (pool, image)
+
+    gw_disks = _names(config.get('disks'))
+    targets = config.get('targets') or {}
+    target = targets.get(target_iqn)
+    if target is None:
+        result.add('create_target', 'create_target_iqn', target_iqn)
+        target = {}
+    target_disks = _names(target.get('disks'))
+    target_clients = target.get('clients') or {}
+
+    current = set()
+    for client_iqn, client in target_clients.items():
+        for name in _names(client.get('luns')):
+            current.add((client_iqn, name))
+
+    for name in sorted(set(disks) - gw_disks):
+        result.add('create', 'create_disk', *disks[name])
+    for client_iqn in sorted(set(c for c, _ in desired) -
+                             set(target_clients)):
+        result.add('create', 'create_client', target_iqn, client_iqn)
+
+    for name in sorted(set(disks) - target_disks):
+        result.add('register', 'register_disk', target_iqn, name)
+
+    for client_iqn, name in sorted(desired - current):
+        pool, image = disks[name]
+        result.add('export', 'export_disk', target_iqn, client_iqn,
+                   pool, image)
+
+    for client_iqn, name in sorted(current - desired):
+        dummy, pool, image = split_disk(name)
+        result.add('unexport', 'unexport_disk', target_iqn, client_iqn,
+                   pool, image)
+
+    if unregister_unused:
+        unused = target_disks - set(disks)
+        for name in sorted(unused):
+            result.add('unregister', 'unregister_disk', target_iqn, name)
+
+        if delete_unused:
+            in_use = set()
+            for iqn, other in targets.items():
+                if iqn != target_iqn:
+                    in_use |= _names(other.get('disks'))
+            for name in sorted((unused & gw_disks) - in_use):
+                dummy, pool, image = split_disk(name)
+                result.add('delete', 'delete_disk', pool, image, True)
+
+    return result
+
+
+def execute(client, plan, max_workers=parallel.DEFAULT_MAX_WORKERS):
+    """Run the steps of plan with client, one phase at a time.
+
+    The steps of a phase run in parallel.  When a step fails the later
+    phases, which may depend on it, are not run.  The results are stored
+    in plan.results, as they complete, so they are there even when the
+    execution is cancelled.
+    """
+    plan.executed = True
+
+    def _run(step):
+        return getattr(client, step.action)(*step.args)
+
+    for phase, steps in plan.phases.items():
+        if not steps:
+            continue
+        failed = False
+        for result in parallel.fan_out(_run, steps,
+                                       max_workers=max_workers):
+            plan.results.append(result)
+            failed = failed or not result.ok
+        if failed:
+            break
+    return plan
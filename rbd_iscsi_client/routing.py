@@ -0,0 +1,73 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Owner gateway routing
+
+.. module: routing
+
+:Description: rbd-target-api forwards most of the operations on a disk
+to the gateway owning it.  These helpers find, from a config document,
+which of the gateway urls the client knows is the owner of a disk, so
+that the request can be sent there directly.
+"""
+
+import ipaddress
+from urllib import parse
+
+
+def _short(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return host.split('.', 1)[0]
+    return host
+
+
+def owner_urls(config, urls):
+    """Map the gateway host names of config to the urls of urls.
+
+    A url belongs to a gateway when its host is the name of the gateway,
+    its short name, or one of its portal ip addresses.  The gateways
+    without a url aren't in the returned dict.
+    """
+    config = config or {}
+    addresses = {}
+    for name, gateway in (config.get('gateways') or {}).items():
+        if isinstance(gateway, dict):
+            addresses.setdefault(name, set()).update(
+                gateway.get('portal_ip_addresses') or ())
+    for target in (config.get('targets') or {}).values():
+        for name, portal in (target.get('portals') or {}).items():
+            if isinstance(portal, dict):
+                addresses.setdefault(name, set()).update(
+                    portal.get('portal_ip_addresses') or ())
+
+    hosts = [(parse.urlsplit(url).hostname or '', url) for url in urls]
+    owners = {}
+    for name, ips in addresses.items():
+        for host, url in hosts:
+            if (host == name or _short(host) == _short(name) or
+                    host in ips):
+                owners[name] = url
+                break
+    return owners
+
+
+def disk_owner(config, disk):
+    """Return the host name of the gateway owning disk, or None.
+
+    disk is the 'pool/image' name of the disk.
+    """
+    details = ((config or {}).get('disks') or {}).get(disk)
+    if not isinstance(details, dict):
+        return None
+    return details.get('owner') or None
@@ -0,0 +1,292 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Config snapshots
+
+.. module: snapshot
+
+:Description: Persist the last /api/config response to a local file so a
+restarted client can warm start from it.  The file is written with
+msgpack when it is installed and falls back to JSON otherwise.
+SharedCache shares the latest snapshot between the processes of a host.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from rbd_iscsi_client import lazy
+
+msgpack = lazy.LazyModule('msgpack', optional=True)
+sqlite3 = lazy.LazyModule('sqlite3')
+
+LOG = logging.getLogger(__name__)
+
+# Every snapshot file starts with this magic followed by a one byte
+# format marker, so a file written with msgpack can still be identified
+# by a process that doesn't have it installed.
+MAGIC = b'RBDSNAP1'
+FORMAT_MSGPACK = b'm'
+FORMAT_JSON = b'j'
+
+# Response headers that are worth keeping with the snapshot.
+SAVED_HEADERS = ('status', 'content-location', 'etag', 'last-modified')
+
+
+class ConfigSnapshot(object):
+    """A parsed /api/config response and the data to revalidate it.
+
+    :param config: The decoded config body
+    :param headers: The subset of response headers kept with it
+    :param fetched_at: When the config was fetched from the gateway
+    """
+
+    def __init__(self, config, headers=None, fetched_at=None):
+        self.config = config
+        self.headers = headers or {}
+        self.fetched_at = fetched_at or time.time()
+
+    @classmethod
+    def from_response(cls, resp, body):
+        headers = {}
+        for name in SAVED_HEADERS:
+            if resp is not None and name in resp:
+                headers[name] = resp[name]
+        return cls(body, headers)
+
+    @property
+    def epoch(self):
+        """The config epoch reported by rbd-target-api, if any."""
+        if isinstance(self.config, dict):
+            return self.config.get('epoch')
+        return None
+
+    @property
+    def validator(self):
+        """The HTTP validator (ETag or Last-Modified), if any."""
+        return (self.headers.get('etag') or
+                self.headers.get('last-modified'))
+
+    def conditional_headers(self):
+        """Headers to revalidate this snapshot with the gateway."""
+        headers = {}
+        if 'etag' in self.headers:
+            headers['If-None-Match'] = self.headers['etag']
+        elif 'last-modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+    def same_as(self, other):
+        """Is other the same config generation as this snapshot?"""
+        if other is None:
+            return False
+        if self.validator and self.validator == other.validator:
+            return True
+        if self.epoch is not None and self.epoch == other.epoch:
+            return True
+        return self.config == other.config
+
+    def to_dict(self):
+        return {'config': self.config,
+                'headers': self.headers,
+                'fetched_at': self.fetched_at}
+
+
+def dumps(snapshot):
+    """Serialize a snapshot to bytes."""
+    data = snapshot.to_dict()
+    if lazy.is_available(msgpack):
+        return MAGIC + FORMAT_MSGPACK + msgpack.packb(data, use_bin_type=True)
+    return (MAGIC + FORMAT_JSON +
+            json.dumps(data, separators=(',', ':')).encode('utf-8'))
+
+
+def loads(raw):
+    """Deserialize a snapshot written by dumps()."""
+    if not raw.startswith(MAGIC):
+        raise ValueError("Not a config snapshot")
+    fmt = raw[len(MAGIC):len(MAGIC) + 1]
+    payload = raw[len(MAGIC) + 1:]
+    if fmt == FORMAT_MSGPACK:
+        if not lazy.is_available(msgpack):
+            raise ValueError("Snapshot was written with msgpack, "
+                             "which is not installed")
+        data = msgpack.unpackb(payload, raw=False)
+    elif fmt == FORMAT_JSON:
+        data = json.loads(payload.decode('utf-8'))
+    else:
+        raise ValueError("Unknown snapshot format %r" % fmt)
+    return ConfigSnapshot(data['config'], data.get('headers'),
+                          data.get('fetched_at'))
+
+
+def save(path, snapshot):
+    """Atomically write snapshot to path."""
+    raw = dumps(snapshot)
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.rbdsnap-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def load(path):
+    """Read a snapshot from path.
+
+    Returns None if the file doesn't exist or can't be read, as a bad
+    snapshot should never prevent the client from starting.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return loads(f.read())
+    except (IOError, OSError):
+        return None
+    except Exception as ex:
+        LOG.warning("Ignoring unreadable config snapshot %(path)s: %(ex)s",
+                    {'path': path, 'ex': ex})
+        return None
+
+
+class SharedCache(object):
+    """A config snapshot shared by the processes of a host.
+
+    The snapshot is kept in a SQLite database, so that the workers of a
+    service don't each fetch the same config.  A snapshot younger than
+    max_age seconds is served as is.  When it is older, the first
+    process to notice takes a lease and fetches a new one, while the
+    others wait for it up to lease seconds.
+
+    The config holds the CHAP passwords, so the database is created
+    readable by its owner only, SQLite gives its -wal and -shm files the
+    same permissions.  The processes sharing it must run as the same
+    user.
+
+    :param path: The SQLite database file, created if needed
+    :param max_age: Seconds a snapshot is served without refetching it
+    :param lease: Seconds a process may take to fetch the config
+    :param sleep: The sleep used while waiting for another process
+    """
+
+    def __init__(self, path, max_age=5.0, lease=30.0, sleep=time.sleep,
+                 poll_interval=0.05):
+        self.path = path
+        self.max_age = max_age
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._sleep = sleep
+        self._local = threading.local()
+        # Create the file before SQLite does, with restricted permissions
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS snapshot ("
+                         "id INTEGER PRIMARY KEY CHECK (id = 1), "
+                         "fetched_at REAL, data BLOB, lease_until REAL)")
+            conn.execute("INSERT OR IGNORE INTO snapshot "
+                         "VALUES (1, 0, NULL, 0)")
+
+    def _connection(self):
+        # SQLite connections can't be shared by threads, nor inherited
+        # by a forked process.
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=self.lease,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = pid
+        return _Transaction(conn)
+
+    def _fresh(self, row, now):
+        fetched_at, data = row[0], row[1]
+        if data is not None and now - fetched_at < self.max_age:
+            return loads(bytes(data))
+        return None
+
+    def _try_lease(self):
+        """Return a fresh snapshot, True if we got the lease, or False."""
+        with self._connection() as conn:
+            now = time.time()
+            row = conn.execute("SELECT fetched_at, data, lease_until "
+                               "FROM snapshot WHERE id = 1").fetchone()
+            snap = self._fresh(row, now)
+            if snap is not None:
+                return snap
+            if row[2] > now:
+                return False
+            conn.execute("UPDATE snapshot SET lease_until = ? WHERE id = 1",
+                         (now + self.lease,))
+            return True
+
+    def get(self):
+        """Return the snapshot if it is fresh, None otherwise."""
+        with self._connection() as conn:
+            row = conn.execute("SELECT fetched_at, data FROM snapshot "
+                               "WHERE id = 1").fetchone()
+        return self._fresh(row, time.time())
+
+    def put(self, snapshot):
+        with self._connection() as conn:
+            conn.execute("UPDATE snapshot SET fetched_at = ?, data = ?, "
+                         "lease_until = 0 WHERE id = 1",
+                         (snapshot.fetched_at, dumps(snapshot)))
+
+    def _release(self):
+        with self._connection() as conn:
+            conn.execute("UPDATE snapshot SET lease_until = 0 WHERE id = 1")
+
+    def get_or_fetch(self, fetch):
+        """Return a fresh snapshot, calling fetch() for one if needed.
+
+        fetch() returns a new ConfigSnapshot.
+        """
+        deadline = time.monotonic() + self.lease
+        while True:
+            result = self._try_lease()
+            if result is True:
+                try:
+                    snap = fetch()
+                except Exception:
+                    self._release()
+                    raise
+                self.put(snap)
+                return snap
+            if result is not False:
+                return result
+            if time.monotonic() > deadline:
+                # The process holding the lease is stuck or died
+                return fetch()
+            self._sleep(self.poll_interval)
+
+
+class _Transaction(object):
+    """BEGIN IMMEDIATE ... COMMIT, or ROLLBACK on error."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
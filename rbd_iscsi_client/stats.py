@@ -0,0 +1,77 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Latency statistics
+
+.. module: stats
+
+:Description: Small helpers to summarize request latencies.
+"""
+
+import math
+
+
+def percentile(values, pct):
+    """Return the pct percentile of values (nearest rank).
+
+    values must be sorted.  Returns None for an empty sequence.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+
+def summarize(values, percentiles=(50, 90, 99)):
+    """Return a dict with count, min, max, mean and the percentiles."""
+    values = sorted(values)
+    summary = {'count': len(values),
+               'min': values[0] if values else None,
+               'max': values[-1] if values else None,
+               'mean': sum(values) / len(values) if values else None}
+    for pct in percentiles:
+        summary['p%s' % pct] = percentile(values, pct)
+    return summary
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets.
+
+    The bucket upper bounds start at min_value seconds and grow by
+    factor, so a few dozen buckets cover microseconds to minutes.
+    The raw samples are kept too, for exact percentiles.
+    """
+
+    def __init__(self, min_value=0.0001, factor=2.0, buckets=24):
+        self.bounds = [min_value * factor ** i for i in range(buckets)]
+        self.counts = [0] * (buckets + 1)
+        self.samples = []
+
+    def add(self, value):
+        self.samples.append(value)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def summary(self, percentiles=(50, 90, 99)):
+        return summarize(self.samples, percentiles)
+
+    def buckets(self):
+        """Return (upper bound, count) of the non empty buckets.
+
+        The bound of the overflow bucket is None.
+        """
+        bounds = self.bounds + [None]
+        return [(bound, count) for bound, count in zip(bounds, self.counts)
+                if count]
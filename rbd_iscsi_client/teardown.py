@@ -0,0 +1,210 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Volume teardown pipeline
+
+.. module: teardown
+
+:Description: Removes many disks from the gateways.  Each disk is
+unexported from every client, unregistered from every target and
+deleted, the steps being computed from one /api/config document.  The
+disks stream through one bounded worker pool per stage, so the unexports
+of a disk overlap with the deletion of the previous ones, and only a
+bounded number of disks are in flight at any time.
+"""
+
+import collections
+from concurrent import futures
+
+from rbd_iscsi_client import cancel
+from rbd_iscsi_client import parallel
+from rbd_iscsi_client import reconcile
+
+# The stages of a teardown, in order
+STAGES = ('unexport', 'unregister', 'delete')
+
+DEFAULT_WORKERS = 8
+
+
+class Outcome(collections.namedtuple('Outcome',
+                                     ['key', 'results', 'error'])):
+    """The outcome of the teardown of one disk.
+
+    key is the disk as it was given, results the parallel.Result of
+    each step that ran and error the exception of the first step that
+    failed, after which the later stages of the disk were not run.
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def steps(config, disk, preserve_image=True, delete=True):
+    """Return the [(stage, [Step, ...]), ...] removing a disk.
+
+    disk is 'pool/image' or a (pool, image) tuple.  The steps of a stage
+    don't depend on each other.
+    """
+    config = config or {}
+    name, pool, image = reconcile.split_disk(disk)
+    unexport = []
+    unregister = []
+    for target_iqn, target in sorted((config.get('targets') or {}).items()):
+        for client_iqn, client in sorted(
+                (target.get('clients') or {}).items()):
+            if name in reconcile._names(client.get('luns')):
+                unexport.append(reconcile.Step(
+                    'unexport_disk', (target_iqn, client_iqn, pool, image)))
+        if name in reconcile._names(target.get('disks')):
+            unregister.append(reconcile.Step(
+                'unregister_disk', (target_iqn, name)))
+    remove = []
+    if delete and name in reconcile._names(config.get('disks')):
+        remove.append(reconcile.Step('delete_disk',
+                                     (pool, image, preserve_image)))
+    return list(zip(STAGES, (unexport, unregister, remove)))
+
+
+class _Item(object):
+
+    def __init__(self, key, stages):
+        self.key = key
+        self.stages = collections.deque(
+            (stage, stage_steps) for stage, stage_steps in stages
+            if stage_steps)
+        self.pending = 0
+        self.results = []
+        self.error = None
+
+    def outcome(self):
+        return Outcome(self.key, self.results, self.error)
+
+
+def teardown(client, disks, config=None, preserve_image=True, delete=True,
+             workers=None, max_inflight=None):
+    """Tear down disks, yielding an Outcome per disk as it completes.
+
+    :param client: The RBDISCSIClient
+    :param disks: Iterable of 'pool/image' or (pool, image), consumed
+                  lazily
+    :param config: The /api/config document, fetched once if not given
+    :param preserve_image: Passed to delete_disk()
+    :param delete: Delete the disks from the gateway, not only unexport
+                   and unregister them
+    :param workers: Dict of stage to its number of workers, each stage
+                    has DEFAULT_WORKERS by default
+    :param max_inflight: Number of disks in the pipeline at once,
+                         twice the number of workers by default
+
+    The steps run under the cancel.scope() of the caller.  Once its token
+    is cancelled no more disks are taken, the steps of the disks in the
+    pipeline fail with Cancelled, and Cancelled or DeadlineExceeded is
+    raised after their outcomes if disks were left.
+    """
+    if config is None:
+        resp, config = client.get_config()
+    workers = dict((stage, (workers or {}).get(stage, DEFAULT_WORKERS))
+                   for stage in STAGES)
+    if max_inflight is None:
+        max_inflight = 2 * sum(workers.values())
+
+    executors = dict((stage, futures.ThreadPoolExecutor(
+        max_workers=workers[stage],
+        thread_name_prefix='rbd-iscsi-%s' % stage)) for stage in STAGES)
+    waiting = dict((stage, collections.deque()) for stage in STAGES)
+    running = dict((stage, 0) for stage in STAGES)
+    pending = {}
+    done_items = collections.deque()
+    disks = iter(disks)
+    exhausted = False
+    stopped = False
+    inflight = 0
+    token = cancel.current()
+
+    @cancel.propagate
+    def _run(step):
+        return getattr(client, step.action)(*step.args)
+
+    def _advance(item):
+        if item.error is None and item.stages:
+            waiting[item.stages[0][0]].append(item)
+        else:
+            done_items.append(item)
+
+    def _dispatch(stage):
+        # A stage only takes the next disk when it has a free worker,
+        # the others wait in its queue: that is the backpressure.
+        while waiting[stage] and running[stage] < workers[stage]:
+            item = waiting[stage].popleft()
+            dummy, stage_steps = item.stages.popleft()
+            for step in stage_steps:
+                future = executors[stage].submit(_run, step)
+                pending[future] = (item, stage, step)
+            item.pending = len(stage_steps)
+            running[stage] += len(stage_steps)
+
+    try:
+        while True:
+            while not exhausted and inflight < max_inflight:
+                key = next(disks, None)
+                if key is None:
+                    exhausted = True
+                    break
+                if token is not None and token.cancelled:
+                    exhausted = stopped = True
+                    break
+                inflight += 1
+                try:
+                    item = _Item(key, steps(config, key, preserve_image,
+                                            delete))
+                except ValueError as ex:
+                    item = _Item(key, ())
+                    item.error = ex
+                _advance(item)
+            for stage in STAGES:
+                _dispatch(stage)
+
+            while done_items:
+                inflight -= 1
+                yield done_items.popleft().outcome()
+            if not pending:
+                if exhausted and inflight == 0:
+                    break
+                continue
+
+            done, dummy = futures.wait(pending,
+                                       return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                item, stage, step = pending.pop(future)
+                running[stage] -= 1
+                item.pending -= 1
+                try:
+                    resp, body = future.result()
+                except Exception as ex:
+                    item.results.append(
+                        parallel.Result(step, None, None, ex))
+                    if item.error is None:
+                        item.error = ex
+                else:
+                    item.results.append(
+                        parallel.Result(step, resp, body, None))
+                if not item.pending:
+                    _advance(item)
+    finally:
+        for future in pending:
+            future.cancel()
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+    if stopped:
+        token.check()
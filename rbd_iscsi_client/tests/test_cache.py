@@ -0,0 +1,129 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.cache`."""
+
+import unittest
+
+from rbd_iscsi_client import cache
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client.tests import utils
+
+
+class TestDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = utils.FakeClock()
+        self.cache = cache.DiskCache(maxsize=2, ttl=60, negative_ttl=5,
+                                     clock=self.clock)
+
+    def test_ttls(self):
+        self.cache.put(('rbd', 'a'), 'found')
+        self.cache.put_missing(('rbd', 'b'))
+        self.assertEqual('found', self.cache.get(('rbd', 'a')))
+        self.assertIs(cache.MISSING, self.cache.get(('rbd', 'b')))
+        self.clock.now = 10
+        self.assertEqual('found', self.cache.get(('rbd', 'a')))
+        self.assertIsNone(self.cache.get(('rbd', 'b')))
+        self.clock.now = 100
+        self.assertIsNone(self.cache.get(('rbd', 'a')))
+
+    def test_lru(self):
+        self.cache.put(('rbd', 'a'), 'a')
+        self.cache.put(('rbd', 'b'), 'b')
+        self.cache.get(('rbd', 'a'))
+        self.cache.put(('rbd', 'c'), 'c')
+        self.assertEqual(2, len(self.cache))
+        self.assertIsNone(self.cache.get(('rbd', 'b')))
+        self.assertEqual('a', self.cache.get(('rbd', 'a')))
+
+    def test_known(self):
+        self.cache.put_missing(('rbd', 'a'))
+        self.cache.set_known([('rbd', 'a')])
+        self.assertIsNone(self.cache.get(('rbd', 'a')))
+        self.assertIs(cache.MISSING, self.cache.get(('rbd', 'b')))
+        self.cache.invalidate(('rbd', 'b'), exists=True)
+        self.assertIsNone(self.cache.get(('rbd', 'b')))
+        self.cache.invalidate(('rbd', 'a'), exists=False)
+        self.assertIs(cache.MISSING, self.cache.get(('rbd', 'a')))
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get(('rbd', 'c')))
+
+    def test_stale_listing_is_ignored(self):
+        generation = self.cache.generation
+        self.cache.invalidate(('rbd', 'a'), exists=True)
+        self.cache.set_known([], generation)
+        self.assertIsNone(self.cache.get(('rbd', 'a')))
+
+
+class TestClientDiskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.cl = utils.fake_client(self.gateway, disk_cache=True)
+        self.cl.create_disk('rbd', 'volume-1')
+
+    def test_hit_returns_the_response_of_a_miss(self):
+        miss, disk = self.cl.find_disk('rbd', 'volume-1')
+        hit, disk = self.cl.find_disk('rbd', 'volume-1')
+        self.assertEqual(1, self.cl.metrics.get('disk_cache_hits'))
+        self.assertIs(type(miss), type(hit))
+        self.assertEqual(200, miss.status)
+        self.assertEqual(200, hit.status)
+        self.assertEqual(miss['Content-Type'], hit['content-type'])
+        hit['status'] = '500'
+        self.assertEqual('200', self.cl.find_disk('rbd', 'volume-1')[0]
+                         ['status'])
+
+    def test_find_disk_is_cached(self):
+        resp, disk = self.cl.find_disk('rbd', 'volume-1')
+        requests = self.gateway.requests
+        disk['image'] = 'changed'
+        resp, disk = self.cl.find_disk('rbd', 'volume-1')
+        self.assertEqual('volume-1', disk['image'])
+        self.assertEqual(requests, self.gateway.requests)
+        self.assertEqual(1, self.cl.metrics.get('disk_cache_hits'))
+
+        self.cl.create_target_iqn('iqn.t')
+        self.cl.register_disk('iqn.t', 'rbd/volume-1')
+        requests = self.gateway.requests
+        self.cl.find_disk('rbd', 'volume-1')
+        self.assertEqual(requests + 1, self.gateway.requests)
+
+        self.cl.unregister_disk('iqn.t', 'rbd/volume-1')
+        self.cl.delete_disk('rbd', 'volume-1')
+        self.assertRaises(exceptions.HTTPNotFound, self.cl.find_disk,
+                          'rbd', 'volume-1')
+
+    def test_negative_entries(self):
+        self.assertRaises(exceptions.HTTPNotFound, self.cl.find_disk,
+                          'rbd', 'volume-2')
+        requests = self.gateway.requests
+        self.assertRaises(exceptions.HTTPNotFound, self.cl.find_disk,
+                          'rbd', 'volume-2')
+        self.assertEqual(requests, self.gateway.requests)
+
+        self.cl.create_disk('rbd', 'volume-2')
+        resp, disk = self.cl.find_disk('rbd', 'volume-2')
+        self.assertEqual('volume-2', disk['image'])
+
+    def test_populated_from_listings(self):
+        self.cl.get_disks()
+        requests = self.gateway.requests
+        for i in range(10):
+            self.assertRaises(exceptions.HTTPNotFound, self.cl.find_disk,
+                              'rbd', 'other-%d' % i)
+        self.assertEqual(requests, self.gateway.requests)
+
+        self.cl.get_config()
+        self.cl.find_disk('rbd', 'volume-1')
+        self.assertEqual(requests + 2, self.gateway.requests)
@@ -0,0 +1,227 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.cancel`."""
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import cancel
+from rbd_iscsi_client import client
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import parallel
+from rbd_iscsi_client import throttle
+from rbd_iscsi_client.tests import utils
+
+import requests
+
+
+class TestCancelToken(unittest.TestCase):
+
+    def test_deadline(self):
+        clock = utils.FakeClock()
+        token = cancel.CancelToken(timeout=10, clock=clock)
+        self.assertEqual(10, token.remaining())
+        self.assertEqual(10, token.timeout(60))
+        self.assertEqual(10, token.timeout(None))
+        clock.now = 4
+        self.assertEqual(1, token.timeout(1))
+        token.check()
+        clock.now = 10
+        self.assertTrue(token.cancelled)
+        self.assertRaises(exceptions.DeadlineExceeded, token.check)
+
+        token = cancel.CancelToken(clock=clock)
+        self.assertIsNone(token.remaining())
+        self.assertEqual(60, token.timeout(60))
+
+    def test_cancel_propagates_to_children(self):
+        clock = utils.FakeClock()
+        parent = cancel.CancelToken(timeout=5, clock=clock)
+        child = cancel.CancelToken(timeout=10, parent=parent, clock=clock)
+        self.assertEqual(5, child.deadline)
+        parent.cancel('abandoned')
+        self.assertTrue(child.cancelled)
+        self.assertRaisesRegex(exceptions.Cancelled, 'abandoned',
+                               child.check)
+        late = cancel.CancelToken(parent=parent)
+        self.assertTrue(late.cancelled)
+
+    def test_sleep_interrupted(self):
+        token = cancel.CancelToken()
+        timer = threading.Timer(0.05, token.cancel)
+        timer.start()
+        start = time.monotonic()
+        self.assertRaises(exceptions.Cancelled, token.sleep, 5)
+        self.assertLess(time.monotonic() - start, 2)
+        timer.join()
+
+        token = cancel.CancelToken(timeout=1)
+        self.assertRaises(exceptions.DeadlineExceeded, token.sleep, 5)
+
+    def test_scopes(self):
+        self.assertIsNone(cancel.current())
+        with cancel.scope(timeout=30) as outer:
+            self.assertIs(outer, cancel.current())
+            with cancel.scope(timeout=10) as inner:
+                self.assertIs(outer, inner.parent)
+                with cancel.shield():
+                    self.assertIsNone(cancel.current())
+                self.assertIs(inner, cancel.current())
+            self.assertIs(outer, cancel.current())
+        self.assertIsNone(cancel.current())
+
+
+class TestClientCancel(unittest.TestCase):
+
+    def _client(self, status_code=503):
+        transport = mock.Mock()
+        transport.request.return_value = mock.Mock(
+            status_code=status_code, text='',
+            headers=requests.structures.CaseInsensitiveDict())
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   transport=transport)
+        return cl, transport
+
+    def test_backoff_sleep_cancelled(self):
+        cl, transport = self._client()
+        cl.delay = 10
+        with cancel.scope() as token:
+            timer = threading.Timer(0.05, token.cancel)
+            timer.start()
+            start = time.monotonic()
+            self.assertRaises(exceptions.Cancelled, cl.get_api)
+        self.assertLess(time.monotonic() - start, 2)
+        timer.join()
+        self.assertEqual(0, transport.request.call_count)
+
+    def test_backoff_sleep_green(self):
+        cl, transport = self._client()
+        cl.delay = 10
+        cl.runtime = mock.Mock(name='runtime')
+        cl.runtime.name = 'gevent'
+        with cancel.scope() as token:
+            # The green sleep is used, and the token checked in between
+            cl.runtime.sleep.side_effect = (
+                lambda seconds: cl.runtime.sleep.call_count == 3 and
+                token.cancel())
+            with mock.patch.object(token._event, 'wait') as wait:
+                self.assertRaises(exceptions.Cancelled, cl.get_api)
+        self.assertFalse(wait.called)
+        self.assertEqual([mock.call(cancel.POLL_INTERVAL)] * 3,
+                         cl.runtime.sleep.call_args_list)
+        self.assertEqual(0, transport.request.call_count)
+
+    def test_deadline_stops_retries(self):
+        cl, transport = self._client()
+        with cancel.scope(timeout=0.5):
+            self.assertRaises(exceptions.DeadlineExceeded, cl.get_api)
+        # The first backoff sleep would go past the deadline
+        self.assertEqual(1, transport.request.call_count)
+
+    def test_timeout_capped(self):
+        cl, transport = self._client(status_code=200)
+        with cancel.scope(timeout=5):
+            cl.get_api()
+        self.assertLessEqual(transport.request.call_args[1]['timeout'], 5)
+        cl.get_api()
+        self.assertIsNone(transport.request.call_args[1]['timeout'])
+
+    def test_rate_limiter_wait(self):
+        cl, transport = self._client(status_code=200)
+        cl.rate_limiter = throttle.PriorityRateLimiter(0.2)
+        cl.get_targets()
+        start = time.monotonic()
+        with cancel.scope(timeout=0.2):
+            self.assertRaises(exceptions.DeadlineExceeded, cl.get_targets)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(1, transport.request.call_count)
+
+    def test_concurrency_limiter_wait(self):
+        cl, transport = self._client(status_code=200)
+        cl.adaptive_concurrency = {'initial_limit': 1}
+        limiter = cl._concurrency_limiter('http://gw:5000')
+        limiter.acquire()
+        self.addCleanup(limiter.release, 0, throttle.OUTCOME_IGNORE)
+        with cancel.scope() as token:
+            timer = threading.Timer(0.05, token.cancel)
+            timer.start()
+            start = time.monotonic()
+            self.assertRaises(exceptions.Cancelled, cl.get_api)
+        self.assertLess(time.monotonic() - start, 2)
+        timer.join()
+        self.assertEqual(0, transport.request.call_count)
+
+    def test_expired_deadline_not_sent(self):
+        cl, transport = self._client(status_code=200)
+        token = mock.Mock()
+        # The deadline passes between the check and the timeout
+        token.timeout.return_value = 0.0
+        self.assertRaises(exceptions.DeadlineExceeded, cl.get, '/api',
+                          cancel=token)
+        self.assertEqual(0, transport.request.call_count)
+
+    def test_cancel_keyword(self):
+        cl, transport = self._client(status_code=200)
+        token = cancel.CancelToken()
+        token.cancel()
+        self.assertRaises(exceptions.Cancelled, cl.get, '/api',
+                          cancel=token)
+        self.assertEqual(0, transport.request.call_count)
+
+    def test_rollback_is_shielded(self):
+        token = cancel.CancelToken()
+
+        def _abandon(gateway, data, target_iqn):
+            # The operation is abandoned while the gateway is busy
+            token.cancel()
+            return 503, {'message': 'busy'}
+
+        with mock.patch.object(fake.FakeGateway, '_register_disk', _abandon):
+            gateway = fake.FakeGateway()
+        cl = utils.fake_client(gateway)
+        with cancel.scope(token):
+            self.assertRaises(exceptions.Cancelled, cl.run_transaction,
+                              [('create_disk', ('rbd', 'vol1')),
+                               ('register_disk', ('iqn', 'rbd/vol1'))])
+        self.assertEqual({}, gateway.config['disks'])
+
+
+class TestFanOutCancel(unittest.TestCase):
+
+    def test_stops_taking_keys(self):
+        calls = []
+
+        def _call(key):
+            calls.append(key)
+            self.assertIs(token, cancel.current())
+            if key == 0:
+                token.cancel()
+            return None, key
+
+        results = []
+        with cancel.scope() as token:
+            with self.assertRaises(exceptions.Cancelled):
+                for result in parallel.fan_out(_call, range(10),
+                                               max_workers=1):
+                    results.append(result)
+        self.assertEqual([0], calls)
+        self.assertEqual([0], [r.key for r in results])
+
+    def test_completed_batch_does_not_raise(self):
+        with cancel.scope() as token:
+            results = list(parallel.fan_out(lambda key: (None, key),
+                                            range(3)))
+            token.cancel()
+        self.assertEqual(3, len(results))
@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.chap`."""
+
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import chap
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client.tests import utils
+
+
+class TestRotate(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.client = utils.fake_client(self.gateway)
+        self.client.create_target_iqn(self.TARGET)
+        self.clients = ['iqn.1994-05.com.redhat:client%d' % i
+                        for i in range(20)]
+        for client_iqn in self.clients:
+            self.client.create_client(self.TARGET, client_iqn)
+
+    def _credentials(self, client_iqn):
+        return 'user-' + client_iqn[-1], 'secret-' + client_iqn
+
+    def _auth(self, client_iqn):
+        return (self.gateway.config['targets'][self.TARGET]['clients']
+                [client_iqn]['auth'])
+
+    def test_rotate_every_client(self):
+        with mock.patch.object(self.client, 'get_client_info',
+                               wraps=self.client.get_client_info) as info:
+            rotations = list(self.client.rotate_client_auth(
+                self.TARGET, self._credentials, max_workers=4))
+
+        self.assertEqual(sorted(self.clients),
+                         sorted(r.client_iqn for r in rotations))
+        self.assertTrue(all(r.ok for r in rotations))
+        self.assertTrue(all(r.elapsed >= 0 for r in rotations))
+        self.assertEqual(20, info.call_count)
+        for rotation in rotations:
+            auth = self._auth(rotation.client_iqn)
+            self.assertEqual(rotation.username, auth['username'])
+            self.assertEqual('secret-' + rotation.client_iqn,
+                             auth['password'])
+
+    def test_failures_are_reported(self):
+        missing = 'iqn.1994-05.com.redhat:missing'
+        failing = self.clients[0]
+
+        def _credentials(client_iqn):
+            if client_iqn == failing:
+                raise ValueError("no secret")
+            return self._credentials(client_iqn)
+
+        rotations = dict(
+            (r.client_iqn, r) for r in chap.rotate(
+                self.client, self.TARGET, _credentials,
+                clients=[failing, missing, self.clients[1]], verify=False))
+
+        self.assertIsInstance(rotations[failing].error, ValueError)
+        self.assertIsNone(rotations[failing].username)
+        self.assertIsInstance(rotations[missing].error,
+                              exceptions.HTTPNotFound)
+        self.assertTrue(rotations[self.clients[1]].ok)
+        self.assertEqual('', self._auth(failing)['username'])
+
+    def test_rate(self):
+        with mock.patch.object(chap.throttle,
+                               'PriorityRateLimiter') as limiter:
+            list(self.client.rotate_client_auth(self.TARGET,
+                                                self._credentials,
+                                                rate=100))
+        limiter.assert_called_once_with(100)
+        self.assertEqual(20, limiter.return_value.acquire.call_count)
@@ -0,0 +1,127 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.cli`."""
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import cli
+from rbd_iscsi_client import client
+from rbd_iscsi_client import fake
+
+
+class TestCli(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT = 'iqn.1994-05.com.redhat:client1'
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.tmpdir = tempfile.mkdtemp()
+
+        def _client(args, url):
+            return client.RBDISCSIClient(
+                args.username, args.password, url,
+                transport=fake.FakeTransport(self.gateway))
+
+        patcher = mock.patch.object(cli, '_client', side_effect=_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        cl = _client(mock.Mock(), 'http://gw:5000')
+        cl.create_target_iqn(self.TARGET)
+        cl.create_client(self.TARGET, self.CLIENT)
+        for image in ('vol1', 'vol2'):
+            cl.create_disk('rbd', image)
+            cl.register_disk(self.TARGET, 'rbd/%s' % image)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, *argv):
+        out = io.StringIO()
+        status = cli.main(['--url', 'http://gw:5000'] + list(argv), out=out)
+        return status, out.getvalue()
+
+    def test_dump_disks_table(self):
+        status, out = self._run('dump', 'disks')
+        self.assertEqual(0, status)
+        lines = out.splitlines()
+        self.assertTrue(lines[0].startswith('DISK'))
+        self.assertEqual(['rbd/vol1', 'rbd/vol2'],
+                         [line.split()[0] for line in lines[1:]])
+
+    def test_dump_config_json(self):
+        status, out = self._run('dump', 'config', '--format', 'json')
+        self.assertEqual(0, status)
+        self.assertIn(self.TARGET, json.loads(out)['targets'])
+
+    def test_dump_targets_table(self):
+        status, out = self._run('dump', 'targets')
+        self.assertEqual(0, status)
+        self.assertEqual([self.TARGET, '2', '1', '0'],
+                         out.splitlines()[1].split())
+
+    def test_bulk_export_unexport(self):
+        path = os.path.join(self.tmpdir, 'mappings.csv')
+        with open(path, 'w') as f:
+            f.write("target_iqn,client_iqn,pool,image\n")
+            for image in ('vol1', 'vol2', 'missing'):
+                f.write("%s,%s,rbd,%s\n" % (self.TARGET, self.CLIENT, image))
+
+        status, out = self._run('export', '--csv', path)
+        self.assertEqual(1, status)
+        lines = sorted(out.splitlines())
+        self.assertIn('rbd/missing FAILED', lines[0])
+        self.assertTrue(lines[1].endswith('rbd/vol1 ok'))
+        luns = self.gateway.config['targets'][self.TARGET]['clients'][
+            self.CLIENT]['luns']
+        self.assertEqual(['rbd/vol1', 'rbd/vol2'], sorted(luns))
+
+        status, out = self._run('unexport', '--csv', path)
+        self.assertEqual({}, luns)
+
+    def test_bulk_bad_csv(self):
+        path = os.path.join(self.tmpdir, 'bad.csv')
+        with open(path, 'w') as f:
+            f.write("target_iqn,pool\n")
+        with mock.patch('sys.stderr', new_callable=io.StringIO) as err:
+            status, out = self._run('export', '--csv', path)
+        self.assertEqual(1, status)
+        self.assertIn('client_iqn', err.getvalue())
+
+    def test_probe(self):
+        status, out = self._run('probe', '--count', '3')
+        self.assertEqual(0, status)
+        lines = out.splitlines()
+        self.assertEqual(len(cli.PROBE_ENDPOINTS) + 1, len(lines))
+        self.assertEqual('3', lines[1].split()[2])
+
+    def test_probe_isnt_retried(self):
+        calls = []
+
+        def _unavailable(gateway, data):
+            calls.append(data)
+            return 503, {'message': 'busy'}
+
+        with mock.patch.object(fake.FakeGateway, '_get_api', _unavailable):
+            self.gateway = fake.FakeGateway()
+        status, out = self._run('probe', '--count', '2')
+        self.assertEqual(2, len(calls))
+        row = [line.split() for line in out.splitlines()
+               if ' /api ' in line][0]
+        self.assertEqual(['0', '2'], row[2:4])
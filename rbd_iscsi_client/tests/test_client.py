@@ -111,3 +111,43 @@ class TestRbd_iscsi_client(unittest.TestCase):
         response, content = self.client.get_gatewayinfo()
         cs_mock.assert_called_with(fake_uri, 'GET')
         self.assertEqual(response, self.RESP_200)
+
+    @mock.patch.object(client.RBDISCSIClient, '_cs_request')
+    def test_get_all_client_info(self, cs_mock):
+        target_iqn = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+        clients = ['iqn.1994-05.com.redhat:client%d' % i for i in range(5)]
+
+        def _request(url, method, **kwargs):
+            if url.startswith('/api/clients/'):
+                return self.RESP_200, {'clients': clients}
+            if url.endswith('client3'):
+                raise client.exceptions.HTTPNotFound()
+            return self.RESP_200, {'alias': url.rsplit('/', 1)[-1]}
+
+        cs_mock.side_effect = _request
+        results = list(self.client.get_all_client_info(target_iqn))
+        self.assertEqual(sorted(r.key for r in results), sorted(clients))
+        failed = [r for r in results if not r.ok]
+        self.assertEqual(['iqn.1994-05.com.redhat:client3'],
+                         [r.key for r in failed])
+        self.assertIsInstance(failed[0].error,
+                              client.exceptions.HTTPNotFound)
+        for r in results:
+            if r.ok:
+                self.assertEqual(r.key.rsplit('/', 1)[-1], r.body['alias'])
+
+    @mock.patch.object(client.RBDISCSIClient, '_cs_request')
+    def test_get_all_target_info(self, cs_mock):
+        targets = ['iqn.2003-01.com.redhat.iscsi-gw:t1',
+                   'iqn.2003-01.com.redhat.iscsi-gw:t2']
+
+        def _request(url, method, **kwargs):
+            if url == '/api/targets':
+                return self.RESP_200, {'targets': targets}
+            return self.RESP_200, {'num_sessions': 1}
+
+        cs_mock.side_effect = _request
+        results = list(self.client.get_all_target_info(max_workers=1))
+        self.assertEqual(targets, [r.key for r in results])
+        self.assertTrue(all(r.ok for r in results))
+        cs_mock.assert_any_call('/api/targetinfo/%s' % targets[1], 'GET')
@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.dns`."""
+
+import socket
+import time
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import dns
+from rbd_iscsi_client.tests import utils
+
+
+def _info(family, address, port=5000):
+    if family == socket.AF_INET6:
+        sockaddr = (address, port, 0, 0)
+    else:
+        sockaddr = (address, port)
+    return (family, socket.SOCK_STREAM, socket.IPPROTO_TCP, '', sockaddr)
+
+
+class TestResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = utils.FakeClock()
+        self.getaddrinfo = mock.Mock(return_value=[
+            _info(socket.AF_INET6, '2001:db8::1'),
+            _info(socket.AF_INET6, '2001:db8::2'),
+            _info(socket.AF_INET, '10.0.0.1'),
+        ])
+        self.resolver = dns.Resolver(ttl=60, stale_ttl=300,
+                                     clock=self.clock,
+                                     getaddrinfo=self.getaddrinfo)
+
+    def test_families_interleaved(self):
+        infos = self.resolver.resolve('gw', 5000)
+        self.assertEqual(['2001:db8::1', '10.0.0.1', '2001:db8::2'],
+                         [info[4][0] for info in infos])
+
+    def test_cached_for_ttl(self):
+        self.resolver.resolve('gw', 5000)
+        self.clock.now = 59
+        self.resolver.resolve('gw', 5000)
+        self.assertEqual(1, self.getaddrinfo.call_count)
+        self.clock.now = 60
+        self.resolver.resolve('gw', 5000)
+        self.assertEqual(2, self.getaddrinfo.call_count)
+        self.resolver.forget('gw')
+        self.resolver.resolve('gw', 5000)
+        self.assertEqual(3, self.getaddrinfo.call_count)
+
+    def test_stale_on_failure(self):
+        expected = self.resolver.resolve('gw', 5000)
+        self.getaddrinfo.side_effect = socket.gaierror('no server')
+        self.clock.now = 100
+        self.assertEqual(expected, self.resolver.resolve('gw', 5000))
+        self.clock.now = 400
+        self.assertRaises(socket.gaierror, self.resolver.resolve,
+                          'gw', 5000)
+
+    def test_ip_literal_not_cached(self):
+        self.resolver.resolve('10.0.0.1', 5000)
+        self.assertEqual({}, self.resolver._entries)
+
+
+class TestConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.addCleanup(self.listener.close)
+        # A port nothing listens on
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        self.closed_port = closed.getsockname()[1]
+        closed.close()
+
+    def test_connects_to_first_answering(self):
+        infos = [_info(socket.AF_INET, '127.0.0.1', self.closed_port),
+                 _info(socket.AF_INET, '127.0.0.1',
+                       self.listener.getsockname()[1])]
+        start = time.monotonic()
+        sock = dns.connect(infos, timeout=5, delay=10)
+        self.addCleanup(sock.close)
+        # The refused attempt didn't wait for the delay
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.listener.getsockname(), sock.getpeername())
+        self.assertEqual(5, sock.gettimeout())
+
+    def test_all_refused(self):
+        infos = [_info(socket.AF_INET, '127.0.0.1', self.closed_port)]
+        self.assertRaises(ConnectionRefusedError, dns.connect, infos,
+                          timeout=5)
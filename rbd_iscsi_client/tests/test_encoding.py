@@ -0,0 +1,85 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.encoding`."""
+
+import json
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import encoding
+from rbd_iscsi_client.tests import utils
+
+import requests
+
+
+class TestBodyEncoder(unittest.TestCase):
+
+    def test_form_matches_requests(self):
+        encoder = encoding.BodyEncoder()
+        payloads = [
+            {'disk': 'rbd/volume-1', 'client_iqn': 'iqn.1994-05.com:c1'},
+            {'pool': 'rbd', 'image': 'a b&c=d', 'mode': 'create',
+             'size': 1024},
+            {'preserve_image': 'true'},
+        ]
+        for payload in payloads:
+            expected = requests.models.RequestEncodingMixin._encode_params(
+                payload)
+            self.assertEqual(expected, encoder.encode(payload))
+
+    def test_template_reused(self):
+        encoder = encoding.BodyEncoder()
+        encoder.encode({'disk': 'rbd/v1'})
+        template = encoder.template(('disk',))
+        encoder.encode({'disk': 'rbd/v2'})
+        self.assertIs(template, encoder.template(('disk',)))
+
+    def test_non_scalar_values_not_encoded(self):
+        encoder = encoding.BodyEncoder()
+        self.assertIsNone(encoder.encode({'controls': {'a': 1}}))
+
+    def test_json(self):
+        encoder = encoding.BodyEncoder(use_json=True)
+        self.assertEqual(encoding.JSON_CONTENT_TYPE, encoder.content_type)
+        self.assertEqual({'disk': 'rbd/v1'},
+                         json.loads(encoder.encode({'disk': 'rbd/v1'})))
+
+
+class TestClientEncoding(unittest.TestCase):
+
+    def test_request_body_and_headers(self):
+        transport = mock.Mock()
+        transport.request.return_value = mock.Mock(
+            status_code=200, text='',
+            headers=requests.structures.CaseInsensitiveDict())
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   transport=transport)
+        cl.export_disk('iqn.t', 'iqn.c', 'rbd', 'vol1')
+        kwargs = transport.request.call_args[1]
+        self.assertEqual('disk=rbd%2Fvol1&client_iqn=iqn.c',
+                         kwargs['data'])
+        self.assertEqual({'User-Agent': cl.USER_AGENT,
+                          'Accept': 'application/json',
+                          'Content-Type': encoding.FORM_CONTENT_TYPE},
+                         kwargs['headers'])
+
+        cl.get_api()
+        kwargs = transport.request.call_args[1]
+        self.assertIsNone(kwargs['data'])
+        self.assertNotIn('Content-Type', kwargs['headers'])
+
+    def test_json_body_with_fake(self):
+        cl = utils.fake_client(json_body=True)
+        cl.create_disk('rbd', 'vol1', size='2G')
+        resp, disk = cl.find_disk('rbd', 'vol1')
+        self.assertEqual('2G', disk['size'])
@@ -48,3 +48,8 @@ class Test_exceptions(unittest.TestCase):
         self.assertEqual("Fake Error (HTTP 500) 999 - Fake Description - "
                          "Fake Ref (1: 'Fake Debug 1') (2: 'Fake Debug 2')",
                          output)
+
+    def test_002_gateway_unavailable_string_format(self):
+        ex = exceptions.GatewayUnavailable("gw1, gw2 are unhealthy")
+        self.assertEqual("No healthy gateway available - "
+                         "gw1, gw2 are unhealthy", str(ex))
@@ -0,0 +1,72 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.fake`."""
+
+import unittest
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client.tests import utils
+
+
+class TestFakeGateway(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT = 'iqn.1994-05.com.redhat:client1'
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway(credentials=('user', 'password'))
+        self.client = utils.fake_client(self.gateway)
+
+    def test_attach_detach(self):
+        cl = self.client
+        cl.create_target_iqn(self.TARGET)
+        cl.create_client(self.TARGET, self.CLIENT)
+        cl.set_client_auth(self.TARGET, self.CLIENT, 'chap', 'secret')
+        cl.create_disk('rbd', 'vol1', size='1G')
+        cl.register_disk(self.TARGET, 'rbd/vol1')
+        cl.export_disk(self.TARGET, self.CLIENT, 'rbd', 'vol1')
+
+        resp, config = cl.get_config()
+        self.assertEqual('200', resp['status'])
+        target = config['targets'][self.TARGET]
+        self.assertEqual({'rbd/vol1': {'lun_id': 0}},
+                         target['clients'][self.CLIENT]['luns'])
+        self.assertEqual('chap',
+                         target['clients'][self.CLIENT]['auth']['username'])
+        self.assertEqual(6, config['epoch'])
+
+        resp, disk = cl.find_disk('rbd', 'vol1')
+        self.assertEqual('gateway1', disk['owner'])
+        resp, body = cl.get_clients(self.TARGET)
+        self.assertEqual([self.CLIENT], body['clients'])
+
+        # The gateway refuses to delete a disk that is still in use
+        self.assertRaises(exceptions.HTTPBadRequest, cl.delete_disk,
+                          'rbd', 'vol1')
+
+        cl.unexport_disk(self.TARGET, self.CLIENT, 'rbd', 'vol1')
+        cl.unregister_disk(self.TARGET, 'rbd/vol1')
+        cl.delete_disk('rbd', 'vol1')
+        self.assertRaises(exceptions.HTTPNotFound, cl.find_disk,
+                          'rbd', 'vol1')
+
+    def test_unauthorized(self):
+        cl = client.RBDISCSIClient(
+            'user', 'wrong', 'http://gw:5000',
+            transport=fake.FakeTransport(self.gateway))
+        self.assertRaises(exceptions.HTTPUnauthorized, cl.get_api)
+
+    def test_unknown_endpoint(self):
+        self.assertRaises(exceptions.HTTPNotFound, self.client.get,
+                          '/api/bogus')
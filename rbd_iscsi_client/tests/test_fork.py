@@ -0,0 +1,122 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for the fork safety of `rbd_iscsi_client.client`."""
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import journal
+from rbd_iscsi_client import transport
+from rbd_iscsi_client.tests import utils
+
+
+class TestFork(unittest.TestCase):
+
+    def _client(self, **kwargs):
+        return utils.fake_client(
+            base_url=['http://gw1:5000', 'http://gw2:5000'], **kwargs)
+
+    def test_state_rebuilt_after_fork(self):
+        cl = self._client(hedging=True, disk_cache=True,
+                          adaptive_concurrency=True)
+        cl.transport.after_fork = mock.Mock()
+        cl.get_api()
+        cl.hedger._submit(lambda: None).result()
+        old_lock = cl._snapshot_lock
+        cl._revalidating = True
+
+        cl._check_fork()
+        self.assertIs(old_lock, cl._snapshot_lock)
+
+        with mock.patch.object(client, '_fork_generation',
+                               client._fork_generation + 1):
+            cl.get_api()
+            self.assertIsNot(old_lock, cl._snapshot_lock)
+            self.assertFalse(cl._revalidating)
+            self.assertIsNone(cl.hedger._executor)
+            cl.transport.after_fork.assert_called_once_with()
+            cl.get_api()
+            cl.transport.after_fork.assert_called_once_with()
+
+    def test_pid_checked_without_fork_hooks(self):
+        cl = self._client()
+        cl.transport.after_fork = mock.Mock()
+        with mock.patch.object(client, '_fork_id', lambda: os.getpid()):
+            cl._fork_generation = os.getpid()
+            cl.get_api()
+            cl.transport.after_fork.assert_not_called()
+            with mock.patch('os.getpid', return_value=os.getpid() + 1):
+                cl.get_api()
+            cl.transport.after_fork.assert_called_once_with()
+
+    def test_urllib3_pools_dropped(self):
+        tr = transport.Urllib3Transport()
+        manager = tr._manager(True)
+        tr.after_fork()
+        self.assertIsNot(manager, tr._manager(True))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_child_not_blocked_by_parent_locks(self):
+        cl = self._client()
+        # A lock held by another thread of the parent when it forks is
+        # held forever in the child.
+        with cl.metrics._lock:
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    cl.get_api()
+                    code = 0
+                finally:
+                    os._exit(code)
+
+        deadline = time.time() + 10
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if time.time() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                self.fail("The child process is deadlocked")
+            time.sleep(0.01)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(0, os.WEXITSTATUS(status))
+
+    @unittest.skipUnless(hasattr(os, 'fork') and journal.fcntl is not None,
+                         'needs fork and file locks')
+    def test_child_journal_of_its_own(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'journal')
+        cl = self._client(journal_file=path)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                cl.create_disk('rbd', 'volume-1')
+                if cl.journal.path == '%s.%d' % (path, os.getpid()):
+                    code = 0
+            finally:
+                os._exit(code)
+        done, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertEqual(path, cl.journal.path)
+        with open(path) as f:
+            self.assertEqual('', f.read())
+        self.assertTrue(os.path.exists('%s.%d' % (path, pid)))
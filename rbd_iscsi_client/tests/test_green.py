@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.green`."""
+
+import sys
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import green
+
+
+def _fake_eventlet(patched=True):
+    eventlet = mock.Mock()
+    eventlet.patcher.is_monkey_patched.return_value = patched
+    eventlet.tpool.execute.side_effect = lambda func, *args: func(*args)
+    return {'eventlet': eventlet,
+            'eventlet.patcher': eventlet.patcher,
+            'eventlet.tpool': eventlet.tpool}
+
+
+def _fake_gevent(patched=True):
+    gevent = mock.Mock()
+    gevent.monkey.is_module_patched.return_value = patched
+    gevent.get_hub.return_value.threadpool.apply.side_effect = (
+        lambda func, args: func(*args))
+    return {'gevent': gevent, 'gevent.monkey': gevent.monkey}
+
+
+class TestDetect(unittest.TestCase):
+
+    def test_native(self):
+        with mock.patch.dict(sys.modules, _fake_eventlet(patched=False)):
+            self.assertIsNone(green.detect())
+            runtime = green.get_runtime()
+        self.assertIsNone(runtime.name)
+        self.assertFalse(runtime.should_offload(10 ** 9))
+        self.assertEqual(3, runtime.offload(len, 'abc'))
+
+    def test_eventlet(self):
+        modules = _fake_eventlet()
+        with mock.patch.dict(sys.modules, modules):
+            self.assertEqual(green.EVENTLET, green.detect())
+            runtime = green.get_runtime()
+        self.assertEqual(green.EVENTLET, runtime.name)
+        runtime.sleep(2)
+        modules['eventlet'].sleep.assert_called_once_with(2)
+        self.assertEqual(3, runtime.offload(len, 'abc'))
+        modules['eventlet.tpool'].execute.assert_called_once_with(len, 'abc')
+
+    def test_gevent(self):
+        modules = _fake_gevent()
+        with mock.patch.dict(sys.modules, modules):
+            self.assertEqual(green.GEVENT, green.detect())
+            runtime = green.get_runtime()
+        runtime.sleep(2)
+        modules['gevent'].sleep.assert_called_once_with(2)
+        self.assertEqual(3, runtime.offload(len, 'abc'))
+
+    def test_forced_without_patching_warns(self):
+        with mock.patch.dict(sys.modules, _fake_eventlet(patched=False)):
+            with self.assertLogs('rbd_iscsi_client.green', 'WARNING'):
+                runtime = green.get_runtime(green.EVENTLET)
+        self.assertEqual(green.EVENTLET, runtime.name)
+        self.assertRaises(ValueError, green.get_runtime, 'asyncio')
+
+
+class TestClientGreen(unittest.TestCase):
+
+    def test_cooperative_retries_and_offload(self):
+        modules = _fake_eventlet()
+        with mock.patch.dict(sys.modules, modules):
+            transport = fake.FakeTransport()
+            cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                       transport=transport)
+        cl.runtime.offload_threshold = 100
+        for i in range(10):
+            cl.create_disk('rbd', 'volume-%d' % i)
+        resp, body = cl.get_disks()
+        self.assertEqual(10, len(body['disks']))
+        self.assertEqual(1, modules['eventlet.tpool'].execute.call_count)
+
+        cl.tries = 2
+        with mock.patch.object(transport.gateway, 'handle',
+                               return_value=(503, {'message': 'busy'})):
+            self.assertRaises(exceptions.HTTPServiceUnavailable,
+                              cl.get_api)
+        modules['eventlet'].sleep.assert_called_once_with(1)
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.health`."""
+
+import time
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import health
+from rbd_iscsi_client.tests import utils
+
+GW1 = 'http://gw1:5000'
+GW2 = 'http://gw2:5000'
+GW3 = 'http://gw3:5000'
+
+
+class PartlyDownTransport(fake.FakeTransport):
+    """Fails every request sent to one of the gateways."""
+
+    def __init__(self, down):
+        super(PartlyDownTransport, self).__init__()
+        self.down = down
+        self.urls = []
+
+    def request(self, method, url, **kwargs):
+        self.urls.append(url)
+        if url.startswith(self.down):
+            raise ConnectionError("connection refused")
+        return super(PartlyDownTransport, self).request(method, url,
+                                                        **kwargs)
+
+
+class DriftedTransport(fake.FakeTransport):
+    """Serves a different checkconf hash for one of the gateways."""
+
+    def __init__(self, drifted):
+        super(DriftedTransport, self).__init__()
+        self.drifted = drifted
+
+    def request(self, method, url, **kwargs):
+        r = super(DriftedTransport, self).request(method, url, **kwargs)
+        if url == self.drifted + '/api/sysinfo/checkconf':
+            r.text = '{"data": "0123456789abcdef0123456789abcdef"}'
+        return r
+
+
+class TestHealthMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = PartlyDownTransport(GW1)
+        self.cl = client.RBDISCSIClient(
+            'user', 'password', [GW1, GW2], transport=self.transport)
+        self.cl.retry_exceptions = (ConnectionError,)
+
+    def test_probe_all(self):
+        monitor = health.HealthMonitor(self.cl)
+        self.assertTrue(monitor.is_usable(GW1))
+        self.assertIsNone(monitor.status(GW1))
+
+        table = monitor.probe_all()
+        self.assertEqual([GW1, GW2], sorted(table))
+        self.assertFalse(table[GW1].healthy)
+        self.assertEqual(0, table[GW1].score)
+        self.assertIn('connection refused', table[GW1].error)
+        self.assertTrue(table[GW2].healthy)
+        self.assertEqual(health.MAX_SCORE, table[GW2].score)
+        self.assertEqual(0, table[GW2].sessions)
+        self.assertFalse(monitor.is_usable(GW1))
+        self.assertEqual(0, self.cl.metrics.get('health_score',
+                                                gateway=GW1))
+
+    @mock.patch.object(client, 'TIMES_KEPT', 5)
+    def test_request_times_bounded(self):
+        cl = utils.fake_client(base_url=[GW1, GW2])
+        monitor = health.HealthMonitor(cl)
+        for i in range(3):
+            monitor.probe_all()
+        self.assertEqual(5, len(cl.times))
+        self.assertEqual('GET %s/api/sysinfo/checkversions' % GW2,
+                         cl.times[-1][0])
+
+    @mock.patch.object(fake.FakeGateway, '_get_sys_info',
+                       return_value=(200, {'data': False}))
+    def test_failed_check_lowers_score(self, mock_sys_info):
+        self.cl.transport = PartlyDownTransport(GW1)
+        monitor = health.HealthMonitor(self.cl)
+        status = monitor.probe(GW2)
+        self.assertFalse(status.healthy)
+        self.assertEqual('config check failed', status.error)
+
+    def test_config_drift(self):
+        cl = client.RBDISCSIClient('user', 'password', [GW1, GW2, GW3],
+                                   transport=DriftedTransport(GW3))
+        monitor = health.HealthMonitor(cl)
+        # No majority yet, the hashes are tied
+        monitor.probe(GW3)
+        monitor.probe(GW1)
+        self.assertTrue(monitor.is_usable(GW3))
+        table = monitor.probe_all()
+        self.assertTrue(table[GW1].healthy)
+        self.assertTrue(table[GW2].healthy)
+        self.assertFalse(table[GW3].healthy)
+        self.assertEqual('config differs from the other gateways',
+                         table[GW3].error)
+        self.assertEqual(table[GW3].score,
+                         cl.metrics.get('health_score', gateway=GW3))
+
+        # The drift is fixed
+        cl.transport.drifted = 'http://none'
+        self.assertTrue(monitor.probe(GW3).healthy)
+
+    def test_client_routes_around_unhealthy_gateway(self):
+        self.cl.health_monitor = health.HealthMonitor(self.cl)
+        self.cl.health_monitor.probe_all()
+        del self.transport.urls[:]
+        self.cl.get_api()
+        self.assertEqual([GW2 + '/api'], self.transport.urls)
+
+    def test_client_refuses_work_without_healthy_gateway(self):
+        self.transport.down = 'http://'
+        self.cl.health_monitor = health.HealthMonitor(self.cl)
+        self.cl.health_monitor.probe_all()
+        self.assertRaises(exceptions.GatewayUnavailable, self.cl.get_api)
+
+    def test_background_thread(self):
+        monitor = self.cl.start_health_monitor(interval=0.01)
+        try:
+            deadline = time.time() + 5
+            while len(monitor.table()) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertFalse(monitor.is_usable(GW1))
+            self.assertTrue(monitor.is_usable(GW2))
+        finally:
+            self.cl.stop_health_monitor()
+        self.assertIsNone(self.cl.health_monitor)
+        self.assertIsNone(monitor._thread)
@@ -0,0 +1,145 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.hedge`."""
+
+import threading
+import time
+import unittest
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import hedge
+
+GW1 = 'http://gw1:5000'
+GW2 = 'http://gw2:5000'
+
+
+class StalledTransport(fake.FakeTransport):
+    """Holds the requests sent to one gateway until released."""
+
+    def __init__(self, stalled):
+        super(StalledTransport, self).__init__()
+        self.stalled = stalled
+        self.release = threading.Event()
+
+    def request(self, method, url, **kwargs):
+        if url.startswith(self.stalled):
+            self.release.wait(5)
+        return super(StalledTransport, self).request(method, url, **kwargs)
+
+
+class TestHedger(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def _stalled(self, gateway):
+        self.release.wait(5)
+        return gateway
+
+    def test_delay_follows_percentile(self):
+        hedger = hedge.Hedger(min_delay=0.001, max_delay=2.0, min_samples=10)
+        self.assertEqual(2.0, hedger.delay)
+        for i in range(95):
+            hedger.record(0.01)
+        for i in range(5):
+            hedger.record(1.5)
+        self.assertEqual(0.01, hedger.delay)
+        for i in range(100):
+            hedger.record(5)
+        self.assertEqual(2.0, hedger.delay)
+
+    def test_budget(self):
+        hedger = hedge.Hedger(budget=0.5, burst=1)
+        self.assertTrue(hedger.try_hedge())
+        self.assertFalse(hedger.try_hedge())
+        hedger._earn()
+        self.assertFalse(hedger.try_hedge())
+        hedger._earn()
+        self.assertTrue(hedger.try_hedge())
+
+    def test_fast_primary_isnt_hedged(self):
+        hedger = hedge.Hedger(max_delay=5)
+        self.assertEqual((GW1, GW1),
+                         hedger.run(lambda gw: gw, GW1, GW2))
+        self.assertEqual(5, hedger._tokens)
+
+    def test_queued_primary_isnt_hedged(self):
+        hedger = hedge.Hedger(max_delay=0.05, max_workers=1)
+        hedged = []
+        # The only thread is busy for longer than the hedge delay
+        busy = hedger._submit(time.sleep, 0.2)
+        self.assertEqual((GW1, GW1),
+                         hedger.run(lambda gw: gw, GW1, GW2,
+                                    hedge_call=hedged.append))
+        busy.result()
+        self.assertEqual([], hedged)
+        # The latency recorded doesn't include the time queued
+        self.assertLess(max(hedger._latencies), 0.1)
+
+    def test_saturated_pool_isnt_hedged(self):
+        hedger = hedge.Hedger(max_delay=0.01, max_workers=1)
+        hedged = []
+        timer = threading.Timer(0.1, self.release.set)
+        timer.start()
+        self.assertEqual((GW1, GW1),
+                         hedger.run(self._stalled, GW1, GW2,
+                                    hedge_call=hedged.append))
+        timer.join()
+        self.assertEqual([], hedged)
+        self.assertEqual(5, hedger._tokens)
+
+    def test_slow_primary_is_hedged(self):
+        hedger = hedge.Hedger(max_delay=0.01)
+        self.assertEqual((GW2, GW2),
+                         hedger.run(self._stalled, GW1, GW2,
+                                    hedge_call=lambda gw: gw))
+        hedger.shutdown()
+
+    def test_spent_budget_waits_for_primary(self):
+        hedger = hedge.Hedger(max_delay=0.01, burst=0)
+        threading.Timer(0.05, self.release.set).start()
+        self.assertEqual((GW1, GW1),
+                         hedger.run(self._stalled, GW1, GW2))
+
+    def test_both_fail(self):
+        def _fail(gateway):
+            self.release.wait(0.05)
+            raise ValueError(gateway)
+
+        hedger = hedge.Hedger(max_delay=0.01)
+        with self.assertRaisesRegex(ValueError, GW1):
+            hedger.run(_fail, GW1, GW2)
+
+
+class TestClientHedging(unittest.TestCase):
+
+    def test_find_disk_is_hedged(self):
+        transport = StalledTransport(GW1)
+        self.addCleanup(transport.release.set)
+        cl = client.RBDISCSIClient('user', 'password', [GW1, GW2],
+                                   transport=transport,
+                                   hedging={'max_delay': 0.01})
+        transport.gateway.handle('PUT', '/api/disk/rbd/volume-1',
+                                 {'mode': 'create'})
+
+        resp, disk = cl.find_disk('rbd', 'volume-1')
+        self.assertEqual('volume-1', disk['image'])
+        self.assertEqual(1, cl.metrics.get('hedges', gateway=GW2))
+        self.assertEqual(1, cl.metrics.get('hedge_wins', gateway=GW2))
+
+        # Writes are never hedged
+        transport.release.set()
+        cl.create_disk('rbd', 'volume-2')
+        self.assertEqual(1, cl.metrics.get('hedges', gateway=GW2))
+        cl.hedger.shutdown()
@@ -0,0 +1,92 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Import time benchmark of `rbd_iscsi_client`.
+
+The imports run in a fresh interpreter, since the test process already
+has everything imported.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from rbd_iscsi_client import lazy
+
+# Modules that must not be imported by importing the client.
+HEAVY_MODULES = ('pbr', 'requests', 'urllib3', 'msgpack', 'oslo_i18n',
+                 'pyarrow')
+
+# Generous upper bound of the import time of the client, in seconds.  It
+# takes a few tens of milliseconds, importing requests alone takes more.
+IMPORT_BUDGET = 0.5
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import rbd_iscsi_client.client
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed,
+                  'loaded': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+class TestImport(unittest.TestCase):
+
+    def _run(self, script):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=root)
+        out = subprocess.check_output([sys.executable, '-c', script],
+                                      env=env)
+        return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+    def test_client_import_is_lazy(self):
+        result = self._run(SCRIPT)
+        self.assertEqual([], result['loaded'])
+        self.assertLess(result['elapsed'], IMPORT_BUDGET)
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     'module __getattr__ needs Python 3.7')
+    def test_version_resolved_on_access(self):
+        result = self._run(
+            "import json, sys, rbd_iscsi_client\n"
+            "before = 'pbr' in sys.modules\n"
+            "rbd_iscsi_client.version\n"
+            "print(json.dumps({'before': before,\n"
+            "                  'after': 'pbr' in sys.modules}))\n")
+        self.assertEqual({'before': False, 'after': True}, result)
+
+    def test_version_eager_without_module_getattr(self):
+        result = self._run(
+            "import json, sys\n"
+            "sys.version_info = (3, 6, 9)\n"
+            "import rbd_iscsi_client\n"
+            "print(json.dumps('version' in vars(rbd_iscsi_client)))\n")
+        self.assertTrue(result)
+
+
+class TestLazyModule(unittest.TestCase):
+
+    def test_lazy_module(self):
+        module = lazy.LazyModule('json')
+        self.assertIn('not loaded', repr(module))
+        self.assertIs(json.dumps, module.dumps)
+        self.assertTrue(lazy.is_available(module))
+
+    def test_optional_module(self):
+        module = lazy.LazyModule('rbd_iscsi_client_missing', optional=True)
+        self.assertFalse(lazy.is_available(module))
+        self.assertFalse(lazy.is_available(None))
+        required = lazy.LazyModule('rbd_iscsi_client_missing')
+        self.assertRaises(ImportError, lazy.is_available, required)
@@ -0,0 +1,116 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.inventory`."""
+
+import array
+import csv
+import io
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import inventory
+from rbd_iscsi_client import lazy
+from rbd_iscsi_client.tests import utils
+
+
+class TestInventory(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT1 = 'iqn.1994-05.com.redhat:client1'
+    CLIENT2 = 'iqn.1994-05.com.redhat:client2'
+
+    def setUp(self):
+        self.client = utils.fake_client()
+        cl = self.client
+        cl.create_target_iqn(self.TARGET)
+        cl.create_client(self.TARGET, self.CLIENT1)
+        cl.create_client(self.TARGET, self.CLIENT2)
+        cl.create_disk('rbd', 'vol1', size='10G')
+        cl.create_disk('rbd', 'vol2', size='512M')
+        cl.create_disk('ssd', 'vol3', size='1T')
+        cl.register_disk(self.TARGET, 'rbd/vol1')
+        cl.export_disk(self.TARGET, self.CLIENT1, 'rbd', 'vol1')
+        cl.export_disk(self.TARGET, self.CLIENT2, 'rbd', 'vol1')
+
+    def test_size_bytes(self):
+        self.assertEqual(10 * 1024 ** 3, inventory.size_bytes('10G'))
+        self.assertEqual(1536 * 1024 ** 2, inventory.size_bytes('1.5gib'))
+        self.assertEqual(4096, inventory.size_bytes(4096))
+        self.assertEqual(0, inventory.size_bytes(None))
+        self.assertEqual(0, inventory.size_bytes('big'))
+
+    def test_columns(self):
+        inv = self.client.get_inventory()
+        self.assertEqual(3, len(inv))
+        rows = dict((row[1], row) for row in inv.rows())
+        pool, image, size, owner, backstore, targets, clients = rows['vol1']
+        self.assertEqual(('rbd', 10 * 1024 ** 3, 'user:rbd', 1, 2),
+                         (pool, size, backstore, targets, clients))
+        self.assertEqual(['rbd', 'ssd'], inv.columns['pool'].values)
+        self.assertEqual(0, rows['vol3'][5])
+
+        inv = inventory.Inventory.from_config(
+            {'disks': {}}, disks=['rbd/listed'])
+        self.assertEqual([('rbd', 'listed', 0, '', '', 0, 0)],
+                         list(inv.rows()))
+
+    def _check_pool_totals(self):
+        totals = self.client.get_inventory().pool_totals()
+        by_pool = dict((pool, i) for i, pool in enumerate(totals['pool']))
+        rbd = by_pool['rbd']
+        self.assertEqual(2, totals['disks'][rbd])
+        self.assertEqual(10 * 1024 ** 3 + 512 * 1024 ** 2,
+                         totals['size'][rbd])
+        self.assertEqual(1, totals['luns'][rbd])
+        self.assertEqual(2, totals['mappings'][rbd])
+        self.assertEqual(1024 ** 4, totals['size'][by_pool['ssd']])
+
+    def test_pool_totals(self):
+        missing = lazy.LazyModule('rbd_iscsi_client_missing', optional=True)
+        with mock.patch.object(inventory, 'pyarrow', missing):
+            self._check_pool_totals()
+        self.assertEqual({'pool': [], 'disks': array.array('q'),
+                          'size': array.array('q'), 'luns': array.array('q'),
+                          'mappings': array.array('q')},
+                         inventory.Inventory().pool_totals())
+
+    @unittest.skipUnless(lazy.is_available(inventory.pyarrow) and
+                         hasattr(inventory.pyarrow.Table, 'group_by'),
+                         'needs pyarrow 7')
+    def test_arrow_pool_totals(self):
+        with mock.patch.object(inventory.Inventory, '_pool_totals') as loop:
+            self._check_pool_totals()
+        loop.assert_not_called()
+
+    def test_write_csv(self):
+        out = io.StringIO()
+        self.client.get_inventory().write_csv(out)
+        rows = list(csv.reader(io.StringIO(out.getvalue())))
+        self.assertEqual(list(inventory.COLUMNS), rows[0])
+        self.assertEqual(4, len(rows))
+
+    def test_arrow(self):
+        inv = self.client.get_inventory()
+        missing = lazy.LazyModule('rbd_iscsi_client_missing', optional=True)
+        with mock.patch.object(inventory, 'pyarrow', missing):
+            self.assertRaises(ImportError, inv.to_arrow)
+
+        pyarrow = mock.Mock()
+        parquet = mock.Mock()
+        with mock.patch.object(inventory, 'pyarrow', pyarrow), \
+                mock.patch.object(inventory, 'parquet', parquet):
+            inv.write_parquet('/tmp/inventory.parquet')
+        table = pyarrow.Table.from_arrays.return_value
+        parquet.write_table.assert_called_once_with(
+            table, '/tmp/inventory.parquet')
+        self.assertEqual(len(inventory.ENCODED),
+                         pyarrow.DictionaryArray.from_arrays.call_count)
@@ -0,0 +1,262 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.journal`."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import journal
+from rbd_iscsi_client.tests import utils
+
+TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+INITIATOR = 'iqn.1994-05.com.redhat:client1'
+
+
+class Crash(BaseException):
+    """Stands for the death of the process in the middle of a call."""
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'journal')
+        self.gateway = fake.FakeGateway()
+        self.cl = self._client()
+        self.cl.create_target_iqn(TARGET)
+        self.cl.create_client(TARGET, INITIATOR)
+
+    def _client(self):
+        return utils.fake_client(self.gateway, journal_file=self.path)
+
+    def _restart(self):
+        # The death of the process releases its lock on the journal
+        self.cl.journal.close()
+        return self._client()
+
+    def _records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def _steps(self, image='volume-1'):
+        return [('create_disk', ('rbd', image)),
+                ('register_disk', (TARGET, 'rbd/' + image)),
+                ('export_disk', (TARGET, INITIATOR, 'rbd', image))]
+
+    def _exported(self, image='volume-1'):
+        target = self.gateway.config['targets'][TARGET]
+        return 'rbd/' + image in target['clients'][INITIATOR]['luns']
+
+    def test_calls_are_journaled(self):
+        self.cl.set_client_auth(TARGET, INITIATOR, 'chap', 'secret')
+        records = self._records()
+        self.assertEqual(['intent', 'done'] * 3,
+                         [r['t'] for r in records])
+        self.assertEqual({'target_iqn': TARGET, 'client_iqn': INITIATOR,
+                          'username': 'chap',
+                          'password': journal.REDACTED},
+                         records[-2]['args'])
+        self.assertEqual(([], []), self.cl.journal.pending())
+
+    def test_transaction_secrets_are_redacted(self):
+        self.cl.run_transaction([('set_client_auth',
+                                  (TARGET, INITIATOR, 'chap', 'S3CRET'))])
+        with open(self.path) as f:
+            self.assertNotIn('S3CRET', f.read())
+        begin = [r for r in self._records() if r['t'] == 'begin'][0]
+        self.assertEqual([['set_client_auth',
+                           [TARGET, INITIATOR, 'chap', journal.REDACTED]]],
+                         begin['steps'])
+        self.assertEqual(0o600, os.stat(self.path).st_mode & 0o777)
+
+    def test_redacted_transaction_is_rolled_back(self):
+        steps = [('create_disk', ('rbd', 'volume-1')),
+                 ('set_client_auth', (TARGET, INITIATOR, 'chap', 'S3CRET'))]
+        with self._crash_on('/api/clientauth'):
+            self.assertRaises(Crash, self.cl.run_transaction, steps)
+
+        results = self._restart().recover()
+        self.assertEqual([(journal.ROLLBACK, True)],
+                         [(r.action, r.ok) for r in results])
+        self.assertNotIn('rbd/volume-1', self.gateway.config['disks'])
+
+    def test_failed_call(self):
+        self.assertRaises(exceptions.HTTPBadRequest,
+                          self.cl.create_client, TARGET, INITIATOR)
+        self.assertEqual('fail', self._records()[-1]['t'])
+        self.assertEqual(([], []), self.cl.journal.pending())
+
+    def test_transaction(self):
+        results = self.cl.run_transaction(self._steps(), name='attach')
+        self.assertEqual(3, len(results))
+        self.assertTrue(self._exported())
+        self.assertEqual('committed', self._records()[-1]['state'])
+        self.assertEqual([], self.cl.recover())
+        self.assertEqual([], self._records())
+
+    def test_failed_transaction_is_rolled_back(self):
+        steps = self._steps()
+        steps[2] = ('export_disk', (TARGET, 'iqn.unknown', 'rbd',
+                                    'volume-1'))
+        self.assertRaises(exceptions.HTTPNotFound,
+                          self.cl.run_transaction, steps)
+        self.assertNotIn('rbd/volume-1', self.gateway.config['disks'])
+        self.assertEqual('rolled_back', self._records()[-1]['state'])
+
+    def test_refused_step_is_not_rolled_back(self):
+        self.cl.create_disk('rbd', 'volume-1')
+        self.cl.register_disk(TARGET, 'rbd/volume-1')
+        steps = [('create_disk', ('rbd', 'volume-2')),
+                 ('register_disk', (TARGET, 'rbd/volume-1'))]
+        self.assertRaises(exceptions.HTTPBadRequest,
+                          self.cl.run_transaction, steps)
+        # Only the disk created by the transaction is deleted
+        self.assertNotIn('rbd/volume-2', self.gateway.config['disks'])
+        target = self.gateway.config['targets'][TARGET]
+        self.assertIn('rbd/volume-1', target['disks'])
+
+    def test_existing_disk_is_not_deleted(self):
+        self.cl.create_disk('rbd', 'volume-1')
+        self.assertRaises(exceptions.HTTPBadRequest,
+                          self.cl.run_transaction, self._steps())
+        self.assertIn('rbd/volume-1', self.gateway.config['disks'])
+        self.assertEqual('rolled_back', self._records()[-1]['state'])
+
+    def test_outcome_unknown(self):
+        self.assertTrue(journal.outcome_unknown(
+            exceptions.HTTPInternalServerError()))
+        self.assertTrue(journal.outcome_unknown(exceptions.Timeout()))
+        self.assertTrue(journal.outcome_unknown(ConnectionResetError()))
+        self.assertFalse(journal.outcome_unknown(
+            exceptions.HTTPBadRequest()))
+        self.assertFalse(journal.outcome_unknown(
+            exceptions.GatewayUnavailable()))
+        self.assertFalse(journal.outcome_unknown(ValueError()))
+
+    def _crash_on(self, action):
+        real = fake.FakeGateway.handle
+
+        def handle(gateway, method, path, data=None, auth=None):
+            if path.startswith(action):
+                raise Crash()
+            return real(gateway, method, path, data, auth)
+
+        return mock.patch.object(fake.FakeGateway, 'handle', handle)
+
+    def test_recover_resume(self):
+        with self._crash_on('/api/clientlun'):
+            self.assertRaises(Crash, self.cl.run_transaction, self._steps())
+        self.assertFalse(self._exported())
+
+        restarted = self._restart()
+        transactions, operations = restarted.journal.pending()
+        self.assertEqual(1, len(transactions))
+        self.assertEqual({0, 1}, transactions[0].completed_steps)
+        self.assertEqual({2}, transactions[0].in_doubt_steps)
+
+        results = restarted.recover()
+        self.assertEqual([True], [r.ok for r in results])
+        self.assertTrue(self._exported())
+        self.assertEqual([], self._records())
+
+    def test_recover_rollback(self):
+        with self._crash_on('/api/clientlun'):
+            self.assertRaises(Crash, self.cl.run_transaction, self._steps())
+
+        results = self._restart().recover(journal.ROLLBACK)
+        self.assertEqual([True], [r.ok for r in results])
+        self.assertFalse(self._exported())
+        self.assertEqual({}, self.gateway.config['targets'][TARGET]['disks'])
+        self.assertNotIn('rbd/volume-1', self.gateway.config['disks'])
+
+    def test_recover_call_in_doubt(self):
+        with self._crash_on('/api/disk'):
+            self.assertRaises(Crash, self.cl.create_disk, 'rbd', 'volume-2')
+
+        restarted = self._restart()
+        self.assertEqual(1, len(restarted.journal.pending()[1]))
+        results = restarted.recover()
+        self.assertTrue(results[0].ok)
+        self.assertIn('rbd/volume-2', self.gateway.config['disks'])
+        # Replaying again is harmless, the call was already applied
+        self.assertEqual([], restarted.recover())
+
+    def test_truncated_record_is_ignored(self):
+        self.cl.create_disk('rbd', 'volume-3')
+        with open(self.path, 'a') as f:
+            f.write('{"t":"intent","op":"abc","act')
+        self.assertEqual(([], []), self._restart().journal.pending())
+
+    @unittest.skipIf(journal.fcntl is None, 'needs file locks')
+    def test_journal_per_process(self):
+        # Another process, a forked worker say, gets a journal of its own
+        other = self._client()
+        self.assertEqual(self.path + '.%d' % os.getpid(),
+                         other.journal.path)
+        with self._crash_on('/api/disk'):
+            self.assertRaises(Crash, other.create_disk, 'rbd', 'volume-2')
+        # Its records are left alone while it lives
+        self.assertEqual([], self.cl.recover())
+        self.assertTrue(os.path.exists(other.journal.path))
+
+        other.journal.close()
+        results = self.cl.recover()
+        self.assertEqual([True], [r.ok for r in results])
+        self.assertIn('rbd/volume-2', self.gateway.config['disks'])
+        self.assertFalse(os.path.exists(other.journal.path))
+
+    def test_per_process_journal_removed_on_close(self):
+        other = self._client()
+        other.create_disk('rbd', 'volume-2')
+        other.journal.close()
+        self.assertEqual([os.path.basename(self.path)],
+                         os.listdir(self.tmpdir))
+
+    def test_compacted_as_calls_finish(self):
+        self.cl.journal.close()
+        jnl = journal.Journal(self.path, compact_after=3)
+        for i in range(10):
+            jnl.done(jnl.intent('create_disk', {'pool': 'rbd',
+                                                'image': str(i)}))
+        pending = jnl.intent('create_disk', {'pool': 'rbd', 'image': 'x'})
+        for i in range(2):
+            tx_id = jnl.begin([], 'tx-%d' % i)
+            jnl.end(tx_id)
+        # The 12th finished record compacts the journal
+        self.assertEqual([('intent', pending)],
+                         [(r['t'], r['op']) for r in self._records()])
+        jnl.done(pending)
+        self.assertEqual(2, len(self._records()))
+        jnl.close()
+
+    def test_fsync_is_batched(self):
+        self.cl.journal.close()
+        jnl = journal.Journal(self.path, sync_batch=4)
+        with mock.patch('os.fsync') as mock_fsync:
+            op_ids = [jnl.intent('create_disk', {'pool': 'rbd',
+                                                 'image': str(i)})
+                      for i in range(2)]
+            self.assertEqual(2, mock_fsync.call_count)
+            for op_id in op_ids:
+                jnl.done(op_id)
+            self.assertEqual(2, mock_fsync.call_count)
+            jnl.done('x')
+            jnl.done('y')
+            self.assertEqual(3, mock_fsync.call_count)
+        jnl.close()
@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.loadgen`."""
+
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import loadgen
+from rbd_iscsi_client.tests import utils
+
+import requests
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT = 'iqn.1994-05.com.redhat:client1'
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.client = utils.fake_client(self.gateway)
+
+    def test_parse_mix(self):
+        self.assertEqual({'create_disk': 2.0, 'find_disk': 1.0},
+                         loadgen.parse_mix('create_disk=2, find_disk'))
+        self.assertRaises(ValueError, loadgen.parse_mix, 'format_disk=1')
+
+    def test_run_and_cleanup(self):
+        generator = loadgen.LoadGenerator(
+            self.client, self.TARGET, self.CLIENT, rate=400,
+            concurrency=4, duration=0.3, poisson=False, seed=42)
+        generator.setup()
+        # setup() is idempotent
+        generator.setup()
+        report = generator.run()
+        self.assertGreater(report.scheduled, 50)
+        self.assertEqual(report.scheduled,
+                         report.completed + report.skipped)
+        self.assertIn('create_disk', report.latencies)
+        self.assertIn('ops/s', report.format())
+        # Lifecycle calls are only made on volumes in the right state
+        lifecycle_errors = [key for key in report.errors
+                            if key[0] in loadgen.TRANSITIONS]
+        self.assertEqual([], lifecycle_errors)
+
+        generator.cleanup()
+        self.assertEqual({}, self.gateway.config['disks'])
+
+    def test_cleanup_deletes_images(self):
+        generator = loadgen.LoadGenerator(
+            self.client, self.TARGET, self.CLIENT)
+        generator.setup()
+        for dummy in range(3):
+            generator._run_op(loadgen.Report(), 'create_disk', 0)
+        real = self.client.delete_disk
+        calls = []
+
+        def _delete_disk(pool, image, preserve_image=True):
+            calls.append(preserve_image)
+            if len(calls) == 1:
+                raise requests.exceptions.ConnectionError('reset')
+            return real(pool, image, preserve_image=preserve_image)
+
+        with mock.patch.object(self.client, 'delete_disk', _delete_disk):
+            generator.cleanup()
+        self.assertEqual([False] * 3, calls)
+        # The cleanup went on after the connection error
+        self.assertEqual(1, len(self.gateway.config['disks']))
+
+    def test_errors_by_class(self):
+        generator = loadgen.LoadGenerator(
+            self.client, 'iqn.missing', self.CLIENT,
+            mix={'get_clients': 1}, rate=200, duration=0.1, poisson=False)
+        report = generator.run()
+        self.assertEqual(report.completed, report.failed)
+        self.assertEqual([('get_clients', 'HTTPNotFound')],
+                         list(report.errors))
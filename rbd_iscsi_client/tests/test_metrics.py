@@ -0,0 +1,39 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.metrics`."""
+
+import unittest
+
+from rbd_iscsi_client import metrics
+from rbd_iscsi_client.tests import utils
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counters_and_gauges(self):
+        m = metrics.Metrics()
+        m.incr('requests', gateway='http://gw1')
+        m.incr('requests', 2, gateway='http://gw1')
+        m.incr('requests', gateway='http://gw2')
+        m.set('limit', 7)
+        self.assertEqual(3, m.get('requests', gateway='http://gw1'))
+        self.assertEqual({'requests': {'http://gw1': 3, 'http://gw2': 1},
+                          'limit': 7}, m.snapshot())
+        m.reset()
+        self.assertEqual({}, m.snapshot())
+
+    def test_client_counts_requests(self):
+        cl = utils.fake_client()
+        cl.get_api()
+        cl.get_targets()
+        self.assertEqual({'http://gw:5000': 2},
+                         cl.get_metrics()['requests'])
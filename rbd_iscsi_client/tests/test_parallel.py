@@ -0,0 +1,178 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.parallel`."""
+
+import random
+import threading
+import time
+import unittest
+
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import parallel
+from rbd_iscsi_client.tests import utils
+
+
+class TestFanOut(unittest.TestCase):
+
+    def test_bounded_concurrency(self):
+        lock = threading.Lock()
+        state = {'active': 0, 'peak': 0}
+
+        def _call(key):
+            with lock:
+                state['active'] += 1
+                state['peak'] = max(state['peak'], state['active'])
+            time.sleep(0.01)
+            with lock:
+                state['active'] -= 1
+            return {}, key
+
+        results = list(parallel.fan_out(_call, range(20), max_workers=3))
+        self.assertEqual(20, len(results))
+        self.assertLessEqual(state['peak'], 3)
+        self.assertEqual(list(range(20)), sorted(r.body for r in results))
+
+    def test_partial_failure(self):
+        def _call(key):
+            if key % 2:
+                raise ValueError(key)
+            return {}, key
+
+        results = list(parallel.fan_out(_call, range(4)))
+        errors = sorted(r.key for r in results if not r.ok)
+        self.assertEqual([1, 3], errors)
+
+    def test_lazy_consumption(self):
+        consumed = []
+
+        def _keys():
+            for i in range(100):
+                consumed.append(i)
+                yield i
+
+        stream = parallel.fan_out(lambda k: ({}, k), _keys(), max_workers=2)
+        next(stream)
+        self.assertLess(len(consumed), 10)
+        stream.close()
+
+
+class _SlowClient(object):
+    """Records the order the calls on each disk start in."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = set()
+        self.started = []
+        self.overlaps = 0
+
+    def export_disk(self, target_iqn, client_iqn, pool, disk):
+        name = '%s/%s' % (pool, disk)
+        with self.lock:
+            if name in self.active:
+                self.overlaps += 1
+            self.active.add(name)
+            self.started.append((name, client_iqn))
+        time.sleep(random.random() / 500)
+        with self.lock:
+            self.active.discard(name)
+        return {}, None
+
+
+class TestSubmitMany(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+
+    def test_resources(self):
+        cl = utils.fake_client()
+        self.assertEqual(
+            {('disk', 'rbd/vol1'), ('client', 'iqn.c')},
+            parallel.resources(cl.export_disk,
+                               (self.TARGET, 'iqn.c', 'rbd', 'vol1')))
+        self.assertEqual({('disk', 'rbd/vol1')},
+                         parallel.resources(cl.register_disk,
+                                            (self.TARGET, 'rbd/vol1')))
+        self.assertEqual({('disk', 'rbd/vol1')},
+                         parallel.resources(cl.delete_disk,
+                                            ('rbd', 'vol1', False)))
+        self.assertEqual({('target', self.TARGET)},
+                         parallel.resources(cl.create_target_iqn,
+                                            (self.TARGET,)))
+        self.assertRaises(TypeError, parallel.resources, cl.find_disk, ())
+
+    def test_order_per_resource(self):
+        stub = _SlowClient()
+        ops = [('export_disk', (self.TARGET, 'iqn.c%d' % i, 'rbd',
+                                'vol%d' % (i % 3)))
+               for i in range(60)]
+        results = list(parallel.submit_many(stub, ops, max_workers=8))
+        self.assertEqual(60, len(results))
+        self.assertEqual(0, stub.overlaps)
+        for disk in range(3):
+            name = 'rbd/vol%d' % disk
+            self.assertEqual(
+                ['iqn.c%d' % i for i in range(disk, 60, 3)],
+                [c for n, c in stub.started if n == name])
+
+    def test_lifecycles_against_gateway(self):
+        gateway = fake.FakeGateway()
+        cl = utils.fake_client(gateway)
+        initiator = 'iqn.1994-05.com.redhat:client1'
+
+        def _ops():
+            yield 'create_target_iqn', (self.TARGET,)
+            yield 'create_client', (self.TARGET, initiator)
+            for i in range(20):
+                image = 'vol%d' % i
+                yield 'create_disk', ('rbd', image)
+                yield 'register_disk', (self.TARGET, 'rbd/' + image)
+                yield 'export_disk', (self.TARGET, initiator, 'rbd', image)
+            for i in range(0, 20, 2):
+                image = 'vol%d' % i
+                yield 'unexport_disk', (self.TARGET, initiator, 'rbd', image)
+                yield 'unregister_disk', (self.TARGET, 'rbd/' + image)
+                yield 'delete_disk', ('rbd', image)
+            yield 'no_such_call', ()
+
+        results = list(cl.submit_many(_ops(), max_workers=6, window=10))
+        self.assertEqual(93, len(results))
+        failed = [r for r in results if not r.ok]
+        self.assertEqual(['no_such_call'], [r.key[0] for r in failed])
+        self.assertEqual(['rbd/vol%d' % i for i in range(1, 20, 2)],
+                         sorted(gateway.config['disks'],
+                                key=lambda n: int(n[7:])))
+        luns = (gateway.config['targets'][self.TARGET]['clients']
+                [initiator]['luns'])
+        self.assertEqual(10, len(luns))
+
+    def test_window(self):
+        consumed = []
+        gate = threading.Event()
+
+        class _Blocking(object):
+            def delete_disk(self, pool, image):
+                gate.wait(5)
+                return {}, None
+
+        def _ops():
+            for i in range(100):
+                consumed.append(i)
+                yield 'delete_disk', ('rbd', 'vol%d' % i)
+
+        stream = parallel.submit_many(_Blocking(), _ops(), max_workers=2,
+                                      window=5)
+        timer = threading.Timer(0.1, gate.set)
+        timer.start()
+        next(stream)
+        # The window, refilled once as the first ops completed
+        self.assertLessEqual(len(consumed), 10)
+        self.assertEqual(99, len(list(stream)))
+        timer.join()
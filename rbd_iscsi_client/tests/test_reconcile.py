@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.reconcile`."""
+
+import unittest
+
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import reconcile
+from rbd_iscsi_client.tests import utils
+
+
+class TestReconcile(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT1 = 'iqn.1994-05.com.redhat:client1'
+    CLIENT2 = 'iqn.1994-05.com.redhat:client2'
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.client = utils.fake_client(self.gateway)
+
+    def test_plan_from_scratch(self):
+        plan = reconcile.plan({}, self.TARGET,
+                              [(self.CLIENT1, 'rbd/vol1'),
+                               (self.CLIENT2, ('rbd', 'vol1'))])
+        self.assertEqual(
+            ["create_target_iqn('%s')" % self.TARGET,
+             "create_disk('rbd', 'vol1')",
+             "create_client('%s', '%s')" % (self.TARGET, self.CLIENT1),
+             "create_client('%s', '%s')" % (self.TARGET, self.CLIENT2),
+             "register_disk('%s', 'rbd/vol1')" % self.TARGET,
+             "export_disk('%s', '%s', 'rbd', 'vol1')" % (self.TARGET,
+                                                         self.CLIENT1),
+             "export_disk('%s', '%s', 'rbd', 'vol1')" % (self.TARGET,
+                                                         self.CLIENT2)],
+            [str(step) for step in plan])
+
+    def test_invalid_disk(self):
+        self.assertRaises(ValueError, reconcile.plan, {}, self.TARGET,
+                          [(self.CLIENT1, 'vol1')])
+
+    def test_reconcile_converges(self):
+        cl = self.client
+        cl.create_target_iqn(self.TARGET)
+        cl.create_client(self.TARGET, self.CLIENT1)
+        for image in ('vol1', 'vol2'):
+            cl.create_disk('rbd', image)
+            cl.register_disk(self.TARGET, 'rbd/%s' % image)
+            cl.export_disk(self.TARGET, self.CLIENT1, 'rbd', image)
+
+        desired = [(self.CLIENT1, 'rbd/vol1'), (self.CLIENT2, 'rbd/vol3')]
+        plan = cl.reconcile(self.TARGET, desired, dry_run=True,
+                            delete_unused=True)
+        self.assertFalse(plan.executed)
+        actions = dict((phase, [s.action for s in steps])
+                       for phase, steps in plan.phases.items() if steps)
+        self.assertEqual({'create': ['create_disk', 'create_client'],
+                          'register': ['register_disk'],
+                          'export': ['export_disk'],
+                          'unexport': ['unexport_disk'],
+                          'unregister': ['unregister_disk'],
+                          'delete': ['delete_disk']}, actions)
+
+        plan = cl.reconcile(self.TARGET, desired, delete_unused=True)
+        self.assertEqual([], plan.failed)
+        self.assertEqual(len(plan), len(plan.results))
+
+        resp, config = cl.get_config()
+        clients = config['targets'][self.TARGET]['clients']
+        self.assertEqual(['rbd/vol1'], list(clients[self.CLIENT1]['luns']))
+        self.assertEqual(['rbd/vol3'], list(clients[self.CLIENT2]['luns']))
+        self.assertEqual(['rbd/vol1', 'rbd/vol3'], sorted(config['disks']))
+
+        # Converged, nothing left to do
+        self.assertEqual(0, len(cl.reconcile(self.TARGET, desired,
+                                             dry_run=True)))
+
+    def test_failure_stops_later_phases(self):
+        plan = reconcile.Plan(self.TARGET)
+        plan.add('register', 'register_disk', self.TARGET, 'rbd/nope')
+        plan.add('export', 'export_disk', self.TARGET, self.CLIENT1,
+                 'rbd', 'nope')
+        reconcile.execute(self.client, plan)
+        self.assertEqual(1, len(plan.results))
+        self.assertEqual(1, len(plan.failed))
@@ -0,0 +1,103 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.routing`."""
+
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import routing
+from rbd_iscsi_client.tests import utils
+
+
+class TestOwnerUrls(unittest.TestCase):
+
+    def test_owner_urls(self):
+        config = {
+            'gateways': {
+                'gateway1.example.com': {'portal_ip_addresses': []},
+                'gateway2': {'portal_ip_addresses': ['10.0.0.2']},
+                'gateway3': {},
+                'created': '',
+            },
+            'targets': {'iqn': {'portals': {
+                'gateway4': {'portal_ip_addresses': ['10.0.0.4']}}}},
+            'disks': {'rbd/vol1': {'owner': 'gateway2'}},
+        }
+        urls = ['http://gateway1:5000', 'https://10.0.0.2:5000',
+                'http://10.0.0.4:5000', 'http://10.0.0.5:5000']
+        self.assertEqual({'gateway1.example.com': urls[0],
+                          'gateway2': urls[1],
+                          'gateway4': urls[2]},
+                         routing.owner_urls(config, urls))
+        self.assertEqual('gateway2', routing.disk_owner(config, 'rbd/vol1'))
+        self.assertIsNone(routing.disk_owner(config, 'rbd/vol2'))
+        self.assertIsNone(routing.disk_owner(None, 'rbd/vol1'))
+
+
+class TestClientRouting(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT = 'iqn.1994-05.com.redhat:client1'
+    URLS = ['http://gateway1:5000', 'http://gateway2:5000']
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.client = utils.fake_client(self.gateway, self.URLS,
+                                        owner_routing=True)
+        cl = self.client
+        cl.create_target_iqn(self.TARGET)
+        cl.create_client(self.TARGET, self.CLIENT)
+        # The fake gateway gives the disks owners round robin
+        cl.create_disk('rbd', 'vol1')
+        cl.create_disk('rbd', 'vol2')
+
+    def _requests(self):
+        requests = self.client.get_metrics()['requests']
+        return [requests.get(url, 0) for url in self.URLS]
+
+    def test_routed_to_owner(self):
+        cl = self.client
+        # Nothing is routed before a config was fetched
+        cl.register_disk(self.TARGET, 'rbd/vol2')
+        self.assertNotIn('owner_routed', cl.get_metrics())
+
+        cl.get_config()
+        before = self._requests()
+        cl.export_disk(self.TARGET, self.CLIENT, 'rbd', 'vol2')
+        cl.unexport_disk(self.TARGET, self.CLIENT, 'rbd', 'vol2')
+        cl.unregister_disk(self.TARGET, 'rbd/vol2')
+        cl.delete_disk('rbd', 'vol2')
+        after = self._requests()
+        self.assertEqual([before[0], before[1] + 4], after)
+        self.assertEqual({self.URLS[1]: 4},
+                         cl.get_metrics()['owner_routed'])
+
+        # The owner of vol1 is the first gateway
+        cl.register_disk(self.TARGET, 'rbd/vol1')
+        self.assertEqual(1, cl.get_metrics()['owner_routed'][self.URLS[0]])
+
+    def test_unhealthy_owner_falls_back(self):
+        cl = self.client
+        cl.get_config()
+        cl.health_monitor = mock.Mock()
+        cl.health_monitor.is_usable.side_effect = (
+            lambda url: url != self.URLS[1])
+        before = self._requests()
+        cl.register_disk(self.TARGET, 'rbd/vol2')
+        after = self._requests()
+        self.assertEqual([before[0] + 1, before[1]], after)
+
+    def test_disabled(self):
+        cl = utils.fake_client(self.gateway, self.URLS)
+        cl.get_config()
+        self.assertIsNone(cl._owner_gateway('rbd', 'vol2'))
@@ -0,0 +1,194 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.snapshot`."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import snapshot
+from rbd_iscsi_client.tests import utils
+
+
+class TestSnapshot(unittest.TestCase):
+
+    CONFIG = {'epoch': 7,
+              'disks': {'rbd/vol1': {'pool': 'rbd', 'image': 'vol1'}}}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'config.snap')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        snap = snapshot.ConfigSnapshot(self.CONFIG, {'etag': '"abc"'})
+        snapshot.save(self.path, snap)
+        loaded = snapshot.load(self.path)
+        self.assertEqual(self.CONFIG, loaded.config)
+        self.assertEqual(7, loaded.epoch)
+        self.assertEqual('"abc"', loaded.validator)
+        self.assertEqual({'If-None-Match': '"abc"'},
+                         loaded.conditional_headers())
+
+    def test_json_fallback(self):
+        snap = snapshot.ConfigSnapshot(self.CONFIG)
+        with mock.patch.object(snapshot, 'msgpack', None):
+            raw = snapshot.dumps(snap)
+        self.assertTrue(raw.startswith(snapshot.MAGIC +
+                                       snapshot.FORMAT_JSON))
+        self.assertEqual(self.CONFIG, snapshot.loads(raw).config)
+
+    def test_load_missing_or_corrupt(self):
+        self.assertIsNone(snapshot.load(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        self.assertIsNone(snapshot.load(self.path))
+
+    def test_client_warm_start(self):
+        snapshot.save(self.path, snapshot.ConfigSnapshot(self.CONFIG))
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   snapshot_file=self.path)
+        fetched = threading.Event()
+        new_config = dict(self.CONFIG, epoch=8)
+
+        def _get(url, **kwargs):
+            fetched.set()
+            return {'status': '200'}, new_config
+
+        with mock.patch.object(cl, 'get', side_effect=_get):
+            resp, body = cl.get_config()
+            self.assertEqual(self.CONFIG, body)
+            self.assertTrue(fetched.wait(5))
+            for _ in range(100):
+                if not cl._snapshot_warm:
+                    break
+                time.sleep(0.01)
+            self.assertFalse(cl._snapshot_warm)
+            resp, body = cl.get_config()
+            self.assertEqual(new_config, body)
+
+        self.assertEqual(8, snapshot.load(self.path).epoch)
+
+    def test_client_warm_start_response(self):
+        live = utils.fake_client(snapshot_file=self.path)
+        resp, config = live.get_config()
+        cl = utils.fake_client(snapshot_file=self.path)
+        self.assertTrue(cl._snapshot_warm)
+        warm, body = cl.get_config()
+        self.assertEqual(config, body)
+        self.assertIs(type(resp), type(warm))
+        self.assertEqual(200, warm.status)
+        self.assertEqual('200', warm['Status'])
+
+    def test_client_old_snapshot_is_not_used(self):
+        snapshot.save(self.path, snapshot.ConfigSnapshot(
+            self.CONFIG, fetched_at=time.time() - 7200))
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   snapshot_file=self.path,
+                                   snapshot_max_age=3600)
+        new_config = dict(self.CONFIG, epoch=8)
+        with mock.patch.object(cl, 'get',
+                               return_value=({'status': '200'},
+                                             new_config)) as get_mock:
+            resp, body = cl.get_config()
+            get_mock.assert_called_once_with('/api/config')
+        self.assertEqual(new_config, body)
+
+    def test_client_persists_config(self):
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   snapshot_file=self.path)
+        with mock.patch.object(cl, 'get',
+                               return_value=({'status': '200'},
+                                             self.CONFIG)) as get_mock:
+            cl.get_config()
+            get_mock.assert_called_once_with('/api/config')
+        self.assertEqual(self.CONFIG, snapshot.load(self.path).config)
+
+
+class TestSharedCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'config.db')
+
+    def _fetch(self, epoch=1):
+        return mock.Mock(
+            return_value=snapshot.ConfigSnapshot({'epoch': epoch}))
+
+    def test_shared_between_instances(self):
+        fetch = self._fetch()
+        first = snapshot.SharedCache(self.path)
+        self.assertIsNone(first.get())
+        self.assertEqual(1, first.get_or_fetch(fetch).epoch)
+        other = snapshot.SharedCache(self.path)
+        self.assertEqual(1, other.get_or_fetch(fetch).epoch)
+        self.assertEqual(1, fetch.call_count)
+
+        stale = snapshot.SharedCache(self.path, max_age=0)
+        self.assertEqual(2, stale.get_or_fetch(self._fetch(2)).epoch)
+
+    def test_permissions(self):
+        cache = snapshot.SharedCache(self.path)
+        cache.get_or_fetch(self._fetch())
+        for suffix in ('', '-wal', '-shm'):
+            self.assertEqual(
+                0o600, os.stat(self.path + suffix).st_mode & 0o777)
+
+    def test_waits_for_the_lease_holder(self):
+        holder = snapshot.SharedCache(self.path)
+        self.assertTrue(holder._try_lease())
+        timer = threading.Timer(
+            0.05, holder.put, [snapshot.ConfigSnapshot({'epoch': 3})])
+        timer.start()
+        self.addCleanup(timer.join)
+
+        fetch = self._fetch()
+        waiter = snapshot.SharedCache(self.path, poll_interval=0.01)
+        self.assertEqual(3, waiter.get_or_fetch(fetch).epoch)
+        self.assertFalse(fetch.called)
+
+    def test_expired_lease(self):
+        holder = snapshot.SharedCache(self.path, lease=0.05)
+        self.assertTrue(holder._try_lease())
+        time.sleep(0.06)
+        fetch = self._fetch()
+        self.assertEqual(1, holder.get_or_fetch(fetch).epoch)
+
+    def test_failed_fetch_releases_the_lease(self):
+        cache = snapshot.SharedCache(self.path)
+        fetch = mock.Mock(side_effect=ValueError)
+        self.assertRaises(ValueError, cache.get_or_fetch, fetch)
+        self.assertTrue(cache._try_lease())
+
+    def test_client_shared_config(self):
+        transport = fake.FakeTransport()
+        clients = [client.RBDISCSIClient('user', 'password',
+                                         'http://gw:5000',
+                                         transport=transport,
+                                         shared_config=self.path)
+                   for i in range(3)]
+        results = [cl.get_config() for cl in clients]
+        configs = [body for resp, body in results]
+        # Served from the cache like from the gateway
+        self.assertEqual([200] * 3, [resp.status for resp, body in results])
+        self.assertEqual(1, transport.gateway.requests)
+        self.assertEqual(configs[0], configs[2])
+        self.assertIn('targets', configs[0])
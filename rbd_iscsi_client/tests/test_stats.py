@@ -0,0 +1,45 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.stats`."""
+
+import unittest
+
+from rbd_iscsi_client import stats
+
+
+class TestStats(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, stats.percentile(values, 50))
+        self.assertEqual(99, stats.percentile(values, 99))
+        self.assertEqual(100, stats.percentile(values, 100))
+        self.assertEqual(1, stats.percentile(values, 0))
+        self.assertIsNone(stats.percentile([], 50))
+
+    def test_summarize(self):
+        summary = stats.summarize([3, 1, 2])
+        self.assertEqual(3, summary['count'])
+        self.assertEqual(1, summary['min'])
+        self.assertEqual(3, summary['max'])
+        self.assertEqual(2, summary['mean'])
+        self.assertEqual(2, summary['p50'])
+        self.assertIsNone(stats.summarize([])['p99'])
+
+    def test_histogram(self):
+        hist = stats.Histogram(min_value=0.001, factor=10, buckets=3)
+        for value in (0.0005, 0.002, 0.003, 0.5, 5):
+            hist.add(value)
+        self.assertEqual([(0.001, 1), (0.01, 2), (None, 2)],
+                         [(round(b, 6) if b else b, c)
+                          for b, c in hist.buckets()])
+        self.assertEqual(5, hist.summary()['count'])
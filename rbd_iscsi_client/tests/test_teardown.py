@@ -0,0 +1,128 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.teardown`."""
+
+import threading
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import teardown
+from rbd_iscsi_client.tests import utils
+
+
+class TestTeardown(unittest.TestCase):
+
+    TARGET = 'iqn.2003-01.com.redhat.iscsi-gw:ceph-igw'
+    CLIENT1 = 'iqn.1994-05.com.redhat:client1'
+    CLIENT2 = 'iqn.1994-05.com.redhat:client2'
+
+    def setUp(self):
+        self.gateway = fake.FakeGateway()
+        self.client = utils.fake_client(self.gateway)
+
+    def _export(self, count):
+        cl = self.client
+        cl.create_target_iqn(self.TARGET)
+        cl.create_client(self.TARGET, self.CLIENT1)
+        cl.create_client(self.TARGET, self.CLIENT2)
+        for i in range(count):
+            image = 'vol%d' % i
+            cl.create_disk('rbd', image)
+            cl.register_disk(self.TARGET, 'rbd/%s' % image)
+            cl.export_disk(self.TARGET, self.CLIENT1, 'rbd', image)
+            if i % 2:
+                cl.export_disk(self.TARGET, self.CLIENT2, 'rbd', image)
+
+    def test_steps(self):
+        self._export(2)
+        resp, config = self.client.get_config()
+        stages = teardown.steps(config, ('rbd', 'vol1'), preserve_image=False)
+        unexport = "unexport_disk('%s', '%%s', 'rbd', 'vol1')" % self.TARGET
+        self.assertEqual(
+            [('unexport', [unexport % self.CLIENT1, unexport % self.CLIENT2]),
+             ('unregister',
+              ["unregister_disk('%s', 'rbd/vol1')" % self.TARGET]),
+             ('delete', ["delete_disk('rbd', 'vol1', False)"])],
+            [(stage, [str(step) for step in stage_steps])
+             for stage, stage_steps in stages])
+
+        stages = teardown.steps(config, 'rbd/missing')
+        self.assertEqual([[], [], []], [s for stage, s in stages])
+
+    def test_teardown(self):
+        self._export(20)
+        disks = ['rbd/vol%d' % i for i in range(20)] + ['invalid']
+        outcomes = list(self.client.teardown(
+            iter(disks), workers={'unexport': 3, 'delete': 1},
+            max_inflight=4))
+
+        self.assertEqual(sorted(disks), sorted(o.key for o in outcomes))
+        by_key = dict((o.key, o) for o in outcomes)
+        self.assertIsInstance(by_key['invalid'].error, ValueError)
+        self.assertTrue(all(o.ok for o in outcomes if o.key != 'invalid'))
+        self.assertEqual(4, len(by_key['rbd/vol1'].results))
+        self.assertEqual({}, self.gateway.config['disks'])
+        self.assertEqual({}, self.gateway.config['targets'][self.TARGET]
+                         ['disks'])
+
+    def test_failed_step_stops_the_disk(self):
+        self._export(2)
+        unregister = self.client.unregister_disk
+
+        def _unregister(target_iqn, volume):
+            if volume == 'rbd/vol0':
+                raise exceptions.HTTPBadRequest("busy")
+            return unregister(target_iqn, volume)
+
+        with mock.patch.object(self.client, 'unregister_disk', _unregister):
+            outcomes = dict((o.key, o) for o in self.client.teardown(
+                [('rbd', 'vol0'), ('rbd', 'vol1')]))
+
+        failed = outcomes[('rbd', 'vol0')]
+        self.assertIsInstance(failed.error, exceptions.HTTPBadRequest)
+        self.assertEqual(['unexport_disk', 'unregister_disk'],
+                         [r.key.action for r in failed.results])
+        self.assertIn('rbd/vol0', self.gateway.config['disks'])
+        self.assertTrue(outcomes[('rbd', 'vol1')].ok)
+        self.assertNotIn('rbd/vol1', self.gateway.config['disks'])
+
+    def test_backpressure(self):
+        self._export(10)
+        consumed = []
+
+        def _disks():
+            for i in range(10):
+                consumed.append(i)
+                yield 'rbd/vol%d' % i
+
+        gate = threading.Event()
+        delete = self.client.delete_disk
+
+        def _delete(*args):
+            gate.wait(5)
+            return delete(*args)
+
+        with mock.patch.object(self.client, 'delete_disk', _delete):
+            outcomes = self.client.teardown(_disks(), max_inflight=3)
+            timer = threading.Timer(0.2, gate.set)
+            timer.start()
+            first = next(outcomes)
+            # The deletions were blocked, no more than max_inflight disks
+            # were taken from the iterable.
+            self.assertLessEqual(len(consumed), 4)
+            rest = list(outcomes)
+            timer.join()
+        self.assertTrue(first.ok)
+        self.assertEqual(9, len(rest))
+        self.assertEqual({}, self.gateway.config['disks'])
@@ -0,0 +1,216 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.throttle`."""
+
+import threading
+import time
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import throttle
+from rbd_iscsi_client.tests import utils
+
+import requests
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_refill(self):
+        clock = utils.FakeClock()
+        bucket = throttle.TokenBucket(2, burst=2, clock=clock)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(0.5, bucket.delay())
+        clock.now = 0.5
+        self.assertTrue(bucket.try_acquire())
+        clock.now = 100
+        self.assertEqual(0, bucket.delay(2))
+        self.assertFalse(bucket.try_acquire(3))
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, throttle.TokenBucket, 0)
+
+
+class TestPriorityRateLimiter(unittest.TestCase):
+
+    def test_background_rate(self):
+        clock = utils.FakeClock()
+        limiter = throttle.PriorityRateLimiter(10, background_rate=1,
+                                               background_burst=1,
+                                               clock=clock)
+        limiter.acquire(throttle.PRIORITY_BACKGROUND)
+        self.assertAlmostEqual(1.0, limiter._background.delay())
+        # Interactive requests are not limited by the background bucket
+        limiter.acquire(throttle.PRIORITY_INTERACTIVE)
+
+    def test_background_yields_to_interactive(self):
+        limiter = throttle.PriorityRateLimiter(20, burst=1,
+                                               background_rate=20)
+        limiter.acquire()
+        order = []
+
+        def _acquire(priority):
+            limiter.acquire(priority)
+            order.append(priority)
+
+        background = threading.Thread(
+            target=_acquire, args=(throttle.PRIORITY_BACKGROUND,))
+        interactive = threading.Thread(
+            target=_acquire, args=(throttle.PRIORITY_INTERACTIVE,))
+        interactive.start()
+        for _ in range(100):
+            if limiter.interactive_waiters:
+                break
+            time.sleep(0.001)
+        background.start()
+        interactive.join(5)
+        background.join(5)
+        self.assertEqual([throttle.PRIORITY_INTERACTIVE,
+                          throttle.PRIORITY_BACKGROUND], order)
+
+
+class TestClientRateLimit(unittest.TestCase):
+
+    def test_request_priority(self):
+        limiter = mock.Mock()
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   rate_limiter=limiter)
+        resp = mock.Mock(status_code=200,
+                         headers=requests.structures.CaseInsensitiveDict(),
+                         text='',
+                         url='http://gw:5000/api')
+        with mock.patch('requests.request', return_value=resp):
+            cl.get('/api')
+            limiter.acquire.assert_called_with(
+                throttle.PRIORITY_BACKGROUND)
+            cl.put('/api/disk/rbd/vol1')
+            limiter.acquire.assert_called_with(
+                throttle.PRIORITY_INTERACTIVE)
+            cl.get('/api/disk/rbd/vol1',
+                   priority=throttle.PRIORITY_INTERACTIVE)
+            limiter.acquire.assert_called_with(
+                throttle.PRIORITY_INTERACTIVE)
+
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+
+    def test_grows_while_latency_is_flat(self):
+        limiter = throttle.AdaptiveConcurrencyLimiter(initial_limit=2,
+                                                      max_limit=10)
+        for _ in range(200):
+            for _ in range(limiter.limit):
+                limiter.acquire()
+            for _ in range(limiter.limit):
+                limiter.release(0.01)
+        self.assertEqual(10, limiter.limit)
+
+    def test_shrinks_on_overload_and_latency(self):
+        limiter = throttle.AdaptiveConcurrencyLimiter(initial_limit=20,
+                                                      min_limit=2)
+        limiter.acquire()
+        limiter.release(0.01)
+        limiter.acquire()
+        limiter.release(0.01, throttle.OUTCOME_OVERLOAD)
+        self.assertEqual(18, limiter.limit)
+        # Only one decrease per limit responses
+        limiter.acquire()
+        limiter.release(0.01, throttle.OUTCOME_OVERLOAD)
+        self.assertEqual(18, limiter.limit)
+        for _ in range(500):
+            limiter.acquire()
+            limiter.release(1.0)
+        self.assertEqual(2, limiter.limit)
+
+    def test_acquire_blocks_at_limit(self):
+        limiter = throttle.AdaptiveConcurrencyLimiter(initial_limit=1)
+        limiter.acquire()
+        acquired = threading.Event()
+
+        def _acquire():
+            limiter.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=_acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(0.01, throttle.OUTCOME_IGNORE)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_client_reports_limit(self):
+        transport = mock.Mock()
+        transport.request.return_value = mock.Mock(
+            status_code=503, text='',
+            headers=requests.structures.CaseInsensitiveDict())
+        cl = client.RBDISCSIClient(
+            'user', 'password', 'http://gw:5000', transport=transport,
+            adaptive_concurrency={'initial_limit': 10})
+        cl.tries = 3
+        cl.backoff = 0
+        with mock.patch('time.sleep'):
+            self.assertRaises(client.exceptions.HTTPServiceUnavailable,
+                              cl.get_api)
+        snapshot = cl.get_metrics()
+        self.assertEqual({'http://gw:5000': 9},
+                         snapshot['concurrency_limit'])
+        self.assertEqual({'http://gw:5000': 2}, snapshot['retries'])
+
+
+class TestRetryBudget(unittest.TestCase):
+
+    def test_fraction_of_successes(self):
+        clock = utils.FakeClock()
+        budget = throttle.RetryBudget(ratio=0.1, min_per_second=0,
+                                      ttl=10, clock=clock)
+        self.assertFalse(budget.try_retry())
+        for i in range(30):
+            budget.record_success()
+        self.assertEqual([True] * 3 + [False],
+                         [budget.try_retry() for i in range(4)])
+
+        # The successes expire after ttl seconds
+        clock.now = 5
+        for i in range(10):
+            budget.record_success()
+        clock.now = 10
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+
+    def test_min_per_second(self):
+        clock = utils.FakeClock()
+        budget = throttle.RetryBudget(min_per_second=1, ttl=2, clock=clock)
+        self.assertEqual([True, True, False],
+                         [budget.try_retry() for i in range(3)])
+        clock.now = 2.5
+        self.assertTrue(budget.try_retry())
+
+    def test_client_denies_retries(self):
+        transport = mock.Mock()
+        transport.request.return_value = mock.Mock(
+            status_code=503, text='',
+            headers=requests.structures.CaseInsensitiveDict())
+        cl = client.RBDISCSIClient(
+            'user', 'password', 'http://gw:5000', transport=transport,
+            retry_budget={'min_per_second': 0.1, 'ttl': 10})
+        cl.tries = 5
+        cl.backoff = 0
+        with mock.patch('time.sleep'):
+            self.assertRaises(client.exceptions.HTTPServiceUnavailable,
+                              cl.get_api)
+            self.assertRaises(client.exceptions.HTTPServiceUnavailable,
+                              cl.get_api)
+        snapshot = cl.get_metrics()
+        self.assertEqual({'http://gw:5000': 1}, snapshot['retries'])
+        self.assertEqual({'http://gw:5000': 2}, snapshot['retries_denied'])
+        self.assertEqual(3, transport.request.call_count)
@@ -0,0 +1,282 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Tests for `rbd_iscsi_client.transport`."""
+
+import gzip
+import http.server
+import io
+import socket
+import socketserver
+import threading
+import unittest
+from unittest import mock
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import exceptions
+from rbd_iscsi_client import fake
+from rbd_iscsi_client import transport
+from rbd_iscsi_client.tests import utils
+
+import requests
+
+import urllib3
+
+
+class TestRequestsTransport(unittest.TestCase):
+
+    def test_timeout_passed(self):
+        with mock.patch('requests.request') as req:
+            transport.RequestsTransport().request('GET', 'http://gw/api',
+                                                  timeout=5)
+            self.assertEqual(5, req.call_args[1]['timeout'])
+            transport.RequestsTransport().request('GET', 'http://gw/api')
+            self.assertNotIn('timeout', req.call_args[1])
+
+
+class TestUrllib3Transport(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = transport.Urllib3Transport()
+        self.manager = mock.Mock()
+        self.transport._managers[False] = self.manager
+
+    def test_request(self):
+        self.manager.urlopen.return_value = mock.Mock(
+            status=200, headers={'Content-Type': 'application/json'},
+            data=b'{"disks": []}')
+        r = self.transport.request('PUT', 'http://gw/api/disk/rbd/vol1',
+                                   data={'mode': 'create'},
+                                   headers={'Accept': 'application/json'},
+                                   auth=('user', 'password'), verify=False)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('{"disks": []}', r.text)
+        self.assertEqual('application/json', r.headers['content-type'])
+        args, kwargs = self.manager.urlopen.call_args
+        self.assertEqual(('PUT', 'http://gw/api/disk/rbd/vol1'), args)
+        self.assertEqual('mode=create', kwargs['body'])
+        self.assertEqual('application/x-www-form-urlencoded',
+                         kwargs['headers']['Content-Type'])
+        self.assertTrue(
+            kwargs['headers']['authorization'].startswith('Basic '))
+
+    def test_errors_translated(self):
+        cases = [
+            (urllib3.exceptions.NewConnectionError(None, 'refused'),
+             requests.exceptions.ConnectionError),
+            (urllib3.exceptions.ReadTimeoutError(None, None, 'slow'),
+             requests.exceptions.Timeout),
+            (urllib3.exceptions.SSLError('bad cert'),
+             requests.exceptions.SSLError),
+            (urllib3.exceptions.ProtocolError('reset'),
+             requests.exceptions.ConnectionError),
+        ]
+        for error, expected in cases:
+            self.manager.urlopen.side_effect = error
+            self.assertRaises(expected, self.transport.request,
+                              'GET', 'http://gw/api', verify=False)
+
+    def test_client_retries_connection_errors(self):
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   transport=self.transport)
+        cl.tries = 2
+        cl.backoff = 0
+        self.manager.urlopen.side_effect = (
+            urllib3.exceptions.ProtocolError('reset'))
+        with mock.patch('time.sleep'):
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              cl.get_api)
+        self.assertEqual(2, self.manager.urlopen.call_count)
+
+        self.manager.urlopen.side_effect = (
+            urllib3.exceptions.ReadTimeoutError(None, None, 'slow'))
+        self.assertRaises(exceptions.Timeout, cl.get_api)
+
+    def test_compressed_response(self):
+        raw = b'{"disks": [%s]}' % b', '.join([b'"rbd/volume"'] * 100)
+        self.manager.urlopen.return_value = urllib3.HTTPResponse(
+            body=io.BytesIO(gzip.compress(raw)), status=200,
+            headers={'Content-Encoding': 'gzip'}, preload_content=True)
+        cl = client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                   transport=self.transport)
+        resp, body = cl.get_disks()
+        self.assertEqual(100, len(body['disks']))
+        headers = self.manager.urlopen.call_args[1]['headers']
+        self.assertIn('gzip', headers['Accept-Encoding'])
+        self.assertEqual(len(gzip.compress(raw)),
+                         cl.metrics.get('bytes_received',
+                                        gateway='http://gw:5000'))
+        self.assertEqual(len(raw), cl.metrics.get('bytes_decoded',
+                                                  gateway='http://gw:5000'))
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+
+class TestUrllib3Pooling(unittest.TestCase):
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://localhost:%d' % self.server.server_port
+        self.clock = utils.FakeClock()
+        self.transport = transport.Urllib3Transport(maxsize=4,
+                                                    idle_timeout=30,
+                                                    clock=self.clock)
+        self.addCleanup(self.transport.close)
+
+    def _pool(self, verify=True):
+        return self.transport._manager(verify).connection_from_url(self.url)
+
+    def _open(self, verify=True):
+        return [conn for conn in self._pool(verify).pool.queue
+                if conn is not None and conn.sock is not None]
+
+    def test_prewarm(self):
+        with mock.patch.object(self.transport.resolver, '_getaddrinfo',
+                               wraps=self.transport.resolver._getaddrinfo
+                               ) as getaddrinfo:
+            self.assertEqual(2, self.transport.prewarm(self.url, 2))
+            self.assertEqual(2, len(self._open()))
+            # The pooled connections are used, and the address cached
+            r = self.transport.request('GET', self.url + '/api')
+            self.assertEqual(200, r.status_code)
+            self.assertEqual(1, getaddrinfo.call_count)
+        self.assertEqual(2, len(self._open()))
+        self.assertEqual(2, self.transport.prewarm(self.url))
+        self.assertEqual(4, len(self._open()))
+
+    def test_idle_connections_closed(self):
+        self.transport.prewarm(self.url, 2)
+        self.clock.now = 10
+        self.assertEqual(0, self.transport.reap_idle())
+        self.clock.now = 30
+        self.assertEqual(2, self.transport.reap_idle())
+        self.assertEqual([], self._open())
+        # The closed connections are reopened by the requests
+        r = self.transport.request('GET', self.url + '/api')
+        self.assertEqual(200, r.status_code)
+
+    def test_idle_connection_not_reused(self):
+        self.transport.request('GET', self.url + '/api')
+        conn = self._open()[0]
+        sock = conn.sock
+        self.clock.now = 60
+        self.transport.request('GET', self.url + '/api')
+        self.assertIsNot(sock, conn.sock)
+
+    def test_prewarm_refused(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          self.transport.prewarm, self.url)
+
+    def test_name_not_resolved(self):
+        def _getaddrinfo(*args):
+            raise socket.gaierror(socket.EAI_NONAME, 'Name not known')
+
+        self.transport.resolver._getaddrinfo = _getaddrinfo
+        self.assertRaises(requests.exceptions.ConnectionError,
+                          self.transport.request, 'GET', self.url + '/api')
+        # urllib3 before 2.0 has no NameResolutionError
+        with mock.patch.object(urllib3.exceptions, 'NameResolutionError',
+                               None, create=True):
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              self.transport.request, 'GET',
+                              self.url + '/api')
+
+    def test_client_prewarm(self):
+        cl = client.RBDISCSIClient('user', 'password',
+                                   [self.url, 'http://localhost:1'],
+                                   transport=self.transport, prewarm=1)
+        self.assertEqual(1, len(self._open(verify=False)))
+        self.assertEqual({self.url: 1, 'http://localhost:1': 0},
+                         cl.get_metrics()['connections_prewarmed'])
+        cl = utils.fake_client(base_url=self.url)
+        self.assertEqual({}, cl.prewarm())
+
+
+class TestCompressionNegotiation(unittest.TestCase):
+
+    def _client(self, **kwargs):
+        self.transport = fake.FakeTransport()
+        self.transport.accept_encoding = 'gzip,deflate'
+        self.transport.request = mock.Mock(
+            wraps=self.transport.request)
+        return client.RBDISCSIClient('user', 'password', 'http://gw:5000',
+                                     transport=self.transport, **kwargs)
+
+    def _accept_encoding(self):
+        return self.transport.request.call_args[1]['headers'].get(
+            'Accept-Encoding')
+
+    def test_accept_encoding(self):
+        self.assertIsNone(transport.accept_encoding(mock.Mock()))
+        self.assertIsNone(
+            transport.accept_encoding(fake.FakeTransport()))
+        self.assertIn('gzip', transport.Urllib3Transport().accept_encoding)
+        self.assertIn('gzip', transport.RequestsTransport().accept_encoding)
+
+        cl = self._client()
+        cl.get_api()
+        self.assertEqual('gzip,deflate', self._accept_encoding())
+
+    def test_compression_disabled(self):
+        cl = self._client(compression=False)
+        cl.get_api()
+        self.assertEqual('identity', self._accept_encoding())
+
+    def test_threshold(self):
+        cl = self._client(compression_threshold=1000)
+        for i in range(100):
+            cl.create_disk('rbd', 'volume-%d' % i)
+        cl.get_api()
+        self.assertEqual('gzip,deflate', self._accept_encoding())
+        cl.get_api()
+        self.assertEqual('identity', self._accept_encoding())
+        cl.get_disks()
+        cl.get_disks()
+        # Over the threshold, still compressed
+        self.assertEqual('gzip,deflate', self._accept_encoding())
+        self.assertEqual(cl.metrics.get('bytes_received',
+                                        gateway='http://gw:5000'),
+                         cl.metrics.get('bytes_decoded',
+                                        gateway='http://gw:5000'))
+
+    def test_sizes_kept_by_endpoint(self):
+        cl = self._client(compression_threshold=1000)
+        for i in range(10):
+            cl.create_disk('rbd', 'volume-%d' % i)
+            cl.find_disk('rbd', 'volume-%d' % i)
+        self.assertEqual({('PUT', '/api/disk'), ('GET', '/api/disk')},
+                         set(cl._response_sizes))
@@ -0,0 +1,37 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Helpers shared by the tests."""
+
+from rbd_iscsi_client import client
+from rbd_iscsi_client import fake
+
+GATEWAY_URL = 'http://gw:5000'
+
+
+class FakeClock(object):
+    """A clock standing still until the test moves it with now."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_client(gateway=None, base_url=GATEWAY_URL, **kwargs):
+    """Return a client of gateway, a new FakeGateway by default.
+
+    The other keyword arguments are passed to RBDISCSIClient.
+    """
+    return client.RBDISCSIClient('user', 'password', base_url,
+                                 transport=fake.FakeTransport(gateway),
+                                 **kwargs)
@@ -0,0 +1,323 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+Client side throttling
+
+.. module: throttle
+
+:Description: Limits on how fast the client sends requests to the
+rbd-target-api gateways.
+"""
+
+import collections
+import threading
+import time
+
+from rbd_iscsi_client import exceptions
+
+# Priority classes for the rate limiter.  Interactive requests are the
+# latency critical mutations (attach/detach), background requests are
+# the reads done by inventory syncs and stats polls.
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BACKGROUND = 'background'
+
+# Longest a limiter waits without checking the cancel token of the
+# request waiting for it.
+CANCEL_CHECK_INTERVAL = 0.1
+
+
+def _wait(cond, wait, token=None):
+    """Wait on cond for wait seconds at most, None for no limit.
+
+    With a cancel.CancelToken, the wait stops with Cancelled when the
+    token is cancelled, and with DeadlineExceeded right away when it
+    would end past the deadline.
+    """
+    if token is None:
+        cond.wait(wait)
+        return
+    token.check()
+    remaining = token.remaining()
+    if remaining is not None and wait is not None and wait >= remaining:
+        raise exceptions.DeadlineExceeded()
+    interval = CANCEL_CHECK_INTERVAL
+    if wait is not None:
+        interval = min(interval, wait)
+    if remaining is not None:
+        interval = min(interval, remaining)
+    cond.wait(interval)
+    token.check()
+
+
+class TokenBucket(object):
+    """A token bucket refilled at rate tokens per second.
+
+    :param rate: Tokens added per second
+    :param burst: Size of the bucket, defaults to rate
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._clock = clock
+        self._tokens = self.burst
+        self._stamp = clock()
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._stamp
+        if elapsed > 0:
+            self._tokens = min(self.burst,
+                               self._tokens + elapsed * self.rate)
+            self._stamp = now
+
+    def delay(self, tokens=1):
+        """Seconds until tokens are available, 0 if they are now."""
+        self._refill()
+        if self._tokens >= tokens:
+            return 0
+        return (tokens - self._tokens) / self.rate
+
+    def consume(self, tokens=1):
+        self._refill()
+        self._tokens -= tokens
+
+    def try_acquire(self, tokens=1):
+        """Take tokens if they are available right now."""
+        if self.delay(tokens):
+            return False
+        self.consume(tokens)
+        return True
+
+
+class PriorityRateLimiter(object):
+    """Rate limiter with interactive and background priority classes.
+
+    All requests share a token bucket of rate requests per second.
+    Background requests are additionally limited to background_rate,
+    and they yield to interactive requests: while any interactive
+    request is waiting for a token, no background request is let
+    through.
+
+    :param rate: Overall requests per second
+    :param burst: Overall burst size, defaults to rate
+    :param background_rate: Requests per second for background requests,
+                            defaults to half of rate
+    :param background_burst: Burst size for background requests
+    """
+
+    def __init__(self, rate, burst=None, background_rate=None,
+                 background_burst=None, clock=time.monotonic):
+        if background_rate is None:
+            background_rate = rate / 2.0
+        self._bucket = TokenBucket(rate, burst, clock=clock)
+        self._background = TokenBucket(background_rate, background_burst,
+                                       clock=clock)
+        self._cond = threading.Condition()
+        self._interactive_waiters = 0
+
+    @property
+    def interactive_waiters(self):
+        return self._interactive_waiters
+
+    def after_fork(self):
+        """Forget the waiters of the parent process."""
+        self._cond = threading.Condition()
+        self._interactive_waiters = 0
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE, token=None):
+        """Block until a request of the given priority may be sent.
+
+        The wait is given up when the cancel token is cancelled.
+        """
+        interactive = priority != PRIORITY_BACKGROUND
+        with self._cond:
+            if interactive:
+                self._interactive_waiters += 1
+            try:
+                while True:
+                    if interactive:
+                        wait = self._bucket.delay()
+                    elif self._interactive_waiters:
+                        # Yield to queued interactive requests, we get
+                        # notified when one of them got its token.
+                        wait = None
+                    else:
+                        wait = max(self._bucket.delay(),
+                                   self._background.delay())
+
+                    if wait == 0:
+                        self._bucket.consume()
+                        if not interactive:
+                            self._background.consume()
+                        return
+                    _wait(self._cond, wait, token)
+            finally:
+                if interactive:
+                    self._interactive_waiters -= 1
+                    self._cond.notify_all()
+
+
+# Outcomes reported to the AdaptiveConcurrencyLimiter.
+OUTCOME_OK = 'ok'
+OUTCOME_OVERLOAD = 'overload'
+OUTCOME_IGNORE = 'ignore'
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """Limit the requests in flight to a gateway, adapting to its latency.
+
+    The limit grows additively, by about one per round trip, while the
+    latency stays within tolerance times the lowest latency seen
+    recently.  It shrinks multiplicatively when the latency goes past
+    that or when the gateway is overloaded (503 or timeout), at most
+    once per limit responses so that one burst of slow responses only
+    counts once.
+
+    :param initial_limit: The limit to start with
+    :param min_limit: The limit never drops below this
+    :param max_limit: The limit never grows above this
+    :param tolerance: Latency ratio to the baseline considered queueing
+    :param backoff: Factor applied to the limit on overload
+    :param window: Number of samples after which the baseline latency is
+                   recomputed, so it can follow the gateway when it gets
+                   slower for good
+    """
+
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=200,
+                 tolerance=2.0, backoff=0.9, window=500):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.window = window
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._inflight = 0
+        self._baseline = None
+        self._window_min = None
+        self._samples = 0
+        # Allow the first decrease right away
+        self._since_decrease = int(self._limit)
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """The current number of requests allowed in flight."""
+        return int(self._limit)
+
+    @property
+    def inflight(self):
+        return self._inflight
+
+    def acquire(self, token=None):
+        """Block until a request may be sent to the gateway.
+
+        The wait is given up when the cancel token is cancelled.
+        """
+        with self._cond:
+            while self._inflight >= int(self._limit):
+                _wait(self._cond, None, token)
+            self._inflight += 1
+
+    def release(self, latency, outcome=OUTCOME_OK):
+        """Report the latency and outcome of a request sent."""
+        with self._cond:
+            self._inflight -= 1
+            self._since_decrease += 1
+            if outcome == OUTCOME_OVERLOAD:
+                self._decrease()
+            elif outcome == OUTCOME_OK:
+                self._sample(latency)
+            self._cond.notify_all()
+
+    def _decrease(self):
+        if self._since_decrease >= int(self._limit):
+            self._limit = max(self.min_limit, self._limit * self.backoff)
+            self._since_decrease = 0
+
+    def _sample(self, latency):
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        if self._window_min is None or latency < self._window_min:
+            self._window_min = latency
+        self._samples += 1
+        if self._samples >= self.window:
+            self._baseline = self._window_min
+            self._window_min = None
+            self._samples = 0
+
+        if latency > self._baseline * self.tolerance:
+            self._decrease()
+        elif self._inflight + 1 >= int(self._limit):
+            # Only grow while the limit is actually being used
+            self._limit = min(self.max_limit, self._limit + 1.0 / self._limit)
+
+
+class RetryBudget(object):
+    """Allow retries only while they are a fraction of the successes.
+
+    The successful requests and the retries of the last ttl seconds are
+    counted.  A retry is allowed while the retries stay below ratio
+    times the successes, plus min_per_second so that a gateway that
+    hasn't answered for a while can still be retried slowly.  An
+    overloaded gateway, which stops answering, stops being retried
+    instead of being sent every request tries times.
+
+    :param ratio: Retries allowed per successful request
+    :param min_per_second: Retries always allowed per second
+    :param ttl: Seconds the requests are counted for
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1, ttl=10,
+                 clock=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        # [second, successes, retries] of the recent seconds, oldest first
+        self._slots = collections.deque()
+        self._successes = 0
+        self._retries = 0
+
+    def _slot(self):
+        now = int(self._clock())
+        slots = self._slots
+        while slots and slots[0][0] <= now - self.ttl:
+            second, successes, retries = slots.popleft()
+            self._successes -= successes
+            self._retries -= retries
+        if not slots or slots[-1][0] != now:
+            slots.append([now, 0, 0])
+        return slots[-1]
+
+    def record_success(self):
+        with self._lock:
+            self._slot()[1] += 1
+            self._successes += 1
+
+    def try_retry(self):
+        """Take a retry from the budget, False if it is spent."""
+        with self._lock:
+            slot = self._slot()
+            allowed = (self._successes * self.ratio +
+                       self.min_per_second * self.ttl)
+            if self._retries + 1 > allowed:
+                return False
+            slot[2] += 1
+            self._retries += 1
+            return True
+
+    def after_fork(self):
+        self._lock = threading.Lock()
@@ -0,0 +1,419 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""
+HTTP transports
+
+.. module: transport
+
+:Description: The transports RBDISCSIClient sends its requests with.
+A transport takes a fully formed request and returns a response object
+with ``status_code``, ``headers``, ``text``, ``url`` and ``close()``,
+like the one from Python Requests.  Transport errors are raised as the
+matching ``requests.exceptions`` class, so the client handles them the
+same way whatever transport is in use.
+"""
+
+import contextlib
+import socket
+import time
+from urllib import parse
+
+from rbd_iscsi_client import dns
+from rbd_iscsi_client import lazy
+
+requests = lazy.LazyModule('requests')
+urllib3 = lazy.LazyModule('urllib3')
+
+
+class Transport(object):
+    """Base class of the client transports."""
+
+    # The value of the Accept-Encoding header for the content codings
+    # the transport decodes, None for a transport that doesn't decode
+    # any.
+    accept_encoding = None
+
+    def request(self, method, url, data=None, headers=None, auth=None,
+                verify=True, timeout=None):
+        """Send a single HTTP request.
+
+        :param method: The HTTP verb
+        :param url: The full url of the request
+        :param data: dict of form fields, or an already encoded body
+        :param headers: dict of request headers
+        :param auth: requests.auth.HTTPBasicAuth or (user, password)
+        :param verify: Verify the SSL certificate of the server
+        :param timeout: Seconds to wait for the server, None for no limit
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Release any connections held by the transport."""
+        pass
+
+    def after_fork(self):
+        """Called in a child process before the transport is used.
+
+        Connections opened by the parent must not be used by the child,
+        transports pooling them drop them here.
+        """
+        pass
+
+
+class Response(object):
+    """A minimal Requests like response for non Requests transports.
+
+    content is the decoded body and wire_bytes the size of the body as
+    received, before it was decompressed, when they are known.
+    """
+
+    def __init__(self, status_code, headers=None, text='', url=None,
+                 content=None, wire_bytes=None):
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(
+            headers or {})
+        self.text = text
+        self.url = url
+        self.content = content
+        self.wire_bytes = wire_bytes
+
+    def close(self):
+        pass
+
+
+def basic_auth_credentials(auth):
+    """Return (username, password) from a requests auth object."""
+    if auth is None:
+        return None
+    if isinstance(auth, (tuple, list)):
+        return tuple(auth)
+    return auth.username, auth.password
+
+
+def accept_encoding(transport):
+    """The Accept-Encoding to send with transport, None to send none."""
+    if isinstance(transport, Transport):
+        return transport.accept_encoding
+    return None
+
+
+def _urllib3_accept_encoding():
+    # urllib3 lists the codings it can decode, brotli and zstd only
+    # when their modules are installed.
+    return urllib3.util.request.ACCEPT_ENCODING
+
+
+def response_sizes(response):
+    """Return the (wire, decoded) sizes of the body of a response.
+
+    The wire size is the size of the body as received, which is smaller
+    than the decoded size when the body was compressed.  When the
+    transport doesn't report it, the body is assumed uncompressed.
+    """
+    content = getattr(response, 'content', None)
+    if isinstance(content, bytes):
+        decoded = len(content)
+    else:
+        text = response.text
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        decoded = len(text) if isinstance(text, bytes) else 0
+
+    wire = getattr(response, 'wire_bytes', None)
+    if wire is None:
+        # The urllib3 response of a Requests response counts the bytes
+        # read from the socket.
+        raw = getattr(response, 'raw', None)
+        tell = getattr(raw, 'tell', None)
+        if tell is not None:
+            try:
+                wire = tell()
+            except Exception:
+                wire = None
+    if not isinstance(wire, int):
+        wire = decoded
+    return wire, decoded
+
+
+def encode_body(data):
+    """Form encode data the way Requests does for a dict payload."""
+    if data is None or isinstance(data, (bytes, str)):
+        return data
+    return parse.urlencode(data, doseq=True)
+
+
+class RequestsTransport(Transport):
+    """Transport using requests.request(), the historical behaviour."""
+
+    @property
+    def accept_encoding(self):
+        return _urllib3_accept_encoding()
+
+    def request(self, method, url, data=None, headers=None, auth=None,
+                verify=True, timeout=None):
+        if timeout:
+            return requests.request(method, url, data=data,
+                                    headers=headers,
+                                    auth=auth,
+                                    verify=verify,
+                                    timeout=timeout)
+        return requests.request(method, url, data=data,
+                                auth=auth,
+                                headers=headers,
+                                verify=verify)
+
+
+class _ResolvingConnection(object):
+    """Mixin of the urllib3 connections of an Urllib3Transport.
+
+    The addresses of the gateway come from the resolver of the transport
+    and are connected to with dns.connect().
+    """
+
+    transport = None
+
+    def _new_conn(self):
+        transport = self.transport
+        timeout = self.timeout
+        if not isinstance(timeout, (int, float)):
+            # urllib3 default timeout sentinel
+            timeout = socket.getdefaulttimeout()
+        try:
+            infos = transport.resolver.resolve(self._dns_host, self.port)
+            return dns.connect(infos, timeout,
+                               delay=transport.happy_eyeballs_delay,
+                               source_address=self.source_address,
+                               socket_options=self.socket_options)
+        except socket.gaierror as err:
+            name_error = getattr(urllib3.exceptions, 'NameResolutionError',
+                                 None)
+            if name_error is not None:
+                raise name_error(self.host, self, err) from err
+            raise urllib3.exceptions.NewConnectionError(
+                self, "Failed to resolve %s: %s" % (self.host, err))
+        except socket.timeout as err:
+            raise urllib3.exceptions.ConnectTimeoutError(
+                self, "Connection to %s timed out. (connect timeout=%s)" %
+                (self.host, timeout)) from err
+        except OSError as err:
+            raise urllib3.exceptions.NewConnectionError(
+                self, "Failed to establish a new connection: %s" % err
+            ) from err
+
+
+class _IdleReapingPool(object):
+    """Mixin of the urllib3 pools of an Urllib3Transport.
+
+    The connections returned to the pool are stamped, and the ones idle
+    for longer than the idle timeout of the transport are closed when
+    taken out, rather than sending a request on a connection the gateway
+    may be closing.
+    """
+
+    transport = None
+
+    def _get_conn(self, timeout=None):
+        conn = super(_IdleReapingPool, self)._get_conn(timeout=timeout)
+        self.transport._expire(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn._idle_since = self.transport._clock()
+        super(_IdleReapingPool, self)._put_conn(conn)
+
+
+@contextlib.contextmanager
+def _translate_urllib3_errors():
+    """Raise the urllib3 errors as the matching requests exception."""
+    try:
+        yield
+    except urllib3.exceptions.SSLError as err:
+        raise requests.exceptions.SSLError(err)
+    except urllib3.exceptions.NewConnectionError as err:
+        # Checked first, older urllib3 derive it from the connect
+        # timeout error.
+        raise requests.exceptions.ConnectionError(err)
+    except urllib3.exceptions.ConnectTimeoutError as err:
+        raise requests.exceptions.ConnectTimeout(err)
+    except urllib3.exceptions.ReadTimeoutError as err:
+        raise requests.exceptions.ReadTimeout(err)
+    except urllib3.exceptions.LocationValueError as err:
+        raise requests.exceptions.URLRequired(err)
+    except urllib3.exceptions.ProtocolError as err:
+        raise requests.exceptions.ConnectionError(err)
+    except urllib3.exceptions.HTTPError as err:
+        raise requests.exceptions.RequestException(err)
+
+
+class Urllib3Transport(Transport):
+    """Transport keeping persistent connection pools with urllib3.
+
+    Unlike requests.request(), which builds a new session for every
+    call, the connections to each gateway are kept in a pool and
+    reused.  Redirects are not followed.
+
+    The addresses of the gateways are cached by a dns.Resolver, and
+    connected to happy eyeballs style with dns.connect().  The pooled
+    connections idle for longer than idle_timeout seconds are closed
+    before being used again, set it below the keep alive timeout of the
+    gateways.  prewarm() opens connections ahead of the first requests.
+
+    :param num_pools: Number of gateway pools to keep
+    :param maxsize: Number of connections to keep per gateway
+    :param resolver: dns.Resolver caching the gateway addresses, a new
+                     one by default
+    :param happy_eyeballs_delay: Seconds before trying the next address
+                                 of a gateway
+    :param idle_timeout: Seconds a pooled connection is kept unused,
+                         None to keep them until the gateway closes them
+    """
+
+    def __init__(self, num_pools=10, maxsize=10, resolver=None,
+                 happy_eyeballs_delay=dns.DEFAULT_ATTEMPT_DELAY,
+                 idle_timeout=30, clock=time.monotonic):
+        super(Urllib3Transport, self).__init__()
+        self.num_pools = num_pools
+        self.maxsize = maxsize
+        if resolver is None:
+            resolver = dns.Resolver()
+        self.resolver = resolver
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._managers = {}
+        self._pool_classes = None
+
+    @property
+    def accept_encoding(self):
+        return _urllib3_accept_encoding()
+
+    def _pool_classes_by_scheme(self):
+        if self._pool_classes is None:
+            classes = {}
+            for scheme, pool_cls in (
+                    ('http', urllib3.HTTPConnectionPool),
+                    ('https', urllib3.HTTPSConnectionPool)):
+                conn_cls = type(pool_cls.ConnectionCls.__name__,
+                                (_ResolvingConnection,
+                                 pool_cls.ConnectionCls),
+                                {'transport': self})
+                classes[scheme] = type(pool_cls.__name__,
+                                       (_IdleReapingPool, pool_cls),
+                                       {'transport': self,
+                                        'ConnectionCls': conn_cls})
+            self._pool_classes = classes
+        return self._pool_classes
+
+    def _manager(self, verify):
+        manager = self._managers.get(verify)
+        if manager is None:
+            cert_reqs = 'CERT_REQUIRED' if verify else 'CERT_NONE'
+            manager = urllib3.PoolManager(num_pools=self.num_pools,
+                                          maxsize=self.maxsize,
+                                          cert_reqs=cert_reqs)
+            manager.pool_classes_by_scheme = self._pool_classes_by_scheme()
+            self._managers[verify] = manager
+        return manager
+
+    def _idle(self, conn):
+        """Was conn, an open pooled connection, idle for too long?"""
+        idle_since = getattr(conn, '_idle_since', None)
+        return (self.idle_timeout is not None and idle_since is not None and
+                getattr(conn, 'sock', None) is not None and
+                self._clock() - idle_since >= self.idle_timeout)
+
+    def _expire(self, conn):
+        if conn is not None and self._idle(conn):
+            # urllib3 opens a new connection for the next request
+            conn.close()
+            return True
+        return False
+
+    def request(self, method, url, data=None, headers=None, auth=None,
+                verify=True, timeout=None):
+        headers = dict(headers or {})
+        body = encode_body(data)
+        if body is not None and 'Content-Type' not in headers:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        credentials = basic_auth_credentials(auth)
+        if credentials:
+            headers.update(urllib3.util.make_headers(
+                basic_auth='%s:%s' % credentials))
+
+        with _translate_urllib3_errors():
+            r = self._manager(verify).urlopen(
+                method, url, body=body, headers=headers,
+                timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                retries=False, redirect=False, preload_content=True)
+
+        # urllib3 decompresses the body, tell() is what was received
+        return Response(r.status, r.headers,
+                        r.data.decode('utf-8', 'replace'), url,
+                        content=r.data, wire_bytes=r.tell())
+
+    def prewarm(self, url, count=None, verify=True, timeout=None):
+        """Open connections to the gateway of url ahead of the requests.
+
+        Up to count connections, maxsize by default, are opened and put
+        in the pool of the gateway.  Returns the number of connections
+        opened, the ones already open are left alone.
+        """
+        count = self.maxsize if count is None else min(count, self.maxsize)
+        pool = self._manager(verify).connection_from_url(url)
+        conns = []
+        opened = 0
+        try:
+            with _translate_urllib3_errors():
+                for dummy in range(count):
+                    conn = pool._get_conn()
+                    conns.append(conn)
+                    if getattr(conn, 'sock', None) is None:
+                        if timeout is not None:
+                            conn.timeout = timeout
+                        conn.connect()
+                        opened += 1
+        finally:
+            for conn in conns:
+                pool._put_conn(conn)
+        return opened
+
+    def reap_idle(self):
+        """Close the pooled connections idle for too long.
+
+        They are closed anyway before being used again, this releases
+        them sooner, from a housekeeping thread for example.  Returns the
+        number of connections closed.
+        """
+        closed = 0
+        for manager in list(self._managers.values()):
+            pools = manager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                queue = getattr(pool, 'pool', None)
+                if queue is None:
+                    continue
+                with queue.mutex:
+                    for conn in list(queue.queue):
+                        if self._expire(conn):
+                            closed += 1
+        return closed
+
+    def after_fork(self):
+        # Closing the pools would close the sockets the parent still
+        # uses, just forget them.
+        self._managers = {}
+        self.resolver.after_fork()
+
+    def close(self):
+        for manager in self._managers.values():
+            manager.clear()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+"""Micro-benchmark of the client side cost of encoding a request.
+
+Compares building the headers and letting Requests form encode a dict
+payload on every call, with the precomputed headers and reused form
+templates of rbd_iscsi_client.encoding.
+
+    python tools/bench_request_encoding.py [-n NUMBER]
+"""
+
+import argparse
+import timeit
+
+from rbd_iscsi_client import encoding
+
+import requests
+
+PAYLOADS = {
+    'export_disk': {'disk': 'rbd/volume-5e1b8d4c-2f1a-4a57-9d5e-7e6ad3f1c2b0',
+                    'client_iqn': 'iqn.1994-05.com.redhat:compute-0042'},
+    'create_disk': {'pool': 'rbd',
+                    'image': 'volume-5e1b8d4c-2f1a-4a57-9d5e-7e6ad3f1c2b0',
+                    'mode': 'create', 'size': '10G'},
+    'set_client_auth': {'username': 'chapuser0042',
+                        'password': 'Zq8vX2mN5pL7rT1w'},
+}
+
+
+def old_style(payload):
+    headers = {}
+    headers['User-Agent'] = 'os_client'
+    headers['Accept'] = 'application/json'
+    return (requests.Request('PUT', 'http://gw:5000/api/x', data=payload,
+                             headers=headers).prepare())
+
+
+def new_style(encoder, static_headers, payload):
+    headers = dict(static_headers)
+    body = encoder.encode(payload)
+    return (requests.Request('PUT', 'http://gw:5000/api/x', data=body,
+                             headers=headers).prepare())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    encoder = encoding.BodyEncoder()
+    static_headers = {'User-Agent': 'os_client',
+                      'Accept': 'application/json',
+                      'Content-Type': encoder.content_type}
+
+    print("%-16s %12s %12s %12s %12s" % (
+        'endpoint', 'requests us', 'template us', 'prepare us',
+        'prepared us'))
+    for name, payload in sorted(PAYLOADS.items()):
+        encode_old = timeit.timeit(
+            lambda: requests.models.RequestEncodingMixin._encode_params(
+                payload), number=args.number)
+        encode_new = timeit.timeit(lambda: encoder.encode(payload),
+                                   number=args.number)
+        prepare_old = timeit.timeit(lambda: old_style(payload),
+                                    number=args.number)
+        prepare_new = timeit.timeit(
+            lambda: new_style(encoder, static_headers, payload),
+            number=args.number)
+        scale = 1e6 / args.number
+        print("%-16s %12.2f %12.2f %12.2f %12.2f" % (
+            name, encode_old * scale, encode_new * scale,
+            prepare_old * scale, prepare_new * scale))
+
+
+if __name__ == '__main__':
+    main()